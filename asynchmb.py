@@ -0,0 +1,386 @@
+"""
+Module for exchanging messages with an httpmsgbus server from an asyncio
+event loop. It needs the aiohttp library.
+
+A single event loop can long-poll several queues and buses and publish
+results concurrently:
+
+    async def main():
+        l1 = AsyncEmscHmbListener(url1, ['QUEUE1']).authentication('user', 'password')
+        l2 = AsyncEmscHmbListener(url2, ['QUEUE2']).authentication('user', 'password')
+        await asyncio.gather(l1.listen(process), l2.listen(process))
+"""
+import asyncio
+import inspect
+import logging
+import time
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from hmbsession import BaseHmbSession, BsonStreamSplitter, generic_hmb_display, _attempts
+from emschmb import EmscHmbListener, EmscHmbPublisher, decode_emsc_msg, emsc_envelope, _genericAuthor
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+
+class HmbHTTPError(Exception):
+    """http error status returned by the hmb server"""
+    def __init__(self, status, text):
+        super(HmbHTTPError, self).__init__('%d %s' % (status, text))
+        self.status = status
+
+
+async def _check_response_raise(r):
+    if r.status == 400:
+        raise HmbHTTPError(r.status, "bad request: " + (await r.text()).strip())
+    elif r.status == 503:
+        raise HmbHTTPError(r.status, "service unavailable: " + (await r.text()).strip())
+    elif r.status >= 400:
+        raise HmbHTTPError(r.status, r.reason or '')
+
+
+def _client_timeout(timeout):
+    """converts a requests like timeout (connect, read) to aiohttp"""
+    if timeout is None:
+        return None
+    if isinstance(timeout, (tuple, list)):
+        connect, read = timeout
+    else:
+        connect = read = timeout
+    return aiohttp.ClientTimeout(total=None, sock_connect=connect, sock_read=read)
+
+
+class AsyncHmbSession(BaseHmbSession):
+    """asyncio counterpart of hmbsession.HmbSession. The methods doing I/O
+    are coroutines (or asynchronous generators for iter_*), with the same
+    parameters and semantics, including seq continuation and retries."""
+    def __init__(self, *args, **kwargs):
+        if aiohttp is None:
+            raise ImportError('AsyncHmbSession needs the aiohttp library')
+        super(AsyncHmbSession, self).__init__(*args, **kwargs)
+
+    def _request_kwargs(self):
+        kwargs = dict(self.requests_kwargs)
+        if 'timeout' in kwargs:
+            kwargs['timeout'] = _client_timeout(kwargs['timeout'])
+        return kwargs
+
+    def get_httpsession(self):
+        if self._http_persistant is None or self._http_persistant.closed:
+            self._logger.debug('New http session')
+            auth = aiohttp.BasicAuth(*self.auth) if self.auth is not None and self.auth[0] is not None else None
+            self._http_persistant = aiohttp.ClientSession(auth=auth)
+        return self._http_persistant
+
+    async def close(self):
+        if self._http_persistant is not None:
+            await self._http_persistant.close()
+
+    async def _open(self):
+        """opens the HMB session"""
+        try:
+            url = self.url + '/open'
+            async with self.get_httpsession().post(
+                    url, data=self._encode_param(),
+                    headers={"Content-type": self._content_type()},
+                    **self._request_kwargs()) as r:
+                self._logger.debug('Open %s with status %s', url, r.status)
+                await _check_response_raise(r)
+                touch = self._apply_ack(self._decode_ack(await r.read()))
+
+            for qname in touch:
+                await self.send(self._touch_msg(qname))
+
+        except (aiohttp.ClientError, asyncio.TimeoutError, HmbHTTPError) as e:
+            self._logger.error("HMB connexion error: %s", str(e))
+            raise ValueError('Hmb Session not open') from e
+
+    async def info(self):
+        """gets info from the hmb server on defined queues, topics and available
+        data."""
+        return await self._info_request('info')
+
+    async def features(self):
+        """gets functions and capabilities supported by the server and optionally
+        the name and version of the server software."""
+        return await self._info_request('features')
+
+    async def status(self):
+        """gets status of connected clients (sessions)."""
+        return await self._info_request('status')
+
+    async def _info_request(self, cmd):
+        url = self.url + '/' + cmd
+        try:
+            async with self.get_httpsession().get(url, **self._request_kwargs()) as r:
+                self._logger.debug('Info %s with status %s', url, r.status)
+                await _check_response_raise(r)
+                return await r.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, HmbHTTPError) as e:
+            self._logger.error("Unable to acces /%s: %s", cmd, str(e))
+            return None
+
+    async def _wrap_retry(self, func, args, retries):
+        for i in _attempts(retries):
+            self.retry_policy.before_call()
+            try:
+                if self._sid is None:
+                    await self._open()
+                res = await func(*args)
+            except Exception as e:
+                delay = self._retry_delay(e, func, args, i, retries)
+                if delay is None:
+                    break
+                await asyncio.sleep(delay)
+            else:
+                self.retry_policy.success()
+                return res
+
+        self._logger.error("Max retry: HMB connexion lost")
+        raise ValueError('Exit Hmb Session. Max retry reached!')
+
+    async def _wrap_retry_iter(self, func, args, retries):
+        for i in _attempts(retries):
+            self.retry_policy.before_call()
+            try:
+                if self._sid is None:
+                    await self._open()
+                async for item in func(*args):
+                    yield item
+            except Exception as e:
+                delay = self._retry_delay(e, func, args, i, retries)
+                if delay is None:
+                    break
+                await asyncio.sleep(delay)
+            else:
+                self.retry_policy.success()
+                return
+
+        self._logger.error("Max retry: HMB connexion lost")
+        raise ValueError('Exit Hmb Session. Max retry reached!')
+
+    async def send_msg(self, queue, data, mtype='MSG', topic=None, retries=1):
+        """send single message to HMB session (see HmbSession.send_msg)"""
+        msg = self.make_msg(queue, data, mtype=mtype, topic=topic)
+        if self._use_json:
+            msg = {0: msg}
+        await self.send(msg, retries)
+
+    async def send_msgs(self, queue, iterable, mtype='MSG', topic=None, retries=1):
+        """send several payloads to the same queue (see HmbSession.send_msgs)"""
+        return await self.send_many(
+            (self.make_msg(queue, data, mtype=mtype, topic=topic) for data in iterable),
+            retries=retries)
+
+    async def send_many(self, messages, retries=1):
+        """send several messages in batches (see HmbSession.send_many)"""
+        nrequests = 0
+        for body in self._iter_batches(messages):
+            await self._wrap_retry(self._send_body, (body,), retries)
+            nrequests += 1
+        return nrequests
+
+    async def send(self, msg, retries=1):
+        """send message to HMB session. Handles disconnections and retries
+        sending the message. The message should have the correct hmb format.
+        """
+        await self._wrap_retry(self._send_body, (self._encode_one(msg),), retries)
+
+    async def _send_body(self, body):
+        url = self.url + '/send/' + self._sid
+        async with self.get_httpsession().post(
+                url, data=body, headers={"Content-type": self._content_type()},
+                **self._request_kwargs()) as r:
+            self._logger.debug('Send %s with status %s', url, r.status)
+            await _check_response_raise(r)
+
+    async def recv(self, retries=1, keep_heartbeat=False):
+        """receives messages from HMB session (see HmbSession.recv)"""
+        return [msg async for msg in self.iter_recv(retries=retries, keep_heartbeat=keep_heartbeat)]
+
+    async def iter_recv(self, retries=1, keep_heartbeat=False, keep_eof=False):
+        """same as recv but messages are yielded one by one as soon as they
+        are received."""
+        async for msg in self._wrap_retry_iter(self._iter_recv, (), retries):
+            if msg['type'] == 'HEARTBEAT' and not keep_heartbeat:
+                continue
+            if msg['type'] == 'EOF' and not keep_eof:
+                continue
+            yield msg
+
+    async def _iter_recv(self):
+        url = self.url + '/recv/' + self._sid + self._oid
+        async with self.get_httpsession().get(url, **self._request_kwargs()) as r:
+            self._logger.debug('Recv %s with status %s', url, r.status)
+            await _check_response_raise(r)
+
+            if self._use_json:
+                msgdict = await r.json(content_type=None)
+                for i in range(len(msgdict)):
+                    obj = msgdict[str(i)]
+                    self._track_seq(obj)
+                    yield obj
+            else:
+                splitter = BsonStreamSplitter()
+                async for chunk in r.content.iter_chunked(self.recv_chunk_size):
+                    for raw in splitter.feed(chunk):
+                        obj = self._decode_doc(raw)
+                        self._track_seq(obj)
+                        yield obj
+                splitter.close()
+
+    async def recv_all(self, retries=1, timeout=None):
+        """receives all messages from an HMB query (see HmbSession.recv_all)"""
+        return [msg async for msg in self.iter_recv_all(retries=retries, timeout=timeout)]
+
+    async def iter_recv_all(self, retries=1, timeout=None):
+        starttime = time.time() - 0.2
+        while True:
+            async for msg in self.iter_recv(retries=retries, keep_eof=True):
+                if msg['type'] == 'EOF':
+                    return
+                yield msg
+
+            if timeout and time.time() > starttime + timeout:
+                self._close()
+                return
+
+    async def get(self, queue, filter):
+        """gets all messages of queue matching filter (mongodb syntax)"""
+        return [msg async for msg in self.iter_get(queue, filter)]
+
+    async def iter_get(self, queue, filter):
+        self.param['queue'] = {queue: {'seq': 0, 'filter': filter}}
+        await self._open()
+        while True:
+            nmsg = 0
+            async for msg in self._iter_recv():
+                if msg['type'] == 'EOF':
+                    return
+                nmsg += 1
+                if msg['type'] != 'HEARTBEAT':
+                    yield msg
+            if nmsg == 0:
+                return
+
+    async def listen(self, callback=generic_hmb_display, delay=0.1, retries=1, keep_heartbeat=False):
+        """run callback on each message until an error occurs. callback can
+        be a function or a coroutine function."""
+        while True:
+            allmsgs = self.iter_recv(retries=retries, keep_heartbeat=keep_heartbeat)
+            while True:
+                try:
+                    msg = await allmsgs.__anext__()
+                except StopAsyncIteration:
+                    break
+                except Exception:
+                    self._logger.warning('unexpected exit HMB')
+                    return
+
+                res = callback(msg)
+                if inspect.isawaitable(res):
+                    await res
+
+            if delay is not None:
+                await asyncio.sleep(delay)
+
+
+class AsyncEmscHmbListener(EmscHmbListener):
+    """asyncio counterpart of emschmb.EmscHmbListener, listen, get and
+    iter_get are coroutines (or asynchronous generator)."""
+    def _session(self, param):
+        return AsyncHmbSession(
+            self._url, use_bson=True, retry_policy=self.retry_policy,
+            param=param, autocreate_queues=True
+        ).authentication(*self._auth).requests_args(timeout=(6.05, self._heartbeat + 5))
+
+    async def get(self, func, queue, filter):
+        """get message on the queue satisfaying filter conditions, func can be
+        a function or a coroutine function. Returns the list of the results of func."""
+        results = []
+        async for msg in self.iter_get(queue, filter):
+            res = func(msg)
+            if inspect.isawaitable(res):
+                res = await res
+            results.append(res)
+        return results
+
+    async def iter_get(self, queue, filter):
+        hmb = self._session({'heartbeat': self._heartbeat})
+        try:
+            async for m in hmb.iter_get(queue, filter):
+                yield decode_emsc_msg(m, self.spool_dir)
+        finally:
+            await hmb.close()
+
+    async def _replay_chunks(self, func, commit, raw):
+        decode = emsc_envelope if raw else self._decode
+        for full in self._replayed_chunks(raw):
+            res = func(decode(full))
+            if inspect.isawaitable(res):
+                await res
+            if commit:
+                self._commit(full)
+        self._commit_dropped(commit)
+
+    async def listen(self, func, retries=None, commit=True, raw=False):
+        """begin the listener and run func (function or coroutine function)
+        for each message, see EmscHmbListener.listen"""
+        await self._replay_chunks(func, commit, raw)
+
+        hmb = self._session({'heartbeat': self._heartbeat, 'queue': self._queue})
+        hmb.raw_bson = raw
+        decode = emsc_envelope if raw else self._decode
+
+        async def func_closure(msg):
+            res = None
+            done = msg
+            if self._accept(msg):
+                # a chunk is done with the file reassembled (or when dropped)
+                done = self._assemble(msg)
+                if done is not None:
+                    res = func(decode(done))
+                    if inspect.isawaitable(res):
+                        res = await res
+            if commit and done is not None:
+                self._commit(done)
+            self._commit_dropped(commit)
+            return res
+
+        try:
+            await hmb.listen(func_closure, retries=retries, keep_heartbeat=False)
+        finally:
+            await hmb.close()
+            self._flush(commit)
+
+
+class AsyncEmscHmbPublisher(EmscHmbPublisher):
+    """asyncio counterpart of emschmb.EmscHmbPublisher. send, send_file,
+    send_str and send_bin return coroutines and the http session is kept
+    open until close() is awaited.
+
+    await hmb.send_file('QUEUE', 'map.ps')
+    """
+    def __init__(self, agency, url, author=_genericAuthor, codec='zlib', level=None):
+        super(AsyncEmscHmbPublisher, self).__init__(
+            agency, url, author=author, httpsession=True, codec=codec, level=level)
+
+    def _get_session(self):
+        if self._hmb_session is None:
+            self._hmb_session = AsyncHmbSession(self._url, use_bson=True).requests_args(**self._requests_args)
+            if self.auth is not None:
+                self._hmb_session.authentication(*self.auth)
+        return self._hmb_session
+
+    async def _publish(self, msg):
+        await self._get_session().send(msg)
+
+    async def _publish_chunks(self, msgs):
+        for msg in msgs:
+            await self._publish(msg)
+
+    async def close(self):
+        await self._get_session().close()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the aggregation of felt reports before FinDer
+(FeltReportBatch.aggregate): size of the FinDer data_N file and time to build
+it for several cell sizes, against the stability of the solution.
+
+The reports are generated around an event, most of them in a dense city
+cluster, with intensities predicted by Allen et al. (2012) plus noise. The
+solution is the magnitude fitted by least squares to the rows of the data_N
+file (grid search on the Allen et al., 2012 prediction, the rows unweighted
+as FinDer reads them). With --finder-run and --finder-conf, FinDer is run on
+the data_N files and its run time, magnitude and epicenter are reported too.
+
+    python3 bench_aggregate.py --reports 20000 --cells 0,1,2,5,10 --max-points 1000
+"""
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+import numpy
+
+from feltreport import FeltReportBatch, I_Allen2012_Rhypo, haversine
+
+__version__ = '1.0'
+
+_FINDER_MAG = re.compile(r'^Mag = (\S+)', re.M)
+_FINDER_EPICENTER = re.compile(r'^Epicenter = (\S+)/(\S+)', re.M)
+
+
+def generate_event(nreports, evmag=5.5, evdepth=10.0, city=0.7, seed=0):
+    """felt reports of an event at (0, 45): a fraction city of them in a city
+    15 km away, the others spread around"""
+    rng = numpy.random.default_rng(seed)
+    evlon, evlat = 0.0, 45.0
+    ncity = int(nreports * city)
+    lon = numpy.concatenate((rng.normal(evlon + 0.19, 0.03, ncity), rng.normal(evlon, 0.5, nreports - ncity)))
+    lat = numpy.concatenate((rng.normal(evlat, 0.03, ncity), rng.normal(evlat, 0.5, nreports - ncity)))
+    I_sim, _ = I_Allen2012_Rhypo(evmag, evdepth, haversine(evlon, evlat, lon, lat))
+    intensity = numpy.clip(numpy.round(I_sim + rng.normal(0, 0.7, nreports)), 1, 10).astype(numpy.int64)
+    batch = FeltReportBatch(numpy.round(lon, 5), numpy.round(lat, 5), intensity, rng.integers(30, 7200, nreports))
+    return batch, (evlon, evlat, evdepth, evmag)
+
+
+def fit_magnitude(batch, evlon, evlat, evdepth, mags=numpy.arange(3, 8, 0.01)):
+    """magnitude minimizing the squared misfit of the Allen et al. (2012)
+    intensities to the intensities of batch"""
+    distance = haversine(evlon, evlat, batch.lon, batch.lat)
+    misfit = [numpy.mean((batch.intensity - I_Allen2012_Rhypo(m, evdepth, distance)[0])**2) for m in mags]
+    return float(mags[numpy.argmin(misfit)])
+
+
+def run_finder(finder_run, finder_conf, text, evmag):
+    """run time in s, magnitude and epicenter of FinDer on the data_N text"""
+    directory = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(directory, 'data_1'), 'w') as f:
+            f.write(text)
+        config = os.path.join(finder_conf, 'finder_socialmedia_M%s.config' % int(numpy.round(evmag*10)))
+        tick = time.perf_counter()
+        proc = subprocess.run([finder_run, config, directory, '1', '1', 'no'],
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        elapsed = time.perf_counter() - tick
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    mag = _FINDER_MAG.search(proc.stdout)
+    epicenter = _FINDER_EPICENTER.search(proc.stdout)
+    return {
+        'finder_s': elapsed,
+        'finder_mag': float(mag.group(1)) if mag else None,
+        'finder_epicenter': [float(v) for v in epicenter.groups()] if epicenter else None,
+    }
+
+
+def print_results(results, out=sys.stdout):
+    out.write('{0:>8} {1:>8} {2:>8} {3:>10} {4:>10} {5:>8} {6:>8}\n'.format(
+        'reports', 'cell km', 'rows', 'size', 'build ms', 'fit mag', 'delta'))
+    for r in results:
+        out.write('{reports:>8d} {cell_km:>8g} {rows:>8d} {size:>10d} {build_ms:>10.2f} {mag:>8.2f} {delta:>8.2f}'.format(**r))
+        if 'finder_s' in r:
+            out.write(' FinDer {0:.2f} s M{1} {2}'.format(r['finder_s'], r['finder_mag'], r['finder_epicenter']))
+        out.write('\n')
+
+
+if __name__ == '__main__':
+    argd = ArgumentParser(description='felt report aggregation benchmark')
+    argd.add_argument('--reports', help='comma separated list of numbers of reports per event', default='1000,10000,100000')
+    argd.add_argument('--cells', help='comma separated list of cell sizes in km, 0 for no aggregation', default='0,1,2,5,10')
+    argd.add_argument('--max-points', help='maximum number of aggregated rows', type=int)
+    argd.add_argument('-n', help='number of repetitions of each measure', type=int, default=5)
+    argd.add_argument('--finder-run', help='fullpath to finder_run, to run FinDer on the data_N files')
+    argd.add_argument('--finder-conf', help='path to the finder_run config files directory')
+    argd.add_argument('--output', help='write the results as json in this file')
+
+    args = argd.parse_args()
+    if (args.finder_run is None) != (args.finder_conf is None):
+        argd.error('--finder-run and --finder-conf go together')
+
+    results = []
+    for nreports in [int(n) for n in args.reports.split(',')]:
+        batch, (evlon, evlat, evdepth, evmag) = generate_event(nreports)
+        batch.compute_distances(evlon, evlat)
+        realistic = batch.select(batch.realistic_mask(evmag, evdepth))
+        realistic.compute_logpga()
+        reference = None
+        for cell_km in [float(c) for c in args.cells.split(',')]:
+            best = float('inf')
+            for _ in range(args.n):
+                tick = time.perf_counter()
+                if cell_km > 0:
+                    rows = realistic.aggregate(cell_km, args.max_points)[0]
+                else:
+                    rows = realistic
+                text = rows.finder_text()
+                best = min(best, time.perf_counter() - tick)
+            mag = fit_magnitude(rows, evlon, evlat, evdepth)
+            if reference is None:
+                reference = mag
+            result = {
+                'reports': nreports,
+                'cell_km': cell_km,
+                'rows': len(rows),
+                'size': len(text),
+                'build_ms': best * 1e3,
+                'mag': mag,
+                'delta': mag - reference,
+            }
+            if args.finder_run is not None:
+                result.update(run_finder(args.finder_run, args.finder_conf, text, evmag))
+            results.append(result)
+            print_results(results[-1:], out=sys.stderr)
+
+    print_results(results)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'version': __version__, 'results': results}, f, indent=1)
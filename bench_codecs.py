@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the payload compression codecs (hmbcodecs.py): compression
+ratio against compression and decompression speed, on sample payloads.
+
+The default samples are generated: felt report messages (the JSON of
+my_processing.process_message) of several sizes and a PostScript map like
+the FinDer ones. Files can be added with --files. With the zstandard
+library, zstd is also measured with a dictionary trained on felt reports.
+
+    python3 bench_codecs.py --codecs zlib,zstd,lz4 -n 20
+"""
+import json
+import os
+import random
+import sys
+import time
+from argparse import ArgumentParser
+
+from hmbcodecs import ZstdCodec, available_codecs, get_codec, zstandard
+
+__version__ = '1.0'
+
+LEVELS = {
+    'zlib': [1, 6, 9],
+    'zstd': [1, 3, 9, 19],
+    'lz4': [0, 9],
+}
+
+
+def feltreport_json(nreports, seed=0):
+    """felt report message payload with nreports reports"""
+    rng = random.Random(seed)
+    evid = rng.randint(900000, 1800000)
+    evlon, evlat = rng.uniform(-180, 180), rng.uniform(-60, 60)
+    return json.dumps({
+        'evid': evid,
+        'feltreport': {
+            'lon': [round(evlon + rng.gauss(0, 1), 5) for _ in range(nreports)],
+            'lat': [round(evlat + rng.gauss(0, 1), 5) for _ in range(nreports)],
+            'intensity': [rng.randint(1, 8) for _ in range(nreports)],
+            'dt': [float(rng.randint(30, 7200)) for _ in range(nreports)],
+        },
+        'eqinfo': {
+            'evid': evid, 'oritime': '2021-03-11T14:19:40', 'lon': round(evlon, 2), 'lat': round(evlat, 2),
+            'magtype': 'mb', 'mag': 4.5, 'depth': 4.0, 'region': 'GREECE', 'net34': 'INFO', 'score': 95,
+            'eqtxt': 'M4.5 in GREECE\n2021/03/11 14:19:40 UTC',
+        },
+    }).encode('utf-8')
+
+
+def postscript(nlines, seed=0):
+    """PostScript like payload, as the maps drawn by GMT"""
+    rng = random.Random(seed)
+    lines = ['%!PS-Adobe-3.0', '%%Creator: GMT5', '%%BoundingBox: 0 0 612 792']
+    for i in range(nlines):
+        op = rng.choice(('M', 'D', 'S', 'N', 'P'))
+        lines.append('%d %d %s' % (rng.randint(-2000, 2000), rng.randint(-2000, 2000), op))
+        if i % 50 == 0:
+            lines.append('0 0 0 C 4 W /Helvetica F (%.2f) Z' % rng.uniform(0, 10))
+    lines.append('%%EOF')
+    return '\n'.join(lines).encode('ascii')
+
+
+def samples():
+    return [
+        ('feltreport_100', feltreport_json(100)),
+        ('feltreport_10k', feltreport_json(10000)),
+        ('postscript', postscript(200000)),
+    ]
+
+
+def train_feltreport_dict(size=16 * 1024):
+    return zstandard.train_dictionary(size, [feltreport_json(random.randint(5, 50), seed=i) for i in range(500)]).as_bytes()
+
+
+def measure(codec, level, data, n):
+    """ratio, compression and decompression speeds in MB/s"""
+    tick = time.perf_counter()
+    for _ in range(n):
+        blob = codec.compress(data, level)
+    tcomp = (time.perf_counter() - tick) / n
+    tick = time.perf_counter()
+    for _ in range(n):
+        out = codec.decompress(blob)
+    tdecomp = (time.perf_counter() - tick) / n
+    if out != data:
+        raise ValueError('%s level %s: decompressed data differs' % (codec.name, level))
+    mb = len(data) / 1e6
+    return {
+        'codec': codec.name,
+        'level': level,
+        'size': len(data),
+        'ratio': len(data) / float(len(blob)),
+        'compress_mb_s': mb / tcomp if tcomp > 0 else float('nan'),
+        'decompress_mb_s': mb / tdecomp if tdecomp > 0 else float('nan'),
+    }
+
+
+def print_results(results, out=sys.stdout):
+    out.write('{0:16} {1:18} {2:>6} {3:>10} {4:>8} {5:>10} {6:>10}\n'.format(
+        'sample', 'codec', 'level', 'size', 'ratio', 'comp MB/s', 'dec MB/s'))
+    for r in results:
+        out.write('{sample:16} {codec:18} {level:>6} {size:>10d} {ratio:>8.2f} '
+                  '{compress_mb_s:>10.1f} {decompress_mb_s:>10.1f}\n'.format(**r))
+
+
+if __name__ == '__main__':
+    argd = ArgumentParser(description='compression codecs benchmark')
+    argd.add_argument('--codecs', help='comma separated list of codecs, default all the installed ones')
+    argd.add_argument('--levels', help='levels of a codec, e.g. zstd=1,3,19 (can be repeated)', action='append', default=[])
+    argd.add_argument('--files', help='comma separated list of files to use as samples too')
+    argd.add_argument('-n', help='number of repetitions of each measure', type=int, default=10)
+    argd.add_argument('--output', help='write the results as json in this file')
+
+    args = argd.parse_args()
+
+    codecs = args.codecs.split(',') if args.codecs else available_codecs()
+    levels = dict(LEVELS)
+    for lv in args.levels:
+        name, _, values = lv.partition('=')
+        levels[name] = [int(v) for v in values.split(',')]
+
+    data = samples()
+    if args.files:
+        for filename in args.files.split(','):
+            with open(filename, 'rb') as f:
+                data.append((os.path.basename(filename), f.read()))
+
+    variants = []
+    for name in codecs:
+        try:
+            codec = get_codec(name)
+        except (ValueError, ImportError) as e:
+            argd.error(str(e))
+        variants.extend((codec, level) for level in levels.get(name, [codec.default_level]))
+    if 'zstd' in codecs:
+        codec = ZstdCodec('zstd-feltreport', dict_data=train_feltreport_dict())
+        variants.extend((codec, level) for level in levels['zstd'])
+
+    results = []
+    for sample, payload in data:
+        for codec, level in variants:
+            # the dictionary is trained for felt reports only
+            if getattr(codec, 'dict_data', None) is not None and not sample.startswith('feltreport'):
+                continue
+            r = measure(codec, level, payload, args.n)
+            r['sample'] = sample
+            results.append(r)
+            print_results(results[-1:], out=sys.stderr)
+
+    print_results(results)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'version': __version__, 'results': results}, f, indent=1)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the decoding of felt report messages (feltreport.py): parse
+time and peak memory of json.loads into python lists (as process_message did
+before), followed by the conversion to numpy arrays, with json and orjson
+(if installed), against loads_feltreport which parses the columns straight
+into numpy arrays.
+
+The payloads are generated felt report messages (see bench_codecs.py).
+
+    python3 bench_feltreport.py --reports 1000,100000 -n 5
+"""
+import gc
+import json
+import sys
+import time
+import tracemalloc
+from argparse import ArgumentParser
+
+import numpy
+
+from bench_codecs import feltreport_json
+from feltreport import loads_feltreport, orjson
+
+__version__ = '1.0'
+
+
+def json_lists(text):
+    return json.loads(text)
+
+
+def json_arrays(text):
+    data = json.loads(text)
+    data['feltreport'] = dict((k, numpy.asarray(v)) for k, v in data['feltreport'].items())
+    return data
+
+
+def orjson_arrays(text):
+    data = orjson.loads(text)
+    data['feltreport'] = dict((k, numpy.asarray(v)) for k, v in data['feltreport'].items())
+    return data
+
+
+def decoders():
+    res = [('json (lists)', json_lists), ('json + numpy', json_arrays)]
+    if orjson is not None:
+        res.append(('orjson + numpy', orjson_arrays))
+    res.append(('loads_feltreport', loads_feltreport))
+    return res
+
+
+def measure(func, text, n):
+    """best parse time in s over n runs and peak memory in bytes"""
+    best = float('inf')
+    for _ in range(n):
+        gc.collect()
+        tick = time.perf_counter()
+        data = func(text)
+        best = min(best, time.perf_counter() - tick)
+        del data
+    gc.collect()
+    tracemalloc.start()
+    data = func(text)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del data
+    return best, peak
+
+
+def print_results(results, out=sys.stdout):
+    out.write('{0:>8} {1:>10} {2:18} {3:>10} {4:>10} {5:>8}\n'.format(
+        'reports', 'size', 'decoder', 'time ms', 'peak MB', 'speedup'))
+    for r in results:
+        out.write('{reports:>8d} {size:>10d} {decoder:18} {time_ms:>10.2f} {peak_mb:>10.1f} {speedup:>8.1f}\n'.format(**r))
+
+
+if __name__ == '__main__':
+    argd = ArgumentParser(description='felt report decoding benchmark')
+    argd.add_argument('--reports', help='comma separated list of numbers of reports per message', default='1000,10000,100000')
+    argd.add_argument('-n', help='number of repetitions of each measure', type=int, default=5)
+    argd.add_argument('--output', help='write the results as json in this file')
+
+    args = argd.parse_args()
+
+    results = []
+    for nreports in [int(n) for n in args.reports.split(',')]:
+        text = feltreport_json(nreports).decode('utf-8')
+        reference = None
+        for name, func in decoders():
+            best, peak = measure(func, text, args.n)
+            if reference is None:
+                reference = best
+            results.append({
+                'reports': nreports,
+                'size': len(text),
+                'decoder': name,
+                'time_ms': best * 1e3,
+                'peak_mb': peak / 1e6,
+                'speedup': reference / best if best > 0 else float('nan'),
+            })
+            print_results(results[-1:], out=sys.stderr)
+
+    print_results(results)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'version': __version__, 'results': results}, f, indent=1)
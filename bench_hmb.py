@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of the hmb transport (hmbsession.py, emschmb.py) against the
+local stand-in server of hmbserver.py, or against a real server with --url.
+
+For each scenario and payload size it reports the throughput (msgs/s) and
+the p50/p99 latency in ms:
+    send       one HmbSession.send_msg per message
+    send_many  HmbSession.send_msgs by batches of --batch messages
+    publish    EmscHmbPublisher.send_bin, closing the http session after each message
+    publish_bg EmscHmbBackgroundPublisher.send_bin, latency up to the delivery
+    recv       live listener, latency from send to reception
+    backfill   HmbSession.iter_recv_all of a filled queue, latency from the request
+    replay     HmbSession.iter_get of a filled queue, latency from the request
+
+    python3 bench_hmb.py --sizes 100,10000,1000000 -n 200
+"""
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+from argparse import ArgumentParser
+
+from hmbsession import HmbSession
+from hmbserver import HmbServerThread
+from emschmb import EmscHmbPublisher, EmscHmbBackgroundPublisher
+
+__version__ = '1.0'
+
+SCENARIOS = ('send', 'send_many', 'publish', 'publish_bg', 'recv', 'backfill', 'replay')
+
+
+def percentile(values, q):
+    """q-th percentile (0-100) of values, nearest rank"""
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    k = max(0, min(len(values) - 1, int(round(q / 100. * len(values) + 0.5)) - 1))
+    return values[k]
+
+
+class Bench(object):
+    def __init__(self, url, use_bson=True, batch=100):
+        self.url = url
+        self.use_bson = use_bson
+        self.batch = batch
+
+    def _queue(self, name):
+        # new queue for each run so that runs are independent
+        return '%s_%s' % (name.upper(), uuid.uuid4().hex[:8])
+
+    def _payload(self, size):
+        return os.urandom(size) if self.use_bson else 'x' * size
+
+    def _session(self, param=None):
+        return HmbSession(self.url, param=param, use_bson=self.use_bson)
+
+    def _fill(self, queue, n, size):
+        hmb = self._session()
+        payload = self._payload(size)
+        hmb.send_msgs(queue, ({'i': i, 'payload': payload} for i in range(n)))
+        hmb.close()
+
+    def send(self, n, size):
+        hmb = self._session()
+        queue = self._queue('send')
+        payload = self._payload(size)
+        lat = []
+        for i in range(n):
+            tick = time.perf_counter()
+            hmb.send_msg(queue, {'i': i, 'payload': payload})
+            lat.append(time.perf_counter() - tick)
+        hmb.close()
+        return n, sum(lat), lat
+
+    def send_many(self, n, size):
+        hmb = self._session()
+        hmb.max_batch_count = self.batch
+        queue = self._queue('send_many')
+        payload = self._payload(size)
+        lat = []
+        for start in range(0, n, self.batch):
+            tick = time.perf_counter()
+            hmb.send_msgs(queue, ({'i': i, 'payload': payload}
+                                  for i in range(start, min(n, start + self.batch))))
+            lat.append(time.perf_counter() - tick)
+        hmb.close()
+        return n, sum(lat), lat
+
+    def publish(self, n, size):
+        hmb = EmscHmbPublisher('BENCH', self.url)
+        queue = self._queue('publish')
+        payload = os.urandom(size)
+        lat = []
+        for i in range(n):
+            tick = time.perf_counter()
+            hmb.send_bin(queue, payload, compress=False)
+            lat.append(time.perf_counter() - tick)
+        return n, sum(lat), lat
+
+    def publish_bg(self, n, size):
+        hmb = EmscHmbBackgroundPublisher('BENCH', self.url, batch_count=self.batch)
+        queue = self._queue('publish_bg')
+        payload = os.urandom(size)
+        lat = []
+
+        def done(tick):
+            return lambda future: lat.append(time.perf_counter() - tick)
+
+        start = time.perf_counter()
+        for i in range(n):
+            hmb.send_bin(queue, payload, compress=False).add_done_callback(done(time.perf_counter()))
+        hmb.close()
+        return n, time.perf_counter() - start, lat
+
+    def recv(self, n, size):
+        queue = self._queue('recv')
+        # creates the queue before listening
+        self._session().send_msg(queue, {'i': -1})
+        listener = self._session({'heartbeat': 5, 'queue': {queue: {'seq': -1, 'keep': True}}})
+        lat = []
+        ready = threading.Event()
+
+        def listen():
+            ready.set()
+            while len(lat) < n:
+                for msg in listener.iter_recv():
+                    lat.append(time.time() - msg['data']['t0'])
+                    if len(lat) >= n:
+                        break
+            listener.close()
+
+        thread = threading.Thread(target=listen)
+        thread.start()
+        ready.wait()
+        time.sleep(0.2)
+
+        hmb = self._session()
+        payload = self._payload(size)
+        start = time.perf_counter()
+        for i in range(n):
+            hmb.send_msg(queue, {'i': i, 't0': time.time(), 'payload': payload})
+        thread.join()
+        hmb.close()
+        return n, time.perf_counter() - start, lat
+
+    def backfill(self, n, size):
+        queue = self._queue('backfill')
+        self._fill(queue, n, size)
+        hmb = self._session({'heartbeat': 5, 'recv_limit': 1000, 'queue': {queue: {'seq': -n - 1}}})
+        lat = []
+        start = time.perf_counter()
+        for msg in hmb.iter_recv_all():
+            lat.append(time.perf_counter() - start)
+        hmb.close()
+        return len(lat), time.perf_counter() - start, lat
+
+    def replay(self, n, size):
+        queue = self._queue('replay')
+        self._fill(queue, n, size)
+        hmb = self._session({'heartbeat': 5, 'recv_limit': 1000})
+        lat = []
+        start = time.perf_counter()
+        for msg in hmb.iter_get(queue, {'data.i': {'$gte': 0}}):
+            lat.append(time.perf_counter() - start)
+        hmb.close()
+        return len(lat), time.perf_counter() - start, lat
+
+    def run(self, scenario, n, size):
+        nmsg, elapsed, lat = getattr(self, scenario)(n, size)
+        return {
+            'scenario': scenario,
+            'size': size,
+            'n': nmsg,
+            'msgs_per_s': nmsg / elapsed if elapsed > 0 else float('nan'),
+            'p50_ms': percentile(lat, 50) * 1000,
+            'p99_ms': percentile(lat, 99) * 1000,
+        }
+
+
+def print_results(results, out=sys.stdout):
+    out.write('{0:12} {1:>10} {2:>7} {3:>12} {4:>10} {5:>10}\n'.format(
+        'scenario', 'size', 'n', 'msgs/s', 'p50 ms', 'p99 ms'))
+    for r in results:
+        out.write('{scenario:12} {size:>10d} {n:>7d} {msgs_per_s:>12.1f} {p50_ms:>10.2f} {p99_ms:>10.2f}\n'.format(**r))
+
+
+if __name__ == '__main__':
+    argd = ArgumentParser(description='hmb transport benchmarks')
+    argd.add_argument('--url', help='hmb url (server and bus name), default is a local stand-in server')
+    argd.add_argument('--scenarios', help='comma separated list of scenarios', default=','.join(SCENARIOS))
+    argd.add_argument('--sizes', help='comma separated list of payload sizes in bytes', default='100,10000,1000000')
+    argd.add_argument('-n', help='number of messages per run', type=int, default=200)
+    argd.add_argument('--batch', help='batch size of send_many and publish_bg', type=int, default=100)
+    argd.add_argument('--json', help='use json instead of bson messages', action='store_true')
+    argd.add_argument('--output', help='write the results as json in this file')
+    argd.add_argument('-v', '--verbose', action='store_true')
+
+    args = argd.parse_args()
+
+    logging.basicConfig(
+        stream=sys.stderr, level=logging.DEBUG if args.verbose else logging.WARNING,
+        format='%(asctime)s:%(levelname)s:%(name)s:%(message)s')
+
+    scenarios = args.scenarios.split(',')
+    for s in scenarios:
+        if s not in SCENARIOS:
+            argd.error('unknown scenario %s' % s)
+
+    server = None
+    url = args.url
+    if url is None:
+        server = HmbServerThread().start()
+        url = server.url + '/BENCH'
+
+    bench = Bench(url, use_bson=not args.json, batch=args.batch)
+    results = []
+    for size in [int(s) for s in args.sizes.split(',')]:
+        for scenario in scenarios:
+            if args.json and scenario in ('publish', 'publish_bg'):
+                continue
+            results.append(bench.run(scenario, args.n, size))
+            print_results(results[-1:], out=sys.stderr)
+
+    print_results(results)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'version': __version__, 'url': url, 'results': results}, f, indent=1)
+
+    if server is not None:
+        server.stop()
@@ -1,32 +1,28 @@
 import sys
 import os
-from zlib import compress, decompress
 import datetime
+import logging
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+import queue as _queue
+from collections.abc import MutableMapping
 
+import bson
+from bson.raw_bson import RawBSONDocument
 
-from hmbsession import HmbSession
+
+from hmbsession import HmbSession, RetryPolicy
+from hmbcodecs import codec_fields, get_codec, payload_codec
+from hmbchunks import CHUNK_SIZE, iter_chunks
+from hmbfilter import MessageFilter
 
 __version__ = "1.0"
 
 _genericAuthor = '.'.join((os.path.basename(__file__), __version__))
 
 
-def _compress_bin(o):
-    return compress(o)
-
-
-def _decompress_bin(o):
-    return decompress(o)
-
-
-def _compress_txt(o, encoding='utf-8'):
-    return _compress_bin(o.encode(encoding))
-
-
-def _decompress_txt(o, encoding='utf-8'):
-    return _decompress_bin(o).decode(encoding)
-
-
 def load_hmbcfg(filename):
     """load a simple config file. the file is formated as some key = val. Comments are lines that starts with a '#'
 
@@ -73,20 +69,27 @@ class EmscHmbPublisher(object):
 
     hmb.send_file : to send file
 
+    hmb.send_file_chunked : to send a large file in several messages
+
     hmb.send_str : to send text
 
     hmb.send_bin : to send byte data
 
     hmb.send : to send general python object with common types (dict, int, float, list, byte, str)
     """
-    def __init__(self, agency, url, author=_genericAuthor, httpsession=False):
+    def __init__(self, agency, url, author=_genericAuthor, httpsession=False, codec='zlib', level=None):
         """
         Args:
             agency (str): name of the agency to identify the message
             url (str): full url of the hmt server
             author (str, optional): name of the author. May be usefull to identify the publisher. Defaults to _genericAuthor.
             httpsession (bool, optional): If True don't close the http session after a send. Defaults to False.
+            codec (str, optional): compression codec of the payloads (see hmbcodecs.py). Defaults to 'zlib'.
+            level (int, optional): compression level. Defaults to the default level of the codec.
         """
+        get_codec(codec)
+        self.codec = codec
+        self.level = level
         self._use_persistent_httpsession = httpsession
         self._url = url
         self.author = author
@@ -150,7 +153,7 @@ class EmscHmbPublisher(object):
         self._url = url
         return self
 
-    def send(self, queue, data, metadata=None):
+    def send(self, queue, data, metadata=None, topic=None):
         """Send a python object with basic types to the queue
         (dict, list, int, float, bool, byte, str)
         add some metadata to the message to avoid the decoding a the whole message to get basic information.
@@ -159,140 +162,455 @@ class EmscHmbPublisher(object):
             queue (str): queue to send the message
             data (python types): python object to send
             metadata (dict, optional): metadata of the message. Allow additional information to access some data easily. Defaults to None.
+            topic (str, optional): topic of the message, listeners can receive only some topics. Defaults to None.
         """
+        return self._publish(self._make_msg(queue, data, metadata, topic))
+
+    def _make_msg(self, queue, data, metadata=None, topic=None):
         data['_header'] = self._header(metadata=metadata)
-        self._get_session().send_msg(queue, data, mtype='EMSC_MSG')
+        return HmbSession.make_msg(queue, data, mtype='EMSC_MSG', topic=topic)
+
+    def _publish(self, msg):
+        self._get_session().send(msg)
         if not self._use_persistent_httpsession:
             self.close()
 
-    def send_file(self, queue, filename, compress=True, metadata=None):
+    def _publish_chunks(self, msgs):
+        # the http session is kept open during the transfer
+        persistent, self._use_persistent_httpsession = self._use_persistent_httpsession, True
+        try:
+            for msg in msgs:
+                self._publish(msg)
+        finally:
+            self._use_persistent_httpsession = persistent
+            if not persistent:
+                self.close()
+
+    def _codec(self, codec, level):
+        # (codec, level) of a send, defaulting to the publisher ones
+        if codec is None:
+            codec, level = self.codec, self.level if level is None else level
+        codec = get_codec(codec)
+        return codec, codec.default_level if level is None else level
+
+    def _compress(self, msg, content, compress, codec, level):
+        # compresses content in msg with codec (default: the publisher one)
+        if not compress:
+            msg.update(codec_fields(None))
+            msg['content'] = content
+            return msg
+        codec, level = self._codec(codec, level)
+        msg.update(codec_fields(codec, level))
+        msg['content'] = codec.compress(content, level)
+        return msg
+
+    def send_file(self, queue, filename, compress=True, metadata=None, codec=None, level=None, topic=None):
         """Send the content of a file.
 
         Args:
             queue (str: queue to send the message
             filename (str): filename of the file to send
-            compress (bool, optional): if True use zlib compression. Defaults to True.
+            compress (bool, optional): if True the content is compressed. Defaults to True.
             metadata (dict, optional): metadata of the message. Allow additional information to access some data easily. Defaults to None.
+            codec (str, optional): compression codec. Defaults to the codec of the publisher.
+            level (int, optional): compression level. Defaults to the level of the publisher.
+            topic (str, optional): topic of the message. Defaults to None.
         """
         msg = {
             '_type': 'FILE',
             'file': os.path.basename(os.path.abspath(filename)),
-            'zlib': compress
         }
 
         with open(filename, 'rb') as f:
             content = f.read()
 
-        if compress:
-            content = _compress_bin(content)
-        msg['content'] = content
+        return self.send(queue, self._compress(msg, content, compress, codec, level), metadata=metadata, topic=topic)
+
+    def send_file_chunked(self, queue, filename, chunk_size=CHUNK_SIZE, compress=True, metadata=None, codec=None, level=None, topic=None):
+        """Send a large file as a sequence of CHUNK messages (see hmbchunks.py),
+        reassembled by the listeners with a ChunkAssembler. The file is memory
+        mapped and compressed as a stream, only a few chunks are in memory.
 
-        self.send(queue, msg, metadata=metadata)
+        Args:
+            queue (str): queue to send the messages
+            filename (str): filename of the file to send
+            chunk_size (int, optional): size of the (compressed) content of a message. Defaults to 1 MB.
+            compress (bool, optional): if True the content is compressed. Defaults to True.
+            metadata (dict, optional): metadata of the message, sent with each chunk. Defaults to None.
+            codec (str, optional): compression codec. Defaults to the codec of the publisher.
+            level (int, optional): compression level. Defaults to the level of the publisher.
+            topic (str, optional): topic of the message. Defaults to None.
+        """
+        codec, level = self._codec(codec, level) if compress else (None, None)
 
-    def send_str(self, queue, txt, encoding='utf-8', compress=True, metadata=None):
+        def msgs():
+            for chunk in iter_chunks(filename, chunk_size, codec, level):
+                yield self._make_msg(queue, chunk, metadata, topic)
+
+        return self._publish_chunks(msgs())
+
+    def send_str(self, queue, txt, encoding='utf-8', compress=True, metadata=None, codec=None, level=None, topic=None):
         """Send txt.
 
         Args:
             queue (str): queue to send the message
             txt (str): txt to send
             encoding (str, optional): encoding of the txt. Used if compress is true. Defaults to 'utf-8'.
-            compress (bool, optional): if True use zlib compression. Defaults to True.
+            compress (bool, optional): if True the txt is compressed. Defaults to True.
             metadata (dict, optional): metadata of the message. Allow additional information to access some data easily. Defaults to None.
+            codec (str, optional): compression codec. Defaults to the codec of the publisher.
+            level (int, optional): compression level. Defaults to the level of the publisher.
+            topic (str, optional): topic of the message. Defaults to None.
         """
         msg = {
             '_type': 'STR',
             'encoding': encoding,
-            'zlib': compress
         }
-        if compress:
-            content = _compress_txt(txt, encoding=encoding)
-        else:
-            content = txt
-        msg['content'] = content
-        self.send(queue, msg, metadata=metadata)
+        content = txt.encode(encoding) if compress else txt
+        return self.send(queue, self._compress(msg, content, compress, codec, level), metadata=metadata, topic=topic)
 
-    def send_bin(self, queue, bin, compress=True, metadata=None):
+    def send_bin(self, queue, bin, compress=True, metadata=None, codec=None, level=None, topic=None):
         """Send bytes
 
         Args:
             queue (str): queue to send the message
             bin (byte): binary data to send
-            compress (bool, optional): if True use zlib compression. Defaults to True.
+            compress (bool, optional): if True the data is compressed. Defaults to True.
             metadata (dict, optional): metadata of the message. Allow additional information to access some data easily. Defaults to None.
+            codec (str, optional): compression codec. Defaults to the codec of the publisher.
+            level (int, optional): compression level. Defaults to the level of the publisher.
+            topic (str, optional): topic of the message. Defaults to None.
         """
         msg = {
             '_type': 'BIN',
-            'zlib': compress
         }
-        if compress:
-            content = _compress_bin(bin)
-        else:
-            content = bin
-        msg['content'] = content
-        self.send(queue, msg, metadata=metadata)
+        return self.send(queue, self._compress(msg, bin, compress, codec, level), metadata=metadata, topic=topic)
 
     def close(self):
         self._get_session().close()
 
 
-def _decode_file(msg):
-    compress = msg.get('zlib', False)
-    raw = msg.get('content', b'')
-    return {
-        'filename': msg.get('file', 'tmp.hmb'),
-        'content': _decompress_bin(raw) if compress else raw
-    }
+_STOP = object()
 
 
-def _decode_zstr(msg):
-    return _decompress_txt(msg.get('content', b''), encoding=msg.get('encoding', 'utf-8'))
+def _gather(futures):
+    # future resolved when all futures are, with the first exception
+    done = Future()
+    remaining = [len(futures)]
+    lock = threading.Lock()
 
+    def callback(future):
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if future.exception() is not None and not done.done():
+            try:
+                done.set_exception(future.exception())
+            except Exception:
+                # already resolved by another callback
+                pass
+        if last and not done.done():
+            done.set_result(None)
 
-def decode_emsc_msg(rawmsg):
-    if rawmsg['type'] != 'EMSC_MSG' or 'data' not in rawmsg:
-        return {}
+    if not futures:
+        done.set_result(None)
+    for future in futures:
+        future.add_done_callback(callback)
+    return done
+
+
+class EmscHmbBackgroundPublisher(EmscHmbPublisher):
+    """EmscHmbPublisher sending messages from a background thread.
+
+    send, send_file, send_str and send_bin only put the message in a bounded
+    queue and return a concurrent.futures.Future resolved once the message is
+    delivered. The thread gathers queued messages until batch_count messages
+    are waiting or linger seconds elapsed, and sends them in a single request
+    over one persistent http session.
+
+    hmb = EmscHmbBackgroundPublisher('EMSC', 'http://cerf.emsc-csem.org:hmbtest').authentication('user', 'password')
+
+    future = hmb.send_file('QUEUE', 'map.ps')
+
+    hmb.close() : to wait for pending messages and stop the thread
+    """
+    def __init__(self, agency, url, author=_genericAuthor, maxsize=1000,
+                 linger=0.05, batch_count=100, retries=1, codec='zlib', level=None):
+        """
+        Args:
+            agency (str): name of the agency to identify the message
+            url (str): full url of the hmt server
+            author (str, optional): name of the author. Defaults to _genericAuthor.
+            maxsize (int, optional): maximum number of messages waiting to be sent, send blocks beyond. Defaults to 1000.
+            linger (float, optional): maximum delay in s to wait for more messages before sending a batch. Defaults to 0.05.
+            batch_count (int, optional): number of waiting messages triggering a send. Defaults to 100.
+            retries (int, optional): number of retries when sending a batch failed. Defaults to 1.
+            codec (str, optional): compression codec of the payloads. Defaults to 'zlib'.
+            level (int, optional): compression level. Defaults to the default level of the codec.
+        """
+        super(EmscHmbBackgroundPublisher, self).__init__(
+            agency, url, author=author, httpsession=True, codec=codec, level=level)
+        self._logger = logging.getLogger(__name__)
+        self._pending = _queue.Queue(maxsize)
+        self._linger = linger
+        self._batch_count = batch_count
+        self._retries = retries
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _publish(self, msg):
+        future = Future()
+        self._start()
+        self._pending.put((msg, future))
+        return future
+
+    def _publish_chunks(self, msgs, window=8):
+        # pipelined: the next chunks are compressed while the previous ones are
+        # sent, at most window chunks waiting
+        futures = []
+        for msg in msgs:
+            if len(futures) >= window:
+                futures[-window].exception()
+            futures.append(self._publish(msg))
+        return _gather(futures)
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(name='hmbpublisher', target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _next_batch(self):
+        """blocks until a message is available then gathers messages until
+        the batch is full or the linger delay expired"""
+        batch = [self._pending.get()]
+        deadline = time.time() + self._linger
+        while batch[-1] is not _STOP and len(batch) < self._batch_count:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._pending.get(timeout=timeout))
+            except _queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch = self._next_batch()
+            if batch[-1] is _STOP:
+                stop = True
+                batch.pop()
+            try:
+                if batch:
+                    self._send_batch(batch)
+            finally:
+                for _ in range(len(batch) + stop):
+                    self._pending.task_done()
+
+    def _send_batch(self, batch):
+        try:
+            self._get_session().send_many([msg for msg, _ in batch], retries=self._retries)
+        except Exception as e:
+            self._logger.error('Unable to send %d message(s): %s', len(batch), str(e))
+            for _, future in batch:
+                future.set_exception(e)
+        else:
+            self._logger.debug('Sent %d message(s)', len(batch))
+            for _, future in batch:
+                future.set_result(None)
+
+    def flush(self):
+        """wait until all queued messages are sent (or failed)"""
+        if self._thread is not None:
+            self._pending.join()
+
+    def close(self):
+        """send pending messages, stop the background thread and close the http session"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._pending.put(_STOP)
+            thread.join()
+        super(EmscHmbBackgroundPublisher, self).close()
+
+
+def _decompress(msg, raw):
+    codec = payload_codec(msg)
+    return codec.decompress(raw) if codec is not None else raw
+
+
+def _spool_file(msg, spool_dir):
+    # decompresses the content of the FILE msg to a new file of spool_dir,
+    # a block at a time
+    filename = msg.get('file', 'tmp.hmb')
+    os.makedirs(spool_dir, exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix='_' + os.path.basename(filename), dir=spool_dir)
+    content = msg.get('content', b'')
+    codec = payload_codec(msg)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for block in codec.iter_decompress([content]) if codec is not None else [content]:
+                f.write(block)
+    except BaseException:
+        os.remove(path)
+        raise
+    return {
+        'filename': filename,
+        'path': path
+    }
 
-    msg = rawmsg['data']
-    header = msg.pop('_header', {}).copy()
 
-    metadata = header.pop('metadata', {})
+def _decode_file(msg, spool_dir=None):
+    if spool_dir is not None and 'path' not in msg:
+        return _spool_file(msg, spool_dir)
+    if 'path' in msg:
+        # reassembled from chunks, already on disk
+        return {
+            'filename': msg.get('file', 'tmp.hmb'),
+            'path': msg['path']
+        }
+    return {
+        'filename': msg.get('file', 'tmp.hmb'),
+        'content': _decompress(msg, msg.get('content', b''))
+    }
 
-    res_msg = header
-    res_msg['metadata'] = metadata
 
+def _decode_payload(msg, spool_dir=None):
     msgtype = msg.get('_type', '')
 
     if msgtype == 'FILE':
-        compress = msg.get('zlib', False)
-        raw = msg.get('content', b'')
-        content = {
-            'file': msg.get('file', 'tmp.hmb'),
-            'content': _decompress_bin(raw) if compress else raw
-        }
-        content = _decode_file(msg)
-    elif msgtype == 'STR':
+        return _decode_file(msg, spool_dir)
+    if msgtype == 'STR':
         raw = msg.get('content', '')
-        compress = msg.get('zlib', False)
-        encoding = msg.get('encoding', 'utf-8')
-        if isinstance(raw, bytes):
-            if compress:
-                content = _decompress_txt(raw, encoding=encoding)
-            else:
-                content = raw
-        else:
-            content = raw
-    elif msgtype == 'BIN':
-        raw = msg.get('content', b'')
-        compress = msg.get('zlib', False)
-        if compress:
-            content = _decompress_bin(raw)
-        else:
-            content = raw
+        if isinstance(raw, bytes) and payload_codec(msg) is not None:
+            return _decompress(msg, raw).decode(msg.get('encoding', 'utf-8'))
+        return raw
+    if msgtype == 'BIN':
+        return _decompress(msg, msg.get('content', b''))
+    return msg
+
+
+# _payload of an EmscMessage without payload left to decode (decoded, or
+# built from a decoded dict)
+_NO_PAYLOAD = object()
+
+
+class EmscMessage(MutableMapping):
+    """Decoded EMSC message, used as a dict: the header fields, 'metadata',
+    'queue', 'seq' and 'data'. The header is available at once, the payload
+    is decoded (and decompressed) at the first access to 'data' and the
+    result is kept. A message pickled before the access to 'data' keeps its
+    payload compressed. With spool_dir, the content of a FILE message is
+    decompressed to a file of spool_dir and 'data' has its 'path' instead of
+    its 'content'."""
+    __slots__ = ('_fields', '_payload', '_spool_dir')
+
+    def __init__(self, fields, payload=_NO_PAYLOAD, spool_dir=None):
+        self._fields = fields
+        self._payload = payload
+        self._spool_dir = spool_dir
+
+    @property
+    def decoded(self):
+        """True if the payload is decoded"""
+        return self._payload is _NO_PAYLOAD
+
+    def _decode(self):
+        if self._payload is not _NO_PAYLOAD:
+            self._fields['data'] = _decode_payload(self._payload, self._spool_dir)
+            self._payload = _NO_PAYLOAD
+
+    def __getitem__(self, key):
+        if key == 'data':
+            self._decode()
+        return self._fields[key]
+
+    def __setitem__(self, key, value):
+        if key == 'data':
+            self._payload = _NO_PAYLOAD
+        self._fields[key] = value
+
+    def __delitem__(self, key):
+        if key == 'data' and self._payload is not _NO_PAYLOAD:
+            self._payload = _NO_PAYLOAD
+            self._fields.pop('data', None)
+            return
+        del self._fields[key]
+
+    def __contains__(self, key):
+        return key in self._fields or (key == 'data' and self._payload is not _NO_PAYLOAD)
+
+    def __iter__(self):
+        for key in self._fields:
+            yield key
+        if self._payload is not _NO_PAYLOAD and 'data' not in self._fields:
+            yield 'data'
+
+    def __len__(self):
+        return len(self._fields) + (self._payload is not _NO_PAYLOAD and 'data' not in self._fields)
+
+    def __reduce__(self):
+        if self._payload is _NO_PAYLOAD:
+            return self.__class__, (self._fields,)
+        return self.__class__, (self._fields, self._payload, self._spool_dir)
+
+    def __repr__(self):
+        fields = dict(self._fields)
+        if self._payload is not _NO_PAYLOAD:
+            fields['data'] = '<not decoded>'
+        return '%s(%r)' % (self.__class__.__name__, fields)
+
+    def copy(self):
+        return self.__class__(dict(self._fields), self._payload, self._spool_dir)
+
+
+def decode_emsc_msg(rawmsg, spool_dir=None):
+    """decodes a hmb message of type EMSC_MSG in an EmscMessage, the payload
+    being decoded only when 'data' is read, FILE contents to a file of
+    spool_dir if given. Returns {} for other messages."""
+    if rawmsg['type'] != 'EMSC_MSG' or 'data' not in rawmsg:
+        return {}
+
+    msg = rawmsg['data']
+    fields = dict(msg.get('_header', {}))
+    fields['metadata'] = fields.get('metadata', {})
+    # position of the message on the hmb bus (and of its chunks)
+    for k in ('queue', 'seq', 'chunks'):
+        if k in rawmsg:
+            fields[k] = rawmsg[k]
+
+    return EmscMessage(fields, dict((k, v) for k, v in msg.items() if k != '_header'), spool_dir)
+
+
+def emsc_envelope(rawmsg):
+    """envelope of a hmb message, to hand it to another process without
+    decoding nor decompressing its payload: a dict with the queue, seq and
+    type of the message, the metadata of the EMSC header and the BSON bytes
+    of the message in 'raw'. rawmsg is preferably a RawBSONDocument (see
+    HmbSession.raw_bson), whose payload is then never decoded."""
+    if isinstance(rawmsg, RawBSONDocument):
+        raw = rawmsg.raw
     else:
-        content = msg
-    res_msg['data'] = content
+        raw = bson.BSON.encode(rawmsg)
+    envelope = {'type': rawmsg.get('type'), 'raw': raw}
+    for k in ('queue', 'seq', 'chunks'):
+        if k in rawmsg:
+            envelope[k] = rawmsg[k]
+    data = rawmsg.get('data')
+    header = data.get('_header') if data is not None else None
+    metadata = header.get('metadata') if header is not None else None
+    if isinstance(metadata, RawBSONDocument):
+        metadata = bson.decode(metadata.raw)
+    envelope['metadata'] = dict(metadata or {})
+    return envelope
+
 
-    return res_msg
+def decode_emsc_envelope(envelope, spool_dir=None):
+    """decodes the EMSC message of an envelope made by emsc_envelope"""
+    return decode_emsc_msg(bson.BSON(envelope['raw']).decode(), spool_dir)
 
 
 class EmscHmbListener(object):
@@ -304,17 +622,32 @@ class EmscHmbListener(object):
 
 
     """
-    def __init__(self, url, queue=(), nlast=10, heartbeat=30):
+    def __init__(self, url, queue=(), nlast=10, heartbeat=30, retry_policy=None, checkpoint=None, dedup=None, journal=None,
+                 chunks=None, spool_dir=None):
         """
         Args:
             url (str): queue to send the message
             queue (tuple, optional): queues to listen. Defaults to ().
             nlast (int, optional): number of previous message to get back. Defaults to 10.
             heartbeat (int, optional): define the delay in s for the server heartbeat. Defaults to 30.
+            retry_policy (RetryPolicy, optional): delays between reconnections. Defaults to exponential backoff up to 10 s, retried without time limit.
+            checkpoint (CheckpointStore, optional): store of the last processed messages (see hmbcheckpoint.py). Queues with a checkpoint resume after it instead of getting back the nlast messages. Defaults to None.
+            dedup (DedupCache, optional): cache of the messages seen (see hmbdedup.py), duplicates are dropped by listen before being decoded. Defaults to None.
+            journal (Journal, optional): write-ahead journal (see hmbjournal.py), listen journals the messages before running func. Defaults to None.
+            chunks (ChunkAssembler, optional): reassembles the files sent in chunks (see hmbchunks.py), func gets a FILE message with the 'path' of the file once all its chunks are received. Defaults to None.
+            spool_dir (str, optional): directory where the contents of the FILE messages are decompressed, 'data' has the 'path' of the file instead of its 'content'. The handler should move or remove the file. Defaults to None.
         """
         self._url = url
         self._heartbeat = heartbeat
+        self.retry_policy = retry_policy or RetryPolicy(max_delay=10)
+        self.checkpoint = checkpoint
+        self.dedup = dedup
+        self.journal = journal
+        self.chunks = chunks
+        self.spool_dir = spool_dir
         self._auth = None, None
+        self._queue = {}
+        self._match = {}
         self.queue(*queue, nlast=nlast)
 
     def authentication(self, user, password):
@@ -330,26 +663,156 @@ class EmscHmbListener(object):
         self._auth = (user, password)
         return self
 
-    def queue(self, *args, nlast=10):
+    def queue(self, *args, nlast=10, topics=None, filter=None):
         """set the queues to listen
 
         Args:
             *args (list of str): queues to listen
-            nlast (int, optional): number of previous messages to get back. Defaults to 10.
+            nlast (int, optional): number of previous messages to get back for queues without checkpoint. Defaults to 10.
+            topics (list of str, optional): only the messages of these topics are received. Defaults to None (all).
+            filter (dict, optional): mongodb like filter of the messages received, on the hmb message (the EMSC header is data._header, see hmbfilter.py). Defaults to None.
 
         Returns:
             oject itself
         """
-        res = {}
-
+        self._queue = {}
+        self._match = {}
         for q in args:
-            res[q] = {
-                'seq': -nlast-1,
-                'keep': True
-            }
-        self._queue = res
+            self.add_queue(q, nlast=nlast, topics=topics, filter=filter)
+        return self
+
+    def add_queue(self, queue, nlast=10, topics=None, filter=None):
+        """add a queue to listen, with its own topics and filter (see queue).
+        topics and filter are sent to the server and also checked by listen,
+        for the servers ignoring them.
+
+        Returns:
+            oject itself
+        """
+        last = self.checkpoint.get(queue) if self.checkpoint is not None else None
+        param = {
+            'seq': -nlast-1 if last is None else last + 1,
+            'keep': True
+        }
+        if topics:
+            param['topics'] = list(topics)
+        if filter:
+            param['filter'] = filter
+        self._queue[queue] = param
+
+        if topics or filter:
+            self._match[queue] = MessageFilter(topics, filter)
+        else:
+            self._match.pop(queue, None)
         return self
 
+    def resume_after_journal(self):
+        """the queues resume after the last message of the journal, when it is
+        past their checkpoint: the messages of the journal not done are
+        replayed from it (see Journal.pending), they are not received again.
+        Called before listen, with the replay."""
+        if self.journal is None:
+            return
+        for queue, seq in self.journal.last_seqs().items():
+            param = self._queue.get(queue)
+            if param is not None and param['seq'] <= seq:
+                logging.getLogger(__name__).info('Queue %s resumes after the journal at %d', queue, seq + 1)
+                param['seq'] = seq + 1
+
+    def _matches(self, msg):
+        # client side check of the topics and filter of the queue of msg
+        match = self._match.get(msg.get('queue'))
+        return match is None or match(msg)
+
+    def _accept(self, msg):
+        # drops the messages filtered out and the duplicates, and journals the
+        # other messages before they are handed to func
+        if not self._matches(msg):
+            return False
+        if self.dedup is not None and self.dedup.seen(msg):
+            logging.getLogger(__name__).info(
+                'Duplicate message dropped: %s %s (%s)', msg.get('queue'), msg.get('seq'), self.dedup.stats())
+            return False
+        if self.journal is not None:
+            self.journal.append(msg)
+        return True
+
+    def _assemble(self, msg):
+        # the message to hand to func: msg, or None for a chunk of a file not
+        # yet complete and the reassembled message for its last chunk
+        if self.chunks is not None and self.chunks.is_chunk(msg):
+            return self.chunks.add(msg)
+        return msg
+
+    def _decode(self, msg):
+        return decode_emsc_msg(msg, self.spool_dir)
+
+    def _replayed_chunks(self, raw):
+        # the chunks journaled by a previous run and not done are added again
+        # to the assembler receiving the rest of their transfer, yields the
+        # files they complete. Called before the first message is received
+        # (and journaled), the other messages of the journal are replayed by
+        # the caller (see Journal.pending)
+        if self.journal is None or self.chunks is None:
+            return
+        for msg in self.journal.pending(raw=raw):
+            if self.chunks.is_chunk(msg):
+                full = self.chunks.add(msg)
+                if full is not None:
+                    yield full
+
+    def _replay_chunks(self, func, commit, raw):
+        decode = emsc_envelope if raw else self._decode
+        for full in self._replayed_chunks(raw):
+            func(decode(full))
+            if commit:
+                self._commit(full)
+        self._commit_dropped(commit)
+
+    def _commit(self, msg):
+        # msg is processed, with the chunks it was reassembled from
+        if 'chunks' in msg:
+            keys = msg['chunks']
+        elif 'seq' in msg and 'queue' in msg:
+            keys = [(msg['queue'], msg['seq'])]
+        else:
+            return
+        for queue, seq in keys:
+            if self.checkpoint is not None:
+                self.checkpoint.commit(queue, int(seq))
+            if self.journal is not None:
+                self.journal.done(queue, int(seq))
+
+    def _commit_dropped(self, commit):
+        # the chunks dropped by the assembler never reach func: they are done
+        # in the journal even when func commits the messages itself
+        if self.chunks is None:
+            return
+        dropped = self.chunks.pop_dropped()
+        if not dropped:
+            return
+        if commit:
+            self._commit({'chunks': dropped})
+        elif self.journal is not None:
+            for queue, seq in dropped:
+                self.journal.done(queue, seq)
+
+    def _flush(self, commit):
+        if commit and self.checkpoint is not None:
+            self.checkpoint.flush()
+        if self.dedup is not None:
+            self.dedup.close()
+        if self.journal is not None:
+            self.journal.flush()
+        if self.chunks is not None:
+            self.chunks.close()
+
+    def _session(self, param):
+        return HmbSession(
+            self._url, use_bson=True, retry_policy=self.retry_policy,
+            param=param, autocreate_queues=True
+        ).authentication(*self._auth).requests_args(timeout=(6.05, self._heartbeat + 5))
+
     def get(self, func, queue, filter):
         """"get message on the queue satisfaying filter conditions
 
@@ -358,45 +821,65 @@ class EmscHmbListener(object):
             queue (str): queue name
             filter (dict): filtering conditions mongodb format
 
+        Returns:
+            list: results of func, the messages are received and processed one by one (see iter_get)
         """
-        param = {
-            'heartbeat': self._heartbeat,
-        }
+        return [func(msg) for msg in self.iter_get(queue, filter)]
 
-        hmb = HmbSession(
-            self._url, use_bson=True, retry_wait=10,
-            param=param, autocreate_queues=True
-        ).authentication(*self._auth).requests_args(timeout=(6.05, self._heartbeat + 5))
+    def iter_get(self, queue, filter):
+        """iterate over the messages of the queue satisfaying filter conditions.
+        Messages are decoded and yielded one by one as they are received.
 
-        res = []
-        for m in hmb.get(queue, filter):
-            res.append(func(decode_emsc_msg(m)))
+        Args:
+            queue (str): queue name
+            filter (dict): filtering conditions mongodb format
 
-        return res
+        Yields:
+            dict: decoded message
+        """
+        hmb = self._session({'heartbeat': self._heartbeat})
 
-    def listen(self, func, retries=1):
+        try:
+            for m in hmb.iter_get(queue, filter):
+                yield decode_emsc_msg(m, self.spool_dir)
+        finally:
+            hmb.close()
+
+    def listen(self, func, retries=None, commit=True, raw=False):
         """begin the listener and run func for each message
 
         Args:
             func (dict -> None): function to run at each message, that take a dict as argument
-            retries (int, optional): number of retries when the receive failed. Defaults to 1.
+            retries (int, optional): number of retries when the receive failed. Defaults to None (no limit but the max_retry_time, budget or circuit breaker of the retry policy).
+            commit (bool, optional): if True, the message is checkpointed and marked done in the journal once func returned. Defaults to True.
+            raw (bool, optional): if True, func gets the envelope of the message (see emsc_envelope) instead of the decoded message, the payload is not decoded. Defaults to False.
 
         """
-        heartbeat = self._heartbeat
-
         param = {
-            'heartbeat': heartbeat,
+            'heartbeat': self._heartbeat,
             'queue': self._queue
         }
 
-        hmb = HmbSession(
-            self._url, use_bson=True, retry_wait=10,
-            param=param, autocreate_queues=True
-        ).authentication(*self._auth).requests_args(timeout=(6.05, heartbeat + 5))
+        self._replay_chunks(func, commit, raw)
+
+        hmb = self._session(param)
+        hmb.raw_bson = raw
+        decode = emsc_envelope if raw else self._decode
 
         def func_closure(msg):
-            return func(decode_emsc_msg(msg))
+            res = None
+            done = msg
+            if self._accept(msg):
+                # a chunk is done with the file reassembled (or when dropped)
+                done = self._assemble(msg)
+                if done is not None:
+                    res = func(decode(done))
+            if commit and done is not None:
+                self._commit(done)
+            self._commit_dropped(commit)
+            return res
 
         hmb.listen(func_closure, retries=retries, keep_heartbeat=False)
 
         hmb.close()
+        self._flush(commit)
@@ -0,0 +1,485 @@
+"""
+Felt reports of an EMSC message as numpy arrays, and the conversions used to
+build the FinDer inputs: distances to the epicenter, intensity prediction
+(Allen et al., 2012), intensity to PGA (Worden et al., 2012) and the data_N
+files.
+
+    batch = FeltReportBatch.from_feltreport(data['feltreport'])
+    batch.compute_distances(evlon, evlat)
+    realistic = batch.select(batch.realistic_mask(evmag, evdepth))
+    realistic.compute_logpga()
+    realistic.write_finder('data_1', extra=[(evlat, evlon, epicentral_logpga)])
+
+The data_N files are written as '%s %s %s' rows (lat, lon, log PGA) of the
+python values, as the rows built one by one before.
+
+loads_feltreport decodes the json of a felt report message with the columns
+of 'feltreport' parsed straight into numpy arrays, without python lists:
+
+    data = loads_feltreport(msg['data'])
+    batch = FeltReportBatch.from_feltreport(data['feltreport'])
+
+FeltReportBatch.aggregate bins dense reports on a grid of cells of about
+cell_km: a point per cell, at the mean position of its reports, with their
+median intensity:
+
+    cells, count, spread = realistic.aggregate(cell_km=2, max_points=1000)
+
+The messages of an event are cumulative: EventCache keeps the reports
+processed for the last events and only processes the new reports of the
+next message of an event.
+
+    cache = EventCache(maxsize=50, spill_dir='events/')
+    mask, rows = cache.update(evid, batch, evlon, evlat, evdepth, evmag)
+"""
+import collections
+import json
+import logging
+import os
+import re
+
+import numpy
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+
+def I_Allen2012_Rhypo(eq_mag,
+                      eq_depth,
+                      sta_dist,
+                      c0=2.085,
+                      c1=1.428,
+                      c2=-1.402,
+                      c4=0.078,
+                      m1=-0.209,
+                      m2=2.042,
+                      Imin=3):
+    """intensity predicted at the epicentral distances sta_dist (km, array)
+    and maximum distance of the felt reports (Allen et al., 2012)"""
+    RM = m1 + m2*numpy.exp(eq_mag-5)
+    R_hypo = numpy.sqrt(eq_depth**2+sta_dist**2)
+    # the far field term is computed once, for I_sim beyond 50 km and max_dist
+    far = c4*numpy.log(R_hypo/50)
+    I_sim = c0 + (c1 * eq_mag) + c2*numpy.log(numpy.sqrt(R_hypo**2+RM**2))
+    I_sim = numpy.where(R_hypo <= 50, I_sim, I_sim+far)
+    max_dist = numpy.sqrt((numpy.exp((Imin-c0-(c1 * eq_mag)-far)/c2))**2-RM**2)
+
+    return I_sim, max_dist
+
+
+def I_to_PGA_Wordon2012(sta_I,
+                        alpha1=1.78,
+                        beta1=1.557,
+                        alpha2=-1.60,
+                        beta2=3.7,
+                        thres=4.22):
+    """log PGA of the intensities sta_I (Worden et al., 2012), as an array"""
+    sta_I = numpy.asarray(sta_I)
+    return numpy.where(sta_I <= thres, (sta_I-alpha1)/beta1, (sta_I-alpha2)/beta2)
+
+
+def haversine(lon1, lat1, lon2, lat2,
+              r=6371  # Radius of earth in kilometers. Use 3956 for miles
+              ):
+    """
+    Calculate the great circle distance between two points
+    on the earth (specified in decimal degrees)
+    """
+    lon1, lat1, lon2, lat2 = map(numpy.deg2rad, [lon1, lat1, lon2, lat2])
+
+    # haversine formula
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+    a = numpy.sin(dlat/2)**2 + numpy.cos(lat1) * numpy.cos(lat2) * numpy.sin(dlon/2)**2
+    c = 2 * numpy.arcsin(numpy.sqrt(a))
+
+    return c * r
+
+
+# km per degree of latitude (haversine radius)
+_KM_PER_DEGREE = 6371 * numpy.pi / 180
+
+
+def _group_quantile(values, starts, counts, q):
+    # quantile q of each group of values (sorted in each group, groups of
+    # counts values at starts), interpolated as numpy.quantile
+    pos = (counts - 1) * q
+    lo = numpy.floor(pos).astype(numpy.int64)
+    hi = numpy.ceil(pos).astype(numpy.int64)
+    low = values[starts + lo]
+    return low + (values[starts + hi] - low) * (pos - lo)
+
+
+def _loads(text):
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+_FELTREPORT = re.compile(r'"feltreport"\s*:\s*\{')
+_COLUMN = re.compile(r'[\s,]*"([^"\\]*)"\s*:\s*\[')
+_SEPARATORS = re.compile(r'[\s,]*')
+
+
+def _parse_column(values):
+    # numbers of a json array (without the brackets), typed as numpy.asarray
+    # of the list would, raises ValueError if they are not only numbers
+    if orjson is not None:
+        # a list of one column at a time
+        column = numpy.asarray(orjson.loads('[%s]' % values))
+        if column.dtype.kind not in 'iuf':
+            raise ValueError('not a column of numbers')
+        return column
+    if not values.strip():
+        return numpy.asarray([])
+    if any(c in values for c in '.eEnN'):
+        return numpy.fromstring(values, dtype=float, sep=',')
+    return numpy.fromstring(values, dtype=numpy.int64, sep=',')
+
+
+def _parse_feltreport(text):
+    # (data, columns) parsed without decoding the felt report arrays as json
+    # lists, None if the text does not have the expected layout
+    m = _FELTREPORT.search(text)
+    if m is None:
+        return None
+    end = text.find('}', m.end())
+    if end < 0:
+        return None
+    columns = {}
+    pos = m.end()
+    while True:
+        c = _COLUMN.match(text, pos, end)
+        if c is None:
+            break
+        close = text.find(']', c.end(), end)
+        if close < 0:
+            return None
+        try:
+            columns[c.group(1)] = _parse_column(text[c.end():close])
+        except ValueError:
+            return None
+        pos = close + 1
+    if not _SEPARATORS.fullmatch(text, pos, end):
+        return None
+    data = _loads(text[:m.end()] + text[end:])
+    # the match should be the top level feltreport
+    if not isinstance(data, dict) or data.get('feltreport') != {}:
+        return None
+    return data, columns
+
+
+def loads_feltreport(text):
+    """decodes the json text (str or bytes) of a felt report message, with
+    the columns of 'feltreport' (lon, lat, intensity, dt) as numpy arrays.
+    The columns are cut from the text and parsed one by one, by orjson if it
+    is installed, else by numpy (no python list). Messages with another
+    layout are decoded as a whole and their columns converted."""
+    if isinstance(text, (bytes, bytearray)):
+        text = text.decode('utf-8')
+    parsed = _parse_feltreport(text)
+    if parsed is not None:
+        data, columns = parsed
+    else:
+        data = _loads(text)
+        columns = dict((k, numpy.asarray(v)) for k, v in (data.get('feltreport') or {}).items())
+    data['feltreport'] = columns
+    return data
+
+
+def format_rows(*columns):
+    """'%s %s %s' lines of the columns (arrays or lists), formatted from the
+    python values (tolist) as the rows built one by one"""
+    columns = [c.tolist() if isinstance(c, numpy.ndarray) else list(c) for c in columns]
+    fmt = ' '.join(['%s'] * len(columns)) + '\n'
+    return ''.join([fmt % row for row in zip(*columns)])
+
+
+class FeltReportBatch(object):
+    """Felt reports as numpy arrays: lon, lat, intensity, dt and, once
+    computed, distance (km to the epicenter) and logpga."""
+    def __init__(self, lon, lat, intensity, dt=None, distance=None, logpga=None):
+        """
+        Args:
+            lon (array like): longitudes of the reports
+            lat (array like): latitudes of the reports
+            intensity (array like): intensities of the reports
+            dt (array like, optional): delays of the reports after the origin time in s. Defaults to zeros.
+            distance (array like, optional): distances to the epicenter in km. Defaults to None (not computed).
+            logpga (array like, optional): log PGA of the intensities. Defaults to None (not computed).
+        """
+        # the dtype of the json values is kept, the rows are written as before
+        self.lon = numpy.asarray(lon)
+        self.lat = numpy.asarray(lat)
+        self.intensity = numpy.asarray(intensity)
+        self.dt = numpy.zeros(len(self.lon)) if dt is None else numpy.asarray(dt)
+        self.distance = None if distance is None else numpy.asarray(distance)
+        self.logpga = None if logpga is None else numpy.asarray(logpga)
+        if not len(self.lon) == len(self.lat) == len(self.intensity) == len(self.dt):
+            raise ValueError('felt report columns of different lengths')
+
+    @classmethod
+    def from_feltreport(cls, fdata):
+        """batch of the 'feltreport' part of a felt report message (dict of
+        lon, lat, intensity and dt lists)"""
+        return cls(fdata['lon'], fdata['lat'], fdata['intensity'], fdata.get('dt'))
+
+    def __len__(self):
+        return len(self.lon)
+
+    def compute_distances(self, evlon, evlat):
+        """distances to the epicenter (evlon, evlat) in km"""
+        self.distance = haversine(evlon, evlat, self.lon, self.lat)
+        return self.distance
+
+    def compute_logpga(self):
+        """log PGA of the intensities (Worden et al., 2012)"""
+        self.logpga = I_to_PGA_Wordon2012(self.intensity)
+        return self.logpga
+
+    def realistic_mask(self, evmag, evdepth, ipe=None):
+        """mask of the realistic reports: intensity up to 10, closer than the
+        maximum distance and within 3 of the intensity predicted by Allen et
+        al. (2012), computed by ipe (I_Allen2012_Rhypo by default, or an
+        ipetables.IpeTable). The distances should be computed."""
+        if self.distance is None:
+            raise ValueError('the distances to the epicenter are not computed')
+        if ipe is None:
+            ipe = I_Allen2012_Rhypo
+        I_sim, max_dist = ipe(evmag, evdepth, self.distance)
+        return (numpy.round(self.intensity) <= 10) & (self.distance < max_dist) & (numpy.abs(self.intensity-I_sim) <= 3)
+
+    def select(self, mask):
+        """batch of the reports selected by mask (boolean array or indices)"""
+        return self.__class__(
+            self.lon[mask], self.lat[mask], self.intensity[mask], self.dt[mask],
+            distance=None if self.distance is None else self.distance[mask],
+            logpga=None if self.logpga is None else self.logpga[mask])
+
+    def _cells(self, cell_km):
+        # cell index of each report on a grid of cell_km x cell_km at the mean
+        # latitude of the reports, and number of cells
+        dlat = cell_km / _KM_PER_DEGREE
+        dlon = dlat / max(numpy.cos(numpy.deg2rad(numpy.mean(self.lat))), 0.01)
+        ix = numpy.floor(self.lon / dlon).astype(numpy.int64)
+        iy = numpy.floor(self.lat / dlat).astype(numpy.int64)
+        key = (ix - ix.min()) * (iy.max() - iy.min() + 1) + (iy - iy.min())
+        _, inverse, counts = numpy.unique(key, return_inverse=True, return_counts=True)
+        return inverse.ravel(), counts
+
+    def aggregate(self, cell_km=1.0, max_points=None):
+        """aggregates the reports on a grid of cells of about cell_km x
+        cell_km: a report per cell with reports, at their mean position, with
+        their median intensity and their earliest dt (and the log PGA of the
+        median intensity). With max_points, the cells are enlarged (size
+        doubled) until there are at most max_points of them, the whole area
+        of the reports stays covered.
+
+        Args:
+            cell_km (float, optional): size of the cells in km. Defaults to 1.
+            max_points (int, optional): maximum number of cells. Defaults to None (no limit).
+
+        Returns:
+            tuple: batch of the cells, number of reports and interquartile range of the intensities of each cell (arrays)
+        """
+        if not len(self):
+            empty = numpy.zeros(0)
+            cells = self.__class__(empty, empty, empty, empty)
+            cells.compute_logpga()
+            return cells, numpy.zeros(0, dtype=numpy.int64), empty
+        inverse, counts = self._cells(cell_km)
+        while max_points is not None and len(counts) > max(max_points, 1):
+            cell_km *= 2
+            inverse, counts = self._cells(cell_km)
+        logging.getLogger(__name__).debug('%d reports in %d cells of %g km', len(self), len(counts), cell_km)
+
+        # reports sorted by cell, then by intensity
+        order = numpy.lexsort((self.intensity, inverse))
+        starts = numpy.concatenate(([0], numpy.cumsum(counts)[:-1]))
+        intensity = self.intensity[order]
+        cells = self.__class__(
+            numpy.round(numpy.bincount(inverse, weights=self.lon) / counts, 5),
+            numpy.round(numpy.bincount(inverse, weights=self.lat) / counts, 5),
+            _group_quantile(intensity, starts, counts, 0.5),
+            numpy.minimum.reduceat(self.dt[order], starts))
+        cells.compute_logpga()
+        spread = _group_quantile(intensity, starts, counts, 0.75) - _group_quantile(intensity, starts, counts, 0.25)
+        return cells, counts, spread
+
+    def finder_text(self, extra=()):
+        """content of a FinDer data_N file: a 'lat lon logpga' line per report
+        then per extra row (e.g. the epicentral point). The log PGA should be
+        computed."""
+        if self.logpga is None:
+            raise ValueError('the log PGA are not computed')
+        return format_rows(self.lat, self.lon, self.logpga) + ''.join(['%s %s %s\n' % tuple(r) for r in extra])
+
+    def write_finder(self, filename, extra=()):
+        """writes the FinDer data_N file filename in a single write, returns
+        its content"""
+        text = self.finder_text(extra)
+        with open(filename, 'w') as f:
+            f.write(text)
+        return text
+
+
+_STATE_ARRAYS = ('lon', 'lat', 'intensity', 'distance', 'logpga', 'mask')
+
+
+def _ipe_key(ipe):
+    # identity of the intensity prediction equation: the key of an
+    # ipetables.IpeTable (its grid), else the name of the function
+    if ipe is None:
+        ipe = I_Allen2012_Rhypo
+    key = getattr(ipe, 'key', None)
+    if key is None:
+        key = '%s.%s' % (getattr(ipe, '__module__', ''), getattr(ipe, '__qualname__', repr(ipe)))
+    return key
+
+
+class EventCache(object):
+    """LRU cache of the felt reports processed for the last events, keyed by
+    evid. The reports of a message of an event begin with the reports of its
+    previous message: only the new ones are processed, as long as the
+    previous reports look unchanged (same dtypes, at least as many reports and
+    the same last previous report) and the event location, magnitude and ipe
+    too. With spill_dir, the events evicted from memory are saved
+    in npz files and loaded back at their next message."""
+    def __init__(self, maxsize=50, spill_dir=None):
+        """
+        Args:
+            maxsize (int, optional): number of events kept in memory. Defaults to 50.
+            spill_dir (str, optional): directory of the npz files of the events evicted, created if needed. Defaults to None (forgotten).
+        """
+        self.maxsize = maxsize
+        self.spill_dir = spill_dir
+        self.hits = 0
+        self.misses = 0
+        self._events = collections.OrderedDict()
+        self._logger = logging.getLogger(__name__)
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def _spill_file(self, evid):
+        return os.path.join(self.spill_dir, '%s.npz' % evid)
+
+    def _spill(self, evid, state):
+        filename = self._spill_file(evid)
+        tmp = filename + '.tmp'
+        with open(tmp, 'wb') as f:
+            numpy.savez(f, event=numpy.asarray(state['event'], dtype=float), ipe=numpy.asarray(state['ipe']),
+                        **dict((k, state[k]) for k in _STATE_ARRAYS))
+        os.replace(tmp, filename)
+
+    def _unspill(self, evid):
+        if self.spill_dir is None or not os.path.exists(self._spill_file(evid)):
+            return None
+        try:
+            with numpy.load(self._spill_file(evid)) as f:
+                state = dict((k, f[k]) for k in _STATE_ARRAYS)
+                state['event'] = tuple(f['event'].tolist())
+                state['ipe'] = str(f['ipe'])
+        except (OSError, ValueError, KeyError) as e:
+            self._logger.warning('Unable to load the reports of event %s: %s', evid, str(e))
+            return None
+        mask = state['mask']
+        state['rows'] = format_rows(state['lat'][mask], state['lon'][mask], state['logpga'][mask])
+        return state
+
+    def _get(self, evid):
+        state = self._events.get(evid)
+        if state is None:
+            state = self._unspill(evid)
+        else:
+            self._events.move_to_end(evid)
+        return state
+
+    def _put(self, evid, state):
+        self._events[evid] = state
+        self._events.move_to_end(evid)
+        while len(self._events) > self.maxsize:
+            old, oldstate = self._events.popitem(last=False)
+            if self.spill_dir is not None:
+                self._spill(old, oldstate)
+
+    @staticmethod
+    def _known(state, batch, event, ipe):
+        # number of reports of batch already processed in state. Only the last
+        # report known is compared, comparing all of them would cost as much
+        # as processing them
+        if state is None or state['event'] != event or state['ipe'] != ipe:
+            return 0
+        n = len(state['lon'])
+        if n == 0 or n > len(batch):
+            return 0
+        for k in ('lon', 'lat', 'intensity'):
+            # same dtype too, the rows are formatted from the values
+            column = getattr(batch, k)
+            if state[k].dtype != column.dtype or state[k][n - 1] != column[n - 1]:
+                return 0
+        return n
+
+    def update(self, evid, batch, evlon, evlat, evdepth, evmag, ipe=None):
+        """processes the reports of batch (all the reports of the event evid)
+        not yet processed: fills batch.distance and batch.logpga and returns
+        the realistic reports mask (see FeltReportBatch.realistic_mask, with
+        ipe) and the FinDer rows of the realistic reports (see finder_text)"""
+        event = (float(evlon), float(evlat), float(evdepth), float(evmag))
+        ipe_key = _ipe_key(ipe)
+        state = self._get(evid)
+        n = self._known(state, batch, event, ipe_key)
+        if n:
+            self.hits += 1
+        else:
+            self.misses += 1
+            if state is not None:
+                self._logger.info('Event %s changed, all its reports are processed again', evid)
+
+        new = batch.select(slice(n, None))
+        new.compute_distances(evlon, evlat)
+        new_mask = new.realistic_mask(evmag, evdepth, ipe)
+        new.compute_logpga()
+        new_rows = format_rows(new.lat[new_mask], new.lon[new_mask], new.logpga[new_mask])
+        self._logger.debug('Event %s: %d report(s) known, %d new', evid, n, len(new))
+
+        if n:
+            state = {
+                'event': event,
+                'ipe': ipe_key,
+                'lon': batch.lon,
+                'lat': batch.lat,
+                'intensity': batch.intensity,
+                'distance': numpy.concatenate((state['distance'], new.distance)),
+                'logpga': numpy.concatenate((state['logpga'], new.logpga)),
+                'mask': numpy.concatenate((state['mask'], new_mask)),
+                'rows': state['rows'] + new_rows,
+            }
+        else:
+            state = {
+                'event': event,
+                'ipe': ipe_key,
+                'lon': batch.lon,
+                'lat': batch.lat,
+                'intensity': batch.intensity,
+                'distance': new.distance,
+                'logpga': new.logpga,
+                'mask': new_mask,
+                'rows': new_rows,
+            }
+        self._put(evid, state)
+        batch.distance = state['distance']
+        batch.logpga = state['logpga']
+        return state['mask'], state['rows']
+
+    def stats(self):
+        return {'events': len(self._events), 'hits': self.hits, 'misses': self.misses}
+
+    def close(self):
+        """spills the events in memory (with spill_dir)"""
+        if self.spill_dir is not None:
+            for evid, state in self._events.items():
+                self._spill(evid, state)
@@ -0,0 +1,186 @@
+"""
+Durable storage of the last processed sequence number of each hmb queue,
+so that a listener restarts exactly after the last message processed
+instead of backfilling the last n messages.
+
+    store = open_checkpoint_store('listener.ckpt')  # or 'listener.sqlite'
+    hmb = EmscHmbListener(url, ['QUEUE1'], checkpoint=store)
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+
+class CheckpointStore(object):
+    """Base class of the checkpoint stores. commit records that the message
+    seq of queue is processed; the writes to the disk are batched: they
+    happen every sync_every commits, at most sync_interval seconds after a
+    commit, and on flush or close."""
+    def __init__(self, sync_every=10, sync_interval=1.):
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self._logger = logging.getLogger(__name__)
+        self._lock = threading.RLock()
+        self._seqs = {}
+        self._dirty = 0
+        self._timer = None
+
+    def __getstate__(self):
+        # the lock, the timer and the database connection can not be pickled
+        # (e.g. to start a listener process)
+        self.flush()
+        state = self.__dict__.copy()
+        for k in ('_lock', '_timer', '_db'):
+            state.pop(k, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+        self._timer = None
+
+    def load(self):
+        """returns the last processed seq of each queue"""
+        with self._lock:
+            return dict(self._seqs)
+
+    def get(self, queue, default=None):
+        with self._lock:
+            return self._seqs.get(queue, default)
+
+    def commit(self, queue, seq):
+        """marks message seq of queue as processed. The checkpoint never
+        goes backward."""
+        with self._lock:
+            if seq <= self._seqs.get(queue, -1):
+                return
+            self._seqs[queue] = seq
+            self._dirty += 1
+            if self._dirty >= self.sync_every:
+                self.flush()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.sync_interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """writes the pending commits to the disk"""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self._dirty:
+                self._write()
+                self._dirty = 0
+
+    def close(self):
+        self.flush()
+
+    def _write(self):
+        raise NotImplementedError
+
+
+class FileCheckpointStore(CheckpointStore):
+    """Checkpoints kept in a json file. The file is replaced atomically
+    (write to a temporary file, fsync, rename) at each sync."""
+    def __init__(self, filename, sync_every=10, sync_interval=1.):
+        super(FileCheckpointStore, self).__init__(sync_every=sync_every, sync_interval=sync_interval)
+        self.filename = os.path.abspath(filename)
+        if os.path.exists(self.filename):
+            with open(self.filename, 'r') as f:
+                self._seqs = dict((q, int(s)) for q, s in json.load(f).items())
+            self._logger.info('Checkpoints loaded from %s: %s', self.filename, self._seqs)
+
+    def _write(self):
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self._seqs, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.filename)
+        try:
+            fd = os.open(os.path.dirname(self.filename), os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+
+class SqliteCheckpointStore(CheckpointStore):
+    """Checkpoints kept in a sqlite database, each sync is a transaction"""
+    def __init__(self, filename, sync_every=10, sync_interval=1.):
+        super(SqliteCheckpointStore, self).__init__(sync_every=sync_every, sync_interval=sync_interval)
+        self.filename = filename
+        self._connect()
+        self._seqs = dict(self._db.execute('SELECT queue, seq FROM checkpoint'))
+        if self._seqs:
+            self._logger.info('Checkpoints loaded from %s: %s', self.filename, self._seqs)
+
+    def __setstate__(self, state):
+        super(SqliteCheckpointStore, self).__setstate__(state)
+        self._connect()
+
+    def _connect(self):
+        self._db = sqlite3.connect(self.filename, check_same_thread=False)
+        self._db.execute('PRAGMA synchronous=FULL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS checkpoint (queue TEXT PRIMARY KEY, seq INTEGER, updated REAL)')
+        self._db.commit()
+
+    def _write(self):
+        now = time.time()
+        with self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO checkpoint (queue, seq, updated) VALUES (?, ?, ?)',
+                [(q, s, now) for q, s in self._seqs.items()])
+
+    def close(self):
+        super(SqliteCheckpointStore, self).close()
+        self._db.close()
+
+
+def open_checkpoint_store(filename, **kwargs):
+    """opens a sqlite store if filename ends with .sqlite, .sqlite3 or .db
+    and a json file store otherwise"""
+    if os.path.splitext(filename)[1] in ('.sqlite', '.sqlite3', '.db'):
+        return SqliteCheckpointStore(filename, **kwargs)
+    return FileCheckpointStore(filename, **kwargs)
+
+
+class CheckpointTracker(object):
+    """Commits checkpoints of messages processed concurrently and possibly
+    out of order: for each queue the checkpoint is the highest seq such that
+    every message dispatched up to it is done."""
+    def __init__(self, store):
+        self.store = store
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._done = {}
+
+    def dispatched(self, queue, seq):
+        if queue is None or seq is None:
+            return
+        with self._lock:
+            self._inflight.setdefault(queue, set()).add(seq)
+
+    def done(self, queue, seq):
+        if queue is None or seq is None:
+            return
+        with self._lock:
+            inflight = self._inflight.setdefault(queue, set())
+            inflight.discard(seq)
+            self._done[queue] = max(self._done.get(queue, -1), seq)
+            mark = self._done[queue]
+            if inflight:
+                mark = min(mark, min(inflight) - 1)
+        if mark >= 0:
+            self.store.commit(queue, mark)
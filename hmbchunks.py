@@ -0,0 +1,251 @@
+"""
+Chunked transfer of large files as a sequence of EMSC messages.
+
+The publisher (EmscHmbPublisher.send_file_chunked) memory maps the file,
+compresses it as a stream and cuts the compressed stream in chunks of
+chunk_size bytes, each one sent in a CHUNK message with the id of the
+transfer, its index and its sha256, and the metadata and topic of the
+message (the filters of the listeners apply to the chunks). The last chunk
+also has the number of chunks, the size and the sha256 of the file.
+
+The listener (EmscHmbListener with chunks=ChunkAssembler(...)) writes the
+chunks at their place in a partial file as they arrive, in any order, then
+decompresses it to a file of directory and hands a FILE message with its
+'path' to func. The handler owns the file and should move or remove it.
+Transfers without new chunk for timeout seconds are abandoned. The FILE
+message has the (queue, seq) of its chunks in 'chunks', so that they are
+all marked processed in the journal with it, and pop_dropped returns the
+(queue, seq) of the chunks dropped (bad, received twice or of a transfer
+abandoned), never handed to func.
+
+    hmb = EmscHmbListener(url, ['QUEUE1'], chunks=ChunkAssembler('incoming/'))
+"""
+import collections
+import hashlib
+import logging
+import mmap
+import os
+import tempfile
+import time
+import uuid
+
+from hmbcodecs import codec_fields, payload_codec
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+CHUNK_SIZE = 1024 * 1024
+
+# bounded reads of the partial files
+_READ_SIZE = 1024 * 1024
+
+
+def iter_chunks(filename, chunk_size=CHUNK_SIZE, codec=None, level=None):
+    """iterates over the CHUNK payloads (dict without header) of the
+    transfer of filename, compressed with codec (None: not compressed)"""
+    transfer = uuid.uuid4().hex
+    base = {
+        '_type': 'CHUNK',
+        'transfer': transfer,
+        'file': os.path.basename(os.path.abspath(filename)),
+        'chunk_size': chunk_size,
+    }
+    base.update(codec_fields(codec, level))
+    compressor = codec.compressobj(level) if codec is not None else None
+    filehash = hashlib.sha256()
+    pending = b''
+    index = 0
+
+    def chunk(content):
+        msg = dict(base)
+        msg['index'] = index
+        msg['sha256'] = hashlib.sha256(content).hexdigest()
+        msg['content'] = content
+        return msg
+
+    with open(filename, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        # an empty file can not be mapped
+        view = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        try:
+            for offset in range(0, size, chunk_size):
+                block = view[offset:offset + chunk_size]
+                filehash.update(block)
+                pending += compressor.compress(block) if compressor is not None else block
+                # the last chunk is held back to be flagged
+                while len(pending) > chunk_size:
+                    yield chunk(pending[:chunk_size])
+                    pending = pending[chunk_size:]
+                    index += 1
+        finally:
+            if size:
+                view.close()
+
+    if compressor is not None:
+        pending += compressor.flush()
+    while len(pending) > chunk_size:
+        yield chunk(pending[:chunk_size])
+        pending = pending[chunk_size:]
+        index += 1
+    last = chunk(pending)
+    last.update({'last': True, 'count': index + 1, 'size': size, 'file_sha256': filehash.hexdigest()})
+    yield last
+
+
+class _Transfer(object):
+    # chunks received of a transfer, written at their place in a partial file
+    def __init__(self, transfer, directory):
+        fd, self.partname = tempfile.mkstemp(prefix=transfer, suffix='.part', dir=directory)
+        self.file = os.fdopen(fd, 'r+b')
+        self.received = set()
+        self.keys = []
+        self.last = None
+        self.updated = time.time()
+
+    @property
+    def complete(self):
+        return self.last is not None and len(self.received) == self.last['count']
+
+    def write(self, chunk):
+        self.file.seek(chunk['index'] * chunk['chunk_size'])
+        self.file.write(chunk['content'])
+        self.received.add(chunk['index'])
+        self.updated = time.time()
+
+    def discard(self):
+        self.file.close()
+        try:
+            os.remove(self.partname)
+        except OSError:
+            pass
+
+
+class ChunkAssembler(object):
+    """Reassembles the files sent in CHUNK messages (listener side)"""
+    def __init__(self, directory=None, timeout=600):
+        """
+        Args:
+            directory (str, optional): directory of the partial and reassembled files, created if needed. Defaults to the temporary directory.
+            timeout (float, optional): time in s after which a transfer without new chunk is abandoned. Defaults to 600.
+        """
+        self.directory = directory or tempfile.gettempdir()
+        self.timeout = timeout
+        self._transfers = {}
+        # ids of the last transfers completed, their chunks received again are
+        # ignored
+        self._completed = collections.deque(maxlen=1000)
+        self._dropped = []
+        self._logger = logging.getLogger(__name__)
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def is_chunk(rawmsg):
+        """True if rawmsg is a raw hmb message with a CHUNK payload"""
+        if rawmsg.get('type') != 'EMSC_MSG':
+            return False
+        data = rawmsg.get('data')
+        return data is not None and data.get('_type') == 'CHUNK'
+
+    def _drop(self, rawmsg):
+        if 'queue' in rawmsg and 'seq' in rawmsg:
+            self._dropped.append([rawmsg['queue'], int(rawmsg['seq'])])
+
+    def pop_dropped(self):
+        """(queue, seq) of the chunks dropped since the last call"""
+        dropped, self._dropped = self._dropped, []
+        return dropped
+
+    def add(self, rawmsg):
+        """adds the chunk of the raw hmb message rawmsg. Returns None until
+        the transfer is complete, then a raw hmb message of type FILE, with
+        the 'path' of the file instead of its 'content', the queue and seq of
+        rawmsg and the (queue, seq) of all the chunks"""
+        self.expire()
+        chunk = rawmsg['data']
+        transfer = chunk['transfer']
+        content = bytes(chunk['content'])
+        if hashlib.sha256(content).hexdigest() != chunk['sha256']:
+            self._logger.warning('Chunk %d of transfer %s dropped: bad checksum', chunk['index'], transfer)
+            self._drop(rawmsg)
+            return None
+
+        t = self._transfers.get(transfer)
+        if t is None and transfer in self._completed:
+            self._drop(rawmsg)
+            return None
+        if t is None:
+            t = self._transfers[transfer] = _Transfer(transfer, self.directory)
+        if chunk['index'] in t.received:
+            self._drop(rawmsg)
+            return None
+        t.write({'index': chunk['index'], 'chunk_size': chunk['chunk_size'], 'content': content})
+        if 'queue' in rawmsg and 'seq' in rawmsg:
+            t.keys.append([rawmsg['queue'], int(rawmsg['seq'])])
+        if chunk.get('last', False):
+            t.last = dict((k, v) for k, v in chunk.items() if k != 'content')
+        if not t.complete:
+            return None
+
+        del self._transfers[transfer]
+        self._completed.append(transfer)
+        try:
+            path = self._finish(t)
+        finally:
+            t.discard()
+        if path is None:
+            self._dropped.extend(t.keys)
+            return None
+
+        data = {'_type': 'FILE', 'file': t.last['file'], 'path': path, 'zlib': False}
+        if '_header' in t.last:
+            data['_header'] = t.last['_header']
+        msg = {'type': 'EMSC_MSG', 'data': data, 'chunks': t.keys}
+        for k in ('queue', 'seq'):
+            if k in rawmsg:
+                msg[k] = rawmsg[k]
+        return msg
+
+    def _finish(self, t):
+        # decompresses the partial file of the complete transfer t
+        last = t.last
+        filehash = hashlib.sha256()
+        fd, path = tempfile.mkstemp(prefix='%s.' % last['transfer'], suffix='_' + os.path.basename(last['file']),
+                                    dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                codec = payload_codec(last)
+                t.file.seek(0)
+                blocks = iter(lambda: t.file.read(_READ_SIZE), b'')
+                if codec is not None:
+                    blocks = codec.iter_decompress(blocks)
+                for block in blocks:
+                    filehash.update(block)
+                    out.write(block)
+        except Exception as e:
+            # unknown codec or corrupted stream, each codec has its own errors
+            self._logger.error('Transfer %s of %s dropped: %s', last['transfer'], last['file'], str(e))
+            os.remove(path)
+            return None
+
+        if filehash.hexdigest() != last['file_sha256']:
+            self._logger.error('Transfer %s of %s dropped: bad checksum', last['transfer'], last['file'])
+            os.remove(path)
+            return None
+        self._logger.debug('Transfer %s of %s complete: %s', last['transfer'], last['file'], path)
+        return path
+
+    def expire(self):
+        """abandons the transfers without new chunk for timeout seconds"""
+        limit = time.time() - self.timeout
+        for transfer, t in list(self._transfers.items()):
+            if t.updated < limit:
+                self._logger.warning('Transfer %s abandoned: %d chunk(s) received in %d s',
+                                     transfer, len(t.received), self.timeout)
+                del self._transfers[transfer]
+                self._dropped.extend(t.keys)
+                t.discard()
+
+    def close(self):
+        """abandons the transfers in progress"""
+        for t in self._transfers.values():
+            t.discard()
+        self._transfers.clear()
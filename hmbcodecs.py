@@ -0,0 +1,260 @@
+"""
+Compression codecs of the EMSC message payloads.
+
+The codec of a payload is recorded in the message ('codec' and 'level').
+zlib payloads also keep the historical 'zlib': True flag, so that they are
+still decoded by older listeners. zstd (zstandard library) and lz4 (lz4
+library) are optional.
+
+    codec = get_codec('zstd')
+    blob = codec.compress(data, level=3)
+    data = codec.decompress(blob)
+
+A zstd codec with a trained dictionary is registered under its own name,
+on both the publisher and the listener sides:
+
+    register_codec(ZstdCodec('zstd-feltreport', dict_data=open('feltreport.dict', 'rb').read()))
+"""
+import zlib
+
+# size of the blocks of the streaming decompression
+BUFSIZE = 1024 * 1024
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4frame
+except ImportError:
+    lz4frame = None
+
+
+class Codec(object):
+    """Base class of the codecs. compressobj and decompressobj return
+    streaming objects with compress/decompress(chunk) and flush() methods."""
+    name = None
+    default_level = None
+    module = None
+
+    @property
+    def available(self):
+        return True
+
+    def check(self):
+        if not self.available:
+            raise ImportError('codec %s needs the %s library' % (self.name, self.module))
+
+    def compress(self, data, level=None):
+        raise NotImplementedError
+
+    def decompress(self, data):
+        raise NotImplementedError
+
+    def compressobj(self, level=None):
+        raise NotImplementedError
+
+    def decompressobj(self):
+        raise NotImplementedError
+
+    def iter_decompress(self, blocks, bufsize=BUFSIZE):
+        """decompresses the iterable of compressed blocks, yielding the data
+        in pieces. The input is fed bufsize bytes at a time."""
+        d = self.decompressobj()
+        for block in blocks:
+            view = memoryview(block)
+            for i in range(0, len(view), bufsize):
+                out = d.decompress(bytes(view[i:i + bufsize]))
+                if out:
+                    yield out
+        out = d.flush()
+        if out:
+            yield out
+
+
+class ZlibCodec(Codec):
+    name = 'zlib'
+    default_level = -1
+
+    def _level(self, level):
+        return self.default_level if level is None else level
+
+    def compress(self, data, level=None):
+        return zlib.compress(data, self._level(level))
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+    def compressobj(self, level=None):
+        return zlib.compressobj(self._level(level))
+
+    def decompressobj(self):
+        return zlib.decompressobj()
+
+    def iter_decompress(self, blocks, bufsize=BUFSIZE):
+        """decompresses the iterable of compressed blocks, yielding pieces of
+        at most bufsize bytes"""
+        d = zlib.decompressobj()
+        for block in blocks:
+            out = d.decompress(block, bufsize)
+            if out:
+                yield out
+            while d.unconsumed_tail:
+                out = d.decompress(d.unconsumed_tail, bufsize)
+                if out:
+                    yield out
+        out = d.flush()
+        if out:
+            yield out
+
+
+class ZstdCodec(Codec):
+    """zstandard, optionally with a dictionary (dict_data, bytes) trained on
+    similar payloads, e.g. with zstandard.train_dictionary"""
+    default_level = 3
+    module = 'zstandard'
+
+    def __init__(self, name='zstd', dict_data=None):
+        self.name = name
+        self.dict_data = dict_data
+        self._dict = None
+
+    @property
+    def available(self):
+        return zstandard is not None
+
+    def _zdict(self):
+        if self.dict_data is not None and self._dict is None:
+            self._dict = zstandard.ZstdCompressionDict(self.dict_data)
+        return self._dict
+
+    def _compressor(self, level):
+        self.check()
+        return zstandard.ZstdCompressor(
+            level=self.default_level if level is None else level, dict_data=self._zdict())
+
+    def _decompressor(self):
+        self.check()
+        return zstandard.ZstdDecompressor(dict_data=self._zdict())
+
+    def compress(self, data, level=None):
+        return self._compressor(level).compress(data)
+
+    def decompress(self, data):
+        # the content size is not in the frame header of streamed frames
+        return self._decompressor().decompressobj().decompress(data)
+
+    def compressobj(self, level=None):
+        return self._compressor(level).compressobj()
+
+    def decompressobj(self):
+        return _StreamDecompressor(self._decompressor().decompressobj())
+
+
+class Lz4Codec(Codec):
+    name = 'lz4'
+    default_level = 0
+    module = 'lz4'
+
+    @property
+    def available(self):
+        return lz4frame is not None
+
+    def _level(self, level):
+        return self.default_level if level is None else level
+
+    def compress(self, data, level=None):
+        self.check()
+        return lz4frame.compress(data, compression_level=self._level(level))
+
+    def decompress(self, data):
+        self.check()
+        return lz4frame.decompress(data)
+
+    def compressobj(self, level=None):
+        self.check()
+        return _Lz4StreamCompressor(lz4frame.LZ4FrameCompressor(compression_level=self._level(level)))
+
+    def decompressobj(self):
+        self.check()
+        return _StreamDecompressor(lz4frame.LZ4FrameDecompressor())
+
+
+class _StreamDecompressor(object):
+    # decompress/flush interface of zlib.decompressobj
+    def __init__(self, obj):
+        self._obj = obj
+
+    def decompress(self, data):
+        return self._obj.decompress(data)
+
+    def flush(self):
+        return b''
+
+
+class _Lz4StreamCompressor(object):
+    # compress/flush interface of zlib.compressobj
+    def __init__(self, obj):
+        self._obj = obj
+        self._header = obj.begin()
+
+    def compress(self, data):
+        out = self._obj.compress(data)
+        if self._header:
+            out, self._header = self._header + out, b''
+        return out
+
+    def flush(self):
+        return self._header + self._obj.flush()
+
+
+_codecs = {}
+
+
+def register_codec(codec):
+    """registers codec under its name, replacing a codec with the same name"""
+    _codecs[codec.name] = codec
+    return codec
+
+
+def get_codec(name):
+    """codec registered under name, raises ValueError if unknown and
+    ImportError if its library is not installed"""
+    try:
+        codec = _codecs[name]
+    except KeyError:
+        raise ValueError('unknown codec %s, should be one of %s' % (name, ', '.join(sorted(_codecs))))
+    codec.check()
+    return codec
+
+
+def available_codecs():
+    """names of the registered codecs whose library is installed"""
+    return sorted(name for name, codec in _codecs.items() if codec.available)
+
+
+register_codec(ZlibCodec())
+register_codec(ZstdCodec())
+register_codec(Lz4Codec())
+
+
+def payload_codec(msg):
+    """codec of the payload of an EMSC message (FILE, STR or BIN part), None
+    if it is not compressed"""
+    name = msg.get('codec')
+    if name is not None:
+        return get_codec(name)
+    if msg.get('zlib', False):
+        return _codecs['zlib']
+    return None
+
+
+def codec_fields(codec, level=None):
+    """fields describing the compression of a payload in an EMSC message"""
+    if codec is None:
+        return {'zlib': False}
+    fields = {'zlib': codec.name == 'zlib', 'codec': codec.name}
+    if level is not None:
+        fields['level'] = level
+    return fields
@@ -0,0 +1,164 @@
+"""
+Bounded cache of the messages already received, to drop the duplicates
+delivered after reconnections or backfills before they are decoded and
+processed.
+
+    dedup = DedupCache(maxsize=10000, keys=('metadata.evid', 'metadata.count'))
+    hmb = EmscHmbListener(url, ['QUEUE1'], dedup=dedup)
+"""
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+
+def emsc_path(rawmsg, path):
+    """value of a dotted path of an EMSC message, as seen after decoding
+    (e.g. 'metadata.evid', 'author'), taken from the raw hmb message without
+    decoding it. Paths not found in the EMSC header are looked up in the raw
+    hmb message (e.g. 'queue', 'seq'). Returns None if not found."""
+    header = rawmsg.get('data')
+    header = header.get('_header') if header is not None else None
+    for doc in (header, rawmsg):
+        for key in path.split('.'):
+            if doc is None:
+                break
+            try:
+                doc = doc.get(key)
+            except AttributeError:
+                doc = None
+        if doc is not None:
+            return doc
+    return None
+
+
+class DedupCache(object):
+    """LRU cache, optionally with a time to live, of the messages seen. A
+    message is a duplicate if its (queue, seq) was already seen or if the
+    values of its payload keys (dotted paths, see emsc_path) were already
+    seen on the same queue. With filename, the cache is saved in a json file at close and
+    every save_every new messages, and reloaded at creation."""
+    def __init__(self, maxsize=10000, ttl=None, keys=('metadata.evid', 'metadata.count'),
+                 filename=None, save_every=100):
+        """
+        Args:
+            maxsize (int, optional): maximum number of entries. Defaults to 10000.
+            ttl (float, optional): time in s after which an entry is forgotten. Defaults to None (no limit).
+            keys (tuple, optional): dotted paths identifying a message payload, () to only use (queue, seq). Defaults to ('metadata.evid', 'metadata.count').
+            filename (str, optional): json file where the cache is persisted. Defaults to None.
+            save_every (int, optional): number of new messages between saves. Defaults to 100.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.keys = tuple(keys)
+        self.filename = filename
+        self.save_every = save_every
+        self._logger = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._unsaved = 0
+        self.hits_seq = 0
+        self.hits_key = 0
+        self.misses = 0
+        if filename is not None and os.path.exists(filename):
+            self.load()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'hits_seq': self.hits_seq,
+            'hits_key': self.hits_key,
+            'misses': self.misses,
+        }
+
+    def _message_keys(self, rawmsg):
+        keys = []
+        if 'queue' in rawmsg and 'seq' in rawmsg:
+            keys.append(('seq', rawmsg['queue'], int(rawmsg['seq'])))
+        if self.keys:
+            values = tuple(emsc_path(rawmsg, k) for k in self.keys)
+            if not all(v is None for v in values):
+                data = rawmsg.get('data')
+                if data is not None and data.get('_type') == 'CHUNK':
+                    # the chunks of a file (see hmbchunks.py) share its metadata
+                    values += (data.get('index'),)
+                # scoped by queue: other queues may carry the same metadata
+                # (e.g. the results published for an event)
+                keys.append(('key', rawmsg.get('queue')) + values)
+        return keys
+
+    def _expire(self, now):
+        if self.ttl is None:
+            return
+        while self._entries:
+            key, tick = next(iter(self._entries.items()))
+            if tick >= now - self.ttl:
+                break
+            del self._entries[key]
+
+    def seen(self, rawmsg):
+        """returns True if rawmsg (raw hmb message) was already seen, and
+        records it otherwise"""
+        now = time.time()
+        keys = self._message_keys(rawmsg)
+        with self._lock:
+            self._expire(now)
+            hit = None
+            for key in keys:
+                if key in self._entries:
+                    hit = hit or key[0]
+                self._entries[key] = now
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+            if hit == 'seq':
+                self.hits_seq += 1
+            elif hit == 'key':
+                self.hits_key += 1
+            else:
+                self.misses += 1
+                self._unsaved += 1
+                if self.filename is not None and self._unsaved >= self.save_every:
+                    self._save()
+        return hit is not None
+
+    def load(self):
+        with open(self.filename, 'r') as f:
+            entries = json.load(f)
+        with self._lock:
+            for key, tick in entries:
+                self._entries[tuple(key)] = tick
+            self._expire(time.time())
+        self._logger.info('%d deduplication entries loaded from %s', len(entries), self.filename)
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump([[list(k), t] for k, t in self._entries.items()], f)
+        os.replace(tmp, self.filename)
+        self._unsaved = 0
+
+    def close(self):
+        if self.filename is not None:
+            self.save()
@@ -0,0 +1,149 @@
+"""
+mongodb like filters of hmb messages, compiled once to a predicate. Used by
+the stand-in server (hmbserver.py) and by the listeners to filter on the
+client side the messages of servers ignoring the filters.
+
+Paths are dotted paths of the hmb message, the EMSC header is in
+data._header:
+
+    match = compile_filter({'data._header.metadata.mag': {'$gte': 4.5},
+                            'data._header.metadata.region': {'$regex': '^GREECE'}})
+    if match(rawmsg):
+        ...
+
+Supported operators: $and, $or, $eq, $ne, $gt, $gte, $lt, $lte, $in, $nin,
+$exists and $regex.
+"""
+import operator
+import re
+from collections.abc import Mapping
+
+_MISSING = object()
+
+
+def get_path(doc, path):
+    """value of the dotted path in doc, _MISSING if not found"""
+    for key in path.split('.'):
+        if not isinstance(doc, Mapping) or key not in doc:
+            return _MISSING
+        doc = doc[key]
+    return doc
+
+
+def _safe(compare):
+    # comparisons of values of different types are false
+    def test(value, arg):
+        try:
+            return compare(value, arg)
+        except TypeError:
+            return False
+    return test
+
+
+_OPERATORS = {
+    '$eq': _safe(operator.eq),
+    '$ne': _safe(operator.ne),
+    '$gt': _safe(operator.gt),
+    '$gte': _safe(operator.ge),
+    '$lt': _safe(operator.lt),
+    '$lte': _safe(operator.le),
+    '$in': _safe(lambda value, arg: value in arg),
+    '$nin': _safe(lambda value, arg: value not in arg),
+}
+
+
+def _compile_condition(path, op, arg):
+    if op == '$exists':
+        exists = bool(arg)
+        return lambda doc: (get_path(doc, path) is not _MISSING) == exists
+    if op == '$regex':
+        try:
+            regex = re.compile(arg)
+        except (re.error, TypeError) as e:
+            raise ValueError('invalid $regex %r: %s' % (arg, e))
+
+        def match(doc):
+            value = get_path(doc, path)
+            return isinstance(value, str) and regex.search(value) is not None
+        return match
+    try:
+        compare = _OPERATORS[op]
+    except KeyError:
+        raise ValueError('unsupported filter operator %s' % op)
+    if op in ('$in', '$nin') and not isinstance(arg, (list, tuple, set, frozenset)):
+        raise ValueError('%s needs a list' % op)
+
+    def test(doc):
+        value = get_path(doc, path)
+        return value is not _MISSING and compare(value, arg)
+    return test
+
+
+def _all(predicates):
+    if len(predicates) == 1:
+        return predicates[0]
+    return lambda doc: all(p(doc) for p in predicates)
+
+
+def compile_filter(filter):
+    """predicate doc -> bool of the mongodb like filter (dict), raises
+    ValueError if the filter is invalid. An empty or None filter matches
+    everything."""
+    if not filter:
+        return lambda doc: True
+    if not isinstance(filter, Mapping):
+        raise ValueError('a filter should be a dict, not %r' % (filter,))
+    predicates = []
+    for key, cond in filter.items():
+        if key in ('$and', '$or'):
+            if not isinstance(cond, (list, tuple)) or not cond:
+                raise ValueError('%s needs a non empty list of filters' % key)
+            subs = [compile_filter(f) for f in cond]
+            if key == '$and':
+                predicates.append(_all(subs))
+            else:
+                predicates.append(lambda doc, subs=subs: any(p(doc) for p in subs))
+        elif key.startswith('$'):
+            raise ValueError('unsupported filter operator %s' % key)
+        elif isinstance(cond, Mapping) and cond and all(k.startswith('$') for k in cond):
+            predicates.extend(_compile_condition(key, op, arg) for op, arg in cond.items())
+        else:
+            predicates.append(_compile_condition(key, '$eq', cond))
+    return _all(predicates)
+
+
+def compile_topics(topics):
+    """predicate doc -> bool matching the messages whose topic is one of
+    topics, everything if topics is empty or None"""
+    if not topics:
+        return lambda doc: True
+    topics = frozenset(topics)
+    return lambda doc: doc.get('topic') in topics
+
+
+class MessageFilter(object):
+    """predicate of the messages of a queue with topics and a filter,
+    picklable (compiled again after unpickling)"""
+    def __init__(self, topics=None, filter=None):
+        self.topics = list(topics) if topics else None
+        self.filter = filter or None
+        self._compile()
+
+    def _compile(self):
+        self._match_topics = compile_topics(self.topics)
+        self._match_filter = compile_filter(self.filter)
+
+    def __getstate__(self):
+        return {'topics': self.topics, 'filter': self.filter}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._compile()
+
+    def __call__(self, doc):
+        return self._match_topics(doc) and self._match_filter(doc)
+
+
+def match_filter(doc, filter):
+    """True if doc matches filter, see compile_filter"""
+    return compile_filter(filter)(doc)
@@ -0,0 +1,237 @@
+"""
+Bounded handoff of the messages from the listener process (receiver) to the
+process dispatching them to the workers (manager).
+
+The receiver keeps up to capacity messages in memory. When it is full, the
+policy decides: 'block' stops the receiver (the server keeps the messages,
+they are received later), 'drop' drops the oldest message of the same event
+(or else the oldest message of an event with a newer one waiting, or else
+the oldest message) and 'spill' writes the messages to a temporary file
+until there is room again. The queue depth, the age of the oldest waiting
+message and the enqueue/dequeue rates are shared by both sides (stats())
+and logged every log_interval seconds by the receiver.
+
+    handoff = HandoffQueue(capacity=1000, policy='spill')
+    # receiver process
+    handoff.put(msg)
+    # manager process
+    msg = handoff.get()
+"""
+import collections
+import logging
+import multiprocessing
+import pickle
+import tempfile
+import threading
+import time
+
+from hmbworkers import emsc_event
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+POLICIES = ('block', 'drop', 'spill')
+
+# fields of the shared gauges
+_ENQUEUED, _DEQUEUED, _DROPPED, _SPILLED, _OLDEST = range(5)
+
+
+class HandoffQueue(object):
+    """Bounded queue between two processes. put is called by a single
+    receiver process, get by a single manager process."""
+    def __init__(self, capacity=1000, policy='block', event=emsc_event, spill_dir=None,
+                 log_interval=60, on_drop=None, context=None):
+        """
+        Args:
+            capacity (int, optional): number of messages kept in memory by the receiver. Defaults to 1000.
+            policy (str, optional): 'block', 'drop' or 'spill', what put does when the queue is full. Defaults to 'block'.
+            event (msg -> (key, rank), optional): event of a message, for the 'drop' policy. Defaults to emsc_event.
+            spill_dir (str, optional): directory of the spill file. Defaults to the temporary directory.
+            log_interval (float, optional): period in s of the gauges logging, None to disable. Defaults to 60.
+            on_drop (msg -> None, optional): called in the receiver with each message dropped. Defaults to None.
+            context (optional): multiprocessing context. Defaults to the default one.
+        """
+        if policy not in POLICIES:
+            raise ValueError('unknown policy %s, should be one of %s' % (policy, ', '.join(POLICIES)))
+        ctx = context or multiprocessing.get_context()
+        self.capacity = capacity
+        self.policy = policy
+        self.event = event
+        self.spill_dir = spill_dir
+        self.log_interval = log_interval
+        self.on_drop = on_drop
+        self._logger = logging.getLogger(__name__)
+        # few messages in the pipe, the others wait in the receiver where the
+        # policy can be applied
+        self._queue = ctx.Queue(maxsize=2)
+        self._gauges = ctx.Array('d', 5)
+        self._rates = (time.time(), 0, 0)
+        self._receiver = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_receiver'] = None
+        return state
+
+    def stats(self):
+        """gauges of the queue: depth (messages waiting), oldest_age (s),
+        enqueued, dequeued, dropped and spilled (counts since the start),
+        enqueue_rate and dequeue_rate (msg/s since the previous call)"""
+        now = time.time()
+        with self._gauges.get_lock():
+            enqueued, dequeued, dropped, spilled, oldest = self._gauges[:]
+        last, last_enqueued, last_dequeued = self._rates
+        self._rates = (now, enqueued, dequeued)
+        depth = int(enqueued - dequeued - dropped)
+        elapsed = max(now - last, 1e-6)
+        return {
+            'depth': depth,
+            'oldest_age': now - oldest if depth > 0 and oldest > 0 else 0.,
+            'enqueued': int(enqueued),
+            'dequeued': int(dequeued),
+            'dropped': int(dropped),
+            'spilled': int(spilled),
+            'enqueue_rate': (enqueued - last_enqueued) / elapsed,
+            'dequeue_rate': (dequeued - last_dequeued) / elapsed,
+        }
+
+    def log_stats(self):
+        self._logger.info(
+            'Handoff: depth %(depth)d, oldest %(oldest_age).1f s, in %(enqueue_rate).1f msg/s, '
+            'out %(dequeue_rate).1f msg/s, dropped %(dropped)d, spilled %(spilled)d', self.stats())
+
+    def put(self, msg):
+        """hands msg to the manager, applying the policy if the queue is full
+        (receiver side)"""
+        if self._receiver is None:
+            self._receiver = _Receiver(self)
+        self._receiver.put(msg)
+
+    def get(self, timeout=None):
+        """next message (manager side), raises queue.Empty after timeout"""
+        ts, msg = self._queue.get(timeout=timeout)
+        with self._gauges.get_lock():
+            self._gauges[_DEQUEUED] += 1
+        return msg
+
+
+class _Receiver(object):
+    # receiver side of a HandoffQueue: messages in memory, spill file and
+    # feeder thread moving them to the pipe
+    def __init__(self, handoff):
+        self.handoff = handoff
+        self._cond = threading.Condition()
+        self._items = collections.deque()
+        self._inflight = collections.deque()
+        self._transferred = 0
+        self._spill = None
+        self._spill_count = 0
+        self._spill_read = 0
+        self._thread = threading.Thread(name='HandoffFeeder', target=self._feed, daemon=True)
+        self._thread.start()
+
+    def _count(self, field, n=1):
+        gauges = self.handoff._gauges
+        with gauges.get_lock():
+            gauges[field] += n
+
+    def put(self, msg):
+        h = self.handoff
+        item = (time.time(), h.event(msg)[0] if h.policy == 'drop' else None, msg)
+        with self._cond:
+            if h.policy == 'block':
+                while len(self._items) >= h.capacity:
+                    self._cond.wait()
+            elif h.policy == 'drop' and len(self._items) >= h.capacity:
+                self._drop(item[1])
+            if h.policy == 'spill' and (self._spill_count or len(self._items) >= h.capacity):
+                # once spilling, keep the order: everything goes to the file
+                # until it is read back
+                self._spill_write(item)
+            else:
+                self._items.append(item)
+            self._count(_ENQUEUED)
+            self._cond.notify_all()
+
+    def _drop(self, key):
+        victim = None
+        if key is not None:
+            victim = next((i for i in self._items if i[1] == key), None)
+        if victim is None:
+            counts = collections.Counter(i[1] for i in self._items if i[1] is not None)
+            victim = next((i for i in self._items if counts.get(i[1], 0) > 1), None)
+        if victim is None:
+            victim = self._items[0]
+        self._items.remove(victim)
+        self._count(_DROPPED)
+        self.handoff._logger.warning('Handoff queue full, message of event %s dropped', victim[1])
+        if self.handoff.on_drop is not None:
+            self.handoff.on_drop(victim[2])
+
+    def _spill_write(self, item):
+        if self._spill is None:
+            self._spill = tempfile.TemporaryFile(prefix='handoff', dir=self.handoff.spill_dir)
+        self._spill.seek(0, 2)
+        pickle.dump(item, self._spill, protocol=pickle.HIGHEST_PROTOCOL)
+        self._spill_count += 1
+        self._count(_SPILLED)
+
+    def _spill_read_one(self):
+        self._spill.seek(self._spill_read)
+        item = pickle.load(self._spill)
+        self._spill_read = self._spill.tell()
+        self._spill_count -= 1
+        if not self._spill_count:
+            self._spill.seek(0)
+            self._spill.truncate()
+            self._spill_read = 0
+        return item
+
+    def _update_oldest(self):
+        # called with the lock held: oldest message not yet dequeued, in the
+        # pipe or in memory
+        gauges = self.handoff._gauges
+        with gauges.get_lock():
+            inflight = self._transferred - int(gauges[_DEQUEUED])
+            while len(self._inflight) > max(inflight, 0):
+                self._inflight.popleft()
+            if self._inflight:
+                oldest = self._inflight[0]
+            elif self._items:
+                oldest = self._items[0][0]
+            else:
+                oldest = 0.
+            gauges[_OLDEST] = oldest
+
+    def _feed(self):
+        h = self.handoff
+        last_log = time.time()
+
+        def log_due():
+            return h.log_interval is not None and time.time() - last_log >= h.log_interval
+
+        while True:
+            with self._cond:
+                while not self._items and not self._spill_count:
+                    # the gauges are refreshed while waiting
+                    self._update_oldest()
+                    if log_due():
+                        break
+                    self._cond.wait(1.)
+                item = None
+                if self._items:
+                    item = self._items.popleft()
+                    self._inflight.append(item[0])
+                    self._transferred += 1
+                    if self._spill_count:
+                        self._items.append(self._spill_read_one())
+                elif self._spill_count:
+                    self._items.append(self._spill_read_one())
+                self._update_oldest()
+                self._cond.notify_all()
+
+            if item is not None:
+                h._queue.put((item[0], item[2]))
+
+            if log_due():
+                last_log = time.time()
+                h.log_stats()
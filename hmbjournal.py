@@ -0,0 +1,329 @@
+"""
+Write-ahead journal of the messages received by a listener and not yet
+processed, so that a listener killed with messages waiting or running
+processes them again at restart (at-least-once processing).
+
+The receiver appends each raw hmb message, BSON encoded, to the current
+segment file of the journal directory before handing it off. The segment
+files are concatenations of BSON documents, a new one is started at each
+start and every segment_bytes. The process marking the messages processed
+appends their (queue, seq) to its own done log. pending() returns the
+messages of the segments not in the done logs, and compact() removes the
+segments whose messages are all done.
+
+The writes reach the operating system at once (a crash of the listener
+loses nothing) and are synced to the disk every sync_every writes or
+sync_interval seconds.
+
+    journal = Journal('journal/')
+    for msg in journal.pending():
+        process(msg)
+    hmb = EmscHmbListener(url, ['QUEUE1'], journal=journal)
+"""
+import glob
+import logging
+import os
+import threading
+
+import bson
+from bson.raw_bson import RawBSONDocument
+
+from hmbsession import BsonStreamSplitter
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+
+def _fsync_dir(dirname):
+    try:
+        fd = os.open(dirname, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+class _SyncedFile(object):
+    # append only file, synced every sync_every writes or sync_interval s
+    def __init__(self, filename, sync_every, sync_interval):
+        self.filename = filename
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.size = os.path.getsize(filename) if os.path.exists(filename) else 0
+        self._file = open(filename, 'ab', buffering=0)
+        self._lock = threading.RLock()
+        self._dirty = 0
+        self._timer = None
+        _fsync_dir(os.path.dirname(filename))
+
+    def write(self, data):
+        with self._lock:
+            self._file.write(data)
+            self.size += len(data)
+            self._dirty += 1
+            if self._dirty >= self.sync_every:
+                self.sync()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.sync_interval, self.sync)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def sync(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self._dirty and not self._file.closed:
+                os.fsync(self._file.fileno())
+                self._dirty = 0
+
+    def close(self):
+        with self._lock:
+            self.sync()
+            self._file.close()
+
+
+class Journal(object):
+    """Segmented journal of the received messages in directory. append is
+    called by the receiver, done by the processes finishing the messages
+    (each one has its own done log), pending and compact by the manager."""
+    def __init__(self, directory, segment_bytes=16 * 1024 * 1024, sync_every=10, sync_interval=0.2):
+        """
+        Args:
+            directory (str): directory of the journal files, created if needed
+            segment_bytes (int, optional): size after which a new segment is started. Defaults to 16 MB.
+            sync_every (int, optional): number of writes between syncs to the disk. Defaults to 10.
+            sync_interval (float, optional): maximum time in s before a write is synced. Defaults to 0.2.
+        """
+        self.directory = os.path.abspath(directory)
+        self.segment_bytes = segment_bytes
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self._logger = logging.getLogger(__name__)
+        os.makedirs(self.directory, exist_ok=True)
+        self._init_process()
+
+    def _init_process(self):
+        # files and threads belong to the process using them
+        self._pid = os.getpid()
+        self._lock = threading.RLock()
+        self._segment = None
+        self._done = None
+        self._segment_keys = {}
+        self._compactor = None
+        self._stop = threading.Event()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for k in ('_lock', '_segment', '_done', '_compactor', '_stop'):
+            state.pop(k, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_process()
+
+    def _check_process(self):
+        if self._pid != os.getpid():
+            # inherited through fork
+            self._init_process()
+
+    def _segments(self):
+        return sorted(glob.glob(os.path.join(self.directory, '*.wal')))
+
+    def _done_logs(self):
+        return glob.glob(os.path.join(self.directory, 'done-*.log'))
+
+    def _new_segment(self):
+        segments = self._segments()
+        n = int(os.path.basename(segments[-1])[:-4]) + 1 if segments else 1
+        filename = os.path.join(self.directory, '%010d.wal' % n)
+        self._logger.debug('New journal segment %s', filename)
+        return _SyncedFile(filename, self.sync_every, self.sync_interval)
+
+    @staticmethod
+    def key(msg):
+        """(queue, seq) of a raw hmb message"""
+        seq = msg.get('seq')
+        return msg.get('queue'), int(seq) if seq is not None else None
+
+    def append(self, rawmsg):
+        """journals the raw hmb message rawmsg (receiver side)"""
+        self._check_process()
+        data = bson.BSON.encode(rawmsg)
+        with self._lock:
+            if self._segment is None or self._segment.size >= self.segment_bytes:
+                if self._segment is not None:
+                    self._segment.close()
+                self._segment = self._new_segment()
+            self._segment.write(data)
+
+    def done(self, queue, seq):
+        """marks the message seq of queue as processed"""
+        if queue is None or seq is None:
+            return
+        self._check_process()
+        with self._lock:
+            if self._done is None:
+                self._done = _SyncedFile(
+                    os.path.join(self.directory, 'done-%d.log' % self._pid), self.sync_every, self.sync_interval)
+            self._done.write(('%s\t%d\n' % (queue, int(seq))).encode('utf-8'))
+
+    def done_msg(self, msg):
+        """marks the message msg (raw or decoded, with its queue and seq) as
+        processed, and the chunks it was reassembled from (see hmbchunks.py)"""
+        self.done(*self.key(msg))
+        for queue, seq in msg.get('chunks', ()):
+            self.done(queue, seq)
+
+    def _read_done(self):
+        done = set()
+        for filename in self._done_logs():
+            with open(filename, 'rb') as f:
+                for line in f:
+                    try:
+                        queue, seq = line.decode('utf-8').rstrip('\n').split('\t')
+                        done.add((queue, int(seq)))
+                    except ValueError:
+                        # torn last line
+                        continue
+        return done
+
+    def _read_segment(self, filename):
+        splitter = BsonStreamSplitter()
+        with open(filename, 'rb') as f:
+            while True:
+                chunk = f.read(1024 * 1024)
+                if not chunk:
+                    break
+                for doc in splitter.feed(chunk):
+                    yield doc
+        try:
+            splitter.close()
+        except ValueError as e:
+            self._logger.warning('Journal segment %s: %s', filename, str(e))
+
+    def _keys(self, filename):
+        keys = self._segment_keys.get(filename)
+        if keys is None:
+            keys = [self.key(RawBSONDocument(doc)) for doc in self._read_segment(filename)]
+        return keys
+
+    def pending(self, raw=False):
+        """iterates over the raw hmb messages journaled and not done, in the
+        order they were received, as RawBSONDocument if raw. Only the segments
+        existing when pending is called are read."""
+        self._check_process()
+        return self._iter_pending(self._segments(), self._read_done(), raw)
+
+    def _iter_pending(self, segments, done, raw):
+        seen = set()
+        n = 0
+        for filename in segments:
+            for doc in self._read_segment(filename):
+                msg = RawBSONDocument(doc) if raw else bson.BSON(doc).decode()
+                key = self.key(msg)
+                if key in done or key in seen:
+                    continue
+                seen.add(key)
+                n += 1
+                yield msg
+        if n:
+            self._logger.info('%d unfinished message(s) replayed from the journal %s', n, self.directory)
+
+    def last_seqs(self):
+        """seq of the last message journaled for each queue, done or not"""
+        self._check_process()
+        last = {}
+        for filename in self._segments():
+            for queue, seq in self._keys(filename):
+                if queue is not None and seq is not None and seq > last.get(queue, seq - 1):
+                    last[queue] = seq
+        return last
+
+    def compact(self):
+        """removes the segments whose messages are all done, and the done
+        entries of the removed segments"""
+        self._check_process()
+        with self._lock:
+            done = self._read_done()
+            segments = self._segments()
+            remaining = set()
+            removed = 0
+            for filename in segments:
+                keys = self._keys(filename)
+                # the last segment may still be written
+                if filename != segments[-1]:
+                    self._segment_keys[filename] = keys
+                    if all(k in done for k in keys):
+                        os.remove(filename)
+                        del self._segment_keys[filename]
+                        removed += 1
+                        continue
+                remaining.update(keys)
+            if removed:
+                _fsync_dir(self.directory)
+
+            # rewrites the done log of this process with the entries still
+            # useful, merging the logs of the processes gone
+            own = os.path.join(self.directory, 'done-%d.log' % self._pid)
+            gone = [f for f in self._done_logs()
+                    if f != own and not _pid_alive(int(os.path.basename(f)[5:-4]))]
+            if self._done is not None:
+                self._done.close()
+                self._done = None
+            tmp = own + '.tmp'
+            with open(tmp, 'wb') as f:
+                for queue, seq in sorted(done & remaining):
+                    f.write(('%s\t%d\n' % (queue, seq)).encode('utf-8'))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, own)
+            for f in gone:
+                os.remove(f)
+            _fsync_dir(self.directory)
+        if removed:
+            self._logger.info('Journal compaction: %d segment(s) removed, %d left', removed, len(segments) - removed)
+        return removed
+
+    def start_compaction(self, interval=60):
+        """compacts the journal every interval seconds in a background thread"""
+        self._check_process()
+
+        def run():
+            while not self._stop.wait(interval):
+                try:
+                    self.compact()
+                except Exception as e:
+                    self._logger.exception('Journal compaction failed: %s', str(e))
+
+        self._compactor = threading.Thread(name='JournalCompaction', target=run, daemon=True)
+        self._compactor.start()
+        return self
+
+    def flush(self):
+        with self._lock:
+            for f in (self._segment, self._done):
+                if f is not None:
+                    f.sync()
+
+    def close(self):
+        self._stop.set()
+        with self._lock:
+            for f in (self._segment, self._done):
+                if f is not None:
+                    f.close()
+            self._segment = self._done = None
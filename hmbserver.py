@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for an httpmsgbus server, implementing the part of the
+protocol used by hmbsession.py: /open, /send/<sid>, /recv/<sid>[/<queue>/<seq>],
+/info, /features and /status, with JSON or BSON bodies, heartbeats, EOF,
+seq and filter handling and queue errors.
+
+It is meant for benchmarks and tests, messages are only kept in memory.
+
+    server = HmbServerThread().start()
+    hmb = HmbSession(server.url + '/BUS', use_bson=True)
+    ...
+    server.stop()
+"""
+import asyncio
+import datetime
+import json
+import logging
+import sys
+import threading
+import time
+import uuid
+from argparse import ArgumentParser
+
+import bson
+
+from hmbfilter import compile_filter
+from hmbsession import iter_bson_stream
+
+__version__ = '1.0'
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+_COMMANDS = ('open', 'send', 'recv', 'info', 'features', 'status')
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 503: 'Service Unavailable'}
+
+
+class HmbRequestError(Exception):
+    """error returned to the client with http status 400"""
+
+
+class _Queue(object):
+    def __init__(self, name, seq=0):
+        self.name = name
+        self.messages = []
+        # sequence number of the first message kept and of the next one
+        self.first = seq
+        self.next = seq
+
+    def append(self, msg, qlen=None):
+        msg['seq'] = self.next
+        self.next += 1
+        self.messages.append(msg)
+        if qlen is not None and len(self.messages) > qlen:
+            ndrop = len(self.messages) - qlen
+            del self.messages[:ndrop]
+            self.first += ndrop
+
+    def get(self, seq):
+        return self.messages[seq - self.first]
+
+
+class _Bus(object):
+    def __init__(self, name):
+        self.name = name
+        self.queues = {}
+        self.sessions = {}
+        self.cond = asyncio.Condition()
+
+
+class _Session(object):
+    def __init__(self, sid, cid, param, use_json):
+        self.sid = sid
+        self.cid = cid
+        self.use_json = use_json
+        self.heartbeat = float(param.get('heartbeat', 30))
+        self.recv_limit = int(param.get('recv_limit', 100))
+        self.queues = {}
+        self.created = time.time()
+        self.last_seen = self.created
+
+
+class HmbServer(object):
+    """In memory httpmsgbus stand-in. Every path prefix before the command
+    is a separate bus, e.g. http://localhost:8000/EmscProducts/open."""
+    def __init__(self, host='127.0.0.1', port=0, qlen=None):
+        """
+        Args:
+            host (str, optional): listening address. Defaults to '127.0.0.1'.
+            port (int, optional): listening port, 0 to choose a free one. Defaults to 0.
+            qlen (int, optional): maximum number of messages kept per queue. Defaults to None (no limit).
+        """
+        self.host = host
+        self.port = port
+        self.qlen = qlen
+        self._buses = {}
+        self._server = None
+        self._connections = {}
+        self._closing = False
+        self._logger = logging.getLogger(__name__)
+        self.nrequests = 0
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % (self.host, self.port)
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._logger.info('HMB stand-in server listening on %s', self.url)
+        return self
+
+    async def serve_forever(self):
+        if self._server is None:
+            await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def close(self):
+        if self._server is not None:
+            self._closing = True
+            self._server.close()
+            for writer in self._connections.values():
+                writer.close()
+            for bus in self._buses.values():
+                async with bus.cond:
+                    bus.cond.notify_all()
+            await asyncio.gather(*self._connections, return_exceptions=True)
+            await self._server.wait_closed()
+
+    def _bus(self, name):
+        if name not in self._buses:
+            self._buses[name] = _Bus(name)
+        return self._buses[name]
+
+    # http layer
+
+    async def _read_body(self, reader, headers):
+        if 'content-length' in headers:
+            return await reader.readexactly(int(headers['content-length']))
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            body = bytearray()
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    await reader.readline()
+                    return bytes(body)
+                body += await reader.readexactly(size)
+                await reader.readline()
+        return b''
+
+    async def _handle(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections[task] = writer
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                method, path, _ = line.decode('latin-1').split(None, 2)
+                headers = {}
+                while True:
+                    hline = await reader.readline()
+                    if hline in (b'\r\n', b'\n', b''):
+                        break
+                    key, val = hline.decode('latin-1').split(':', 1)
+                    headers[key.strip().lower()] = val.strip()
+                body = await self._read_body(reader, headers)
+
+                self.nrequests += 1
+                status, ctype, payload = await self._dispatch(method, path, headers, body)
+                writer.write(('HTTP/1.1 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n\r\n' % (
+                    status, _REASONS.get(status, ''), ctype, len(payload))).encode('latin-1') + payload)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            self._connections.pop(task, None)
+            writer.close()
+
+    async def _dispatch(self, method, path, headers, body):
+        tokens = [t for t in path.split('?')[0].split('/') if t]
+        idx = next((i for i, t in enumerate(tokens) if t in _COMMANDS), None)
+        if idx is None:
+            return 404, 'text/plain', b'not found\n'
+        bus = self._bus('/'.join(tokens[:idx]))
+        cmd, args = tokens[idx], tokens[idx + 1:]
+        try:
+            if cmd == 'open' and method == 'POST':
+                use_json = 'json' in headers.get('content-type', 'application/json')
+                param = json.loads(body.decode('utf-8') or '{}') if use_json else bson.BSON(body).decode()
+                return self._reply(use_json, self._open(bus, param, use_json))
+            elif cmd == 'send' and method == 'POST' and len(args) == 1:
+                session = self._session(bus, args[0])
+                await self._send(bus, session, body)
+                return 200, 'text/plain', b''
+            elif cmd == 'recv' and method == 'GET' and len(args) in (1, 3):
+                session = self._session(bus, args[0])
+                if len(args) == 3:
+                    self._ack(session, args[1], int(args[2]))
+                return self._reply_many(session.use_json, await self._recv(bus, session))
+            elif cmd in ('info', 'features', 'status') and method == 'GET':
+                return self._reply(True, getattr(self, '_' + cmd)(bus))
+        except HmbRequestError as e:
+            return 400, 'text/plain', (str(e) + '\n').encode('utf-8')
+        except (ValueError, KeyError, bson.errors.BSONError) as e:
+            return 400, 'text/plain', ('invalid request: %s\n' % e).encode('utf-8')
+        return 404, 'text/plain', b'not found\n'
+
+    @staticmethod
+    def _reply(use_json, doc):
+        if use_json:
+            return 200, 'application/json', json.dumps(doc, default=str).encode('utf-8')
+        return 200, 'application/bson', bson.BSON.encode(doc)
+
+    @staticmethod
+    def _reply_many(use_json, messages):
+        if use_json:
+            doc = dict((str(i), m) for i, m in enumerate(messages))
+            return 200, 'application/json', json.dumps(doc, default=str).encode('utf-8')
+        return 200, 'application/bson', b''.join(bson.BSON.encode(m) for m in messages)
+
+    # hmb protocol
+
+    def _session(self, bus, sid):
+        session = bus.sessions.get(sid)
+        if session is None:
+            raise HmbRequestError('session not found')
+        session.last_seen = time.time()
+        return session
+
+    def _open(self, bus, param, use_json):
+        session = _Session(uuid.uuid4().hex, param.get('cid') or uuid.uuid4().hex, param, use_json)
+        qack = {}
+        for qname, qparam in (param.get('queue') or {}).items():
+            queue = bus.queues.get(qname)
+            if queue is None:
+                qack[qname] = {'error': 'queue not found'}
+                continue
+            try:
+                match = compile_filter(qparam.get('filter')) if qparam.get('filter') else None
+            except ValueError as e:
+                raise HmbRequestError('invalid filter for queue %s: %s' % (qname, e))
+            seq = qparam.get('seq', -1)
+            if seq is None or seq < 0:
+                seq = max(queue.first, queue.next + (seq if seq is not None else -1) + 1)
+            elif seq > queue.next:
+                qack[qname] = {'error': 'invalid seq %d (next is %d)' % (seq, queue.next)}
+                continue
+            seq = max(seq, queue.first)
+            session.queues[qname] = {
+                'seq': seq,
+                'endseq': qparam.get('endseq'),
+                'keep': bool(qparam.get('keep', False)),
+                'topics': qparam.get('topics'),
+                'filter': match,
+            }
+            qack[qname] = {'seq': seq}
+        bus.sessions[session.sid] = session
+        return {'sid': session.sid, 'cid': session.cid, 'queue': qack}
+
+    async def _send(self, bus, session, body):
+        if session.use_json:
+            msgdict = json.loads(body.decode('utf-8'))
+            if 'type' in msgdict:
+                messages = [msgdict]
+            else:
+                messages = [msgdict[str(i)] for i in range(len(msgdict))]
+        else:
+            messages = [bson.BSON(raw).decode() for raw in iter_bson_stream([body])]
+
+        for msg in messages:
+            if 'type' not in msg or 'queue' not in msg:
+                raise HmbRequestError('message without type or queue')
+            qname = msg['queue']
+            if qname not in bus.queues:
+                bus.queues[qname] = _Queue(qname, 1 if msg['type'] == 'TOUCH' else 0)
+            if msg['type'] == 'TOUCH':
+                continue
+            bus.queues[qname].append(msg, self.qlen)
+
+        async with bus.cond:
+            bus.cond.notify_all()
+
+    def _ack(self, session, qname, seq):
+        if qname in session.queues and seq + 1 > session.queues[qname]['seq']:
+            session.queues[qname]['seq'] = seq + 1
+
+    def _collect(self, bus, session):
+        """gets the next messages of the session queues, and whether all the
+        queues are exhausted"""
+        messages = []
+        exhausted = True
+        for qname, state in session.queues.items():
+            queue = bus.queues[qname]
+            state['seq'] = max(state['seq'], queue.first)
+            end = queue.next
+            if state['endseq'] is not None and state['endseq'] >= 0:
+                end = min(end, state['endseq'] + 1)
+            while state['seq'] < end and len(messages) < session.recv_limit:
+                msg = queue.get(state['seq'])
+                state['seq'] += 1
+                if state['topics'] and msg.get('topic') not in state['topics']:
+                    continue
+                if state['filter'] is not None and not state['filter'](msg):
+                    continue
+                messages.append(msg)
+            if state['seq'] < end or (state['keep'] and state['endseq'] is None):
+                exhausted = False
+        return messages, exhausted
+
+    async def _recv(self, bus, session):
+        keep = any(q['keep'] for q in session.queues.values())
+        deadline = time.time() + session.heartbeat
+        while True:
+            messages, exhausted = self._collect(bus, session)
+            if messages:
+                if exhausted and not keep:
+                    messages.append({'type': 'EOF'})
+                return messages
+            if exhausted or not keep:
+                return [{'type': 'EOF'}]
+            timeout = deadline - time.time()
+            if timeout <= 0 or self._closing:
+                return [{'type': 'HEARTBEAT'}]
+            async with bus.cond:
+                try:
+                    await asyncio.wait_for(bus.cond.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+    def _info(self, bus):
+        return {
+            'queue': dict((q.name, {'startseq': q.first, 'endseq': q.next})
+                          for q in bus.queues.values())
+        }
+
+    def _features(self, bus):
+        return {
+            'software': 'hmbserver.py %s (stand-in)' % __version__,
+            'functions': ['OPEN', 'SEND', 'RECV', 'INFO', 'FEATURES', 'STATUS', 'FILTER', 'TOPICS'],
+            'capabilities': ['JSON', 'BSON', 'WINDOW', 'FILTER'],
+        }
+
+    def _status(self, bus):
+        return {
+            'session': [
+                {'sid': s.sid, 'cid': s.cid,
+                 'ctime': datetime.datetime.utcfromtimestamp(s.created).isoformat(),
+                 'queue': dict((q, st['seq']) for q, st in s.queues.items())}
+                for s in bus.sessions.values()
+            ]
+        }
+
+
+class HmbServerThread(object):
+    """Runs an HmbServer in a background thread with its own event loop,
+    to be used from blocking code."""
+    def __init__(self, host='127.0.0.1', port=0, qlen=None):
+        self.server = HmbServer(host, port, qlen=qlen)
+        self._loop = None
+        self._thread = None
+        self._ready = threading.Event()
+
+    @property
+    def url(self):
+        return self.server.url
+
+    def start(self):
+        self._thread = threading.Thread(name='hmbserver', target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        self._ready.wait()
+        return self
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_until_complete(self.server.start())
+        self._ready.set()
+        self._loop.run_forever()
+        self._loop.run_until_complete(self.server.close())
+        self._loop.close()
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop = None
+
+
+if __name__ == '__main__':
+    argd = ArgumentParser(description='local stand-in httpmsgbus server')
+    argd.add_argument('--host', help='listening address', default='127.0.0.1')
+    argd.add_argument('--port', help='listening port', type=int, default=8000)
+    argd.add_argument('--qlen', help='maximum number of messages kept per queue', type=int)
+    argd.add_argument('-v', '--verbose', action='store_true')
+
+    args = argd.parse_args()
+
+    logging.basicConfig(
+        stream=sys.stderr, level=logging.DEBUG if args.verbose else logging.INFO,
+        format='%(asctime)s:%(levelname)s:%(name)s:%(message)s')
+
+    server = HmbServer(args.host, args.port, qlen=args.qlen)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
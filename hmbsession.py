@@ -4,25 +4,245 @@ Module for sending messages to an httpmsgbus server.
 """
 from __future__ import print_function
 import sys
+import struct
+import random
+import collections
+import itertools
+import threading
 import requests
 import time
 import json
 import logging
 import bson
+from bson.raw_bson import RawBSONDocument
 import datetime
 import getpass
 
 logging.getLogger(__name__).addHandler(logging.NullHandler())
 
+_BSON_SIZE = struct.Struct('<i')
+
 
 def _check_requests_status_raise(r):
     if r.status_code == 400:
-        raise requests.exceptions.RequestException("bad request: " + r.text.strip())
+        raise requests.exceptions.RequestException("bad request: " + r.text.strip(), response=r)
     elif r.status_code == 503:
-        raise requests.exceptions.RequestException("service unavailable: " + r.text.strip())
+        raise requests.exceptions.RequestException("service unavailable: " + r.text.strip(), response=r)
     r.raise_for_status()
 
 
+def _attempts(retries):
+    # numbers of the attempts of a request retried retries times (None: no
+    # limit, see RetryPolicy)
+    return itertools.count() if retries is None else range(retries + 1)
+
+
+class CircuitOpenError(ValueError):
+    """raised without contacting the server while the circuit breaker of a
+    RetryPolicy is open"""
+
+
+class RetryPolicy(object):
+    """Retry policy of the hmb sessions.
+
+    Delays grow exponentially with the attempt number, from base_delay for
+    connection errors (and timeouts) or server_delay for 5xx errors, up to
+    max_delay, and use full jitter (uniform between 0 and the delay) so that
+    many clients do not retry in lockstep. Client errors (4xx, e.g. an
+    expired session) are retried once immediately with a new session, and
+    then fail unless retry_client_errors is True.
+
+    budget limits the number of retries over budget_window seconds for all
+    the requests using the policy, and max_retry_time the time spent retrying
+    after consecutive failures. After breaker_threshold consecutive
+    failures the circuit breaker opens: requests fail immediately with
+    CircuitOpenError during breaker_reset seconds, then a single trial
+    request is allowed (half-open state) and closes the circuit on success.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, base_delay=0.05, server_delay=0.5, max_delay=10., multiplier=2.,
+                 retry_client_errors=False, budget=None, budget_window=60.,
+                 breaker_threshold=None, breaker_reset=30., max_retry_time=None):
+        """
+        Args:
+            base_delay (float, optional): first delay in s after a connection error. Defaults to 0.05.
+            server_delay (float, optional): first delay in s after a server error. Defaults to 0.5.
+            max_delay (float, optional): maximum delay in s. Defaults to 10.
+            multiplier (float, optional): growth factor of the delay between attempts. Defaults to 2.
+            retry_client_errors (bool, optional): if True retry 4xx errors like server errors. Defaults to False.
+            budget (int, optional): maximum number of retries within budget_window. Defaults to None (no limit).
+            budget_window (float, optional): duration in s of the budget window. Defaults to 60.
+            breaker_threshold (int, optional): consecutive failures opening the circuit. Defaults to None (no breaker).
+            breaker_reset (float, optional): duration in s of the open state. Defaults to 30.
+            max_retry_time (float, optional): time in s after the first of consecutive failures after which the requests are no longer retried. Defaults to None (no limit).
+        """
+        self.base_delay = base_delay
+        self.server_delay = server_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.retry_client_errors = retry_client_errors
+        self.budget = budget
+        self.budget_window = budget_window
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        self.max_retry_time = max_retry_time
+
+        self._lock = threading.Lock()
+        self._retries = collections.deque()
+        self._failures = 0
+        self._failing_since = None
+        self._opened = None
+        self._state = self.CLOSED
+        self.nretries = 0
+        self.nfailures = 0
+
+    def __getstate__(self):
+        # the lock can not be pickled (e.g. to start a listener process)
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        """state of the circuit breaker: 'closed', 'open' or 'half-open'"""
+        with self._lock:
+            if self._state == self.OPEN and time.time() >= self._opened + self.breaker_reset:
+                return self.HALF_OPEN
+            return self._state
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'consecutive_failures': self._failures,
+            'failures': self.nfailures,
+            'retries': self.nretries,
+        }
+
+    @staticmethod
+    def classify(exc):
+        """returns the kind of error: 'connect', 'server', 'client' or 'other'"""
+        while exc.__cause__ is not None:
+            exc = exc.__cause__
+        status = getattr(exc, 'status', None)
+        response = getattr(exc, 'response', None)
+        if status is None and response is not None:
+            status = getattr(response, 'status_code', None)
+        if status is not None:
+            return 'client' if 400 <= status < 500 and status not in (408, 429) else 'server'
+        if isinstance(exc, (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                            ConnectionError, TimeoutError, OSError)):
+            return 'connect'
+        return 'other'
+
+    def before_call(self):
+        """raises CircuitOpenError if the circuit is open. In half-open state
+        only the first caller is allowed to try."""
+        if self.breaker_threshold is None:
+            return
+        with self._lock:
+            if self._state == self.CLOSED:
+                return
+            if self._state == self.OPEN and time.time() >= self._opened + self.breaker_reset:
+                self._state = self.HALF_OPEN
+                return
+            raise CircuitOpenError('HMB circuit breaker open (%d consecutive failures)' % self._failures)
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._failing_since = None
+            self._state = self.CLOSED
+
+    def failure(self, exc, attempt, retries):
+        """records a failure and returns the delay in s before the next
+        attempt, or None if the request should not be retried (retries None:
+        no limit on the number of attempts)."""
+        kind = self.classify(exc)
+        now = time.time()
+        with self._lock:
+            self.nfailures += 1
+            if self._failing_since is None:
+                self._failing_since = now
+            self._failures += 1
+            if self._state == self.HALF_OPEN or (
+                    self.breaker_threshold is not None and self._failures >= self.breaker_threshold):
+                if self._state != self.OPEN:
+                    self._state = self.OPEN
+                    self._opened = now
+                return None
+
+            if retries is not None and attempt >= retries:
+                return None
+            if self.max_retry_time is not None and now - self._failing_since >= self.max_retry_time:
+                return None
+
+            if kind == 'client':
+                if attempt > 0 and not self.retry_client_errors:
+                    return None
+                delay = 0. if attempt == 0 else self.server_delay
+            else:
+                base = self.server_delay if kind == 'server' else self.base_delay
+                delay = min(self.max_delay, base * self.multiplier ** min(attempt, 64))
+                delay = random.uniform(0, delay)
+
+            if self.budget is not None:
+                while self._retries and self._retries[0] < now - self.budget_window:
+                    self._retries.popleft()
+                if len(self._retries) >= self.budget:
+                    return None
+                self._retries.append(now)
+            self.nretries += 1
+            return delay
+
+
+class BsonStreamSplitter(object):
+    """incrementally splits a stream of bytes in raw BSON documents using
+    their length prefix. Only the incomplete document is kept in memory."""
+    def __init__(self):
+        self._buf = bytearray()
+
+    def feed(self, chunk):
+        """adds a chunk of the stream and returns the list of documents
+        completed by it"""
+        buf = self._buf
+        buf += chunk
+        docs = []
+        pos = 0
+        while len(buf) - pos >= _BSON_SIZE.size:
+            size = _BSON_SIZE.unpack_from(buf, pos)[0]
+            if size < 5:
+                raise ValueError('invalid BSON document size %d' % size)
+            if len(buf) - pos < size:
+                break
+            docs.append(bytes(buf[pos:pos + size]))
+            pos += size
+        del buf[:pos]
+        return docs
+
+    def close(self):
+        """checks that the stream ended on a document boundary"""
+        if self._buf:
+            raise ValueError('truncated BSON stream (%d bytes left)' % len(self._buf))
+
+
+def iter_bson_stream(chunks):
+    """splits a stream of bytes in raw BSON documents using their length
+    prefix. Each document is yielded as soon as it is complete, so only the
+    current document and the current chunk are kept in memory."""
+    splitter = BsonStreamSplitter()
+    for chunk in chunks:
+        for doc in splitter.feed(chunk):
+            yield doc
+    splitter.close()
+
+
 def generic_hmb_display(msg):
     print(" * {0} --> New message".format(datetime.datetime.now()))
     for k, v in msg.items():
@@ -39,11 +259,21 @@ def generic_hmb_display(msg):
     print()
 
 
-class HmbSession(object):
+class BaseHmbSession(object):
+    """Session state and message encoding shared by the blocking HmbSession
+    and the asyncio AsyncHmbSession (see asynchmb.py). It does no I/O."""
     def __init__(self, url, param=None, retry_wait=1, use_bson=False,
-                 autocreate_queues=False):
+                 autocreate_queues=False, max_batch_count=100,
+                 max_batch_bytes=4 * 1024 * 1024, retry_policy=None):
         """opens a session with an hmb server at provided url.
 
+       retry_policy is a RetryPolicy deciding the delays between retries, by
+       default exponential backoff up to retry_wait seconds. It can be shared
+       by several sessions (e.g. to share a circuit breaker).
+
+       max_batch_count and max_batch_bytes bound the number of messages and
+       the encoded size of a single /send request built by send_many.
+
        param = {
                 "cid": <string>,
                 "heartbeat": <int>,
@@ -70,6 +300,14 @@ class HmbSession(object):
         self.requests_kwargs = {}
         self._logger = logging.getLogger(__name__)
         self.retry_wait = retry_wait
+        self.retry_policy = retry_policy or RetryPolicy(max_delay=retry_wait)
+        self.max_batch_count = max_batch_count
+        self.max_batch_bytes = max_batch_bytes
+        # size of the chunks read from the /recv response
+        self.recv_chunk_size = 64 * 1024
+        # if True, the BSON messages received are RawBSONDocument, decoded
+        # only when their fields are read
+        self.raw_bson = False
 
         self._http_persistant = None
 
@@ -125,6 +363,129 @@ class HmbSession(object):
             self._close()
         return self
 
+    def _close(self):
+        """
+        mark session as closed
+        """
+        self._sid = None
+
+    def _retry_delay(self, e, func, args, attempt, retries):
+        """closes the session after a failure, logs and returns the delay
+        before the next attempt or None to give up"""
+        self._close()
+        self._logger.error('Exception %s with %s, args: %s', str(e), func.__name__, str(args)[:200])
+        delay = self.retry_policy.failure(e, attempt, retries)
+        if delay is not None:
+            self._logger.error('HMB retry %s in %.3f s (retries %d/%s)', func.__name__, delay, attempt,
+                               'unlimited' if retries is None else retries)
+        return delay
+
+    def _content_type(self):
+        return "application/json" if self._use_json else "application/bson"
+
+    def _encode_param(self):
+        return json.dumps(self.param) if self._use_json else bson.BSON.encode(self.param)
+
+    def _decode_ack(self, content):
+        return json.loads(content) if self._use_json else bson.BSON(content).decode()
+
+    def _apply_ack(self, ack):
+        """updates the session from the /open acknowledgment and returns
+        the queues that have to be created with a TOUCH message"""
+        self._sid = ack['sid']
+        self._oid = ''
+        self.param['cid'] = ack['cid']
+
+        touch = []
+        qinfo = ack.get('queue', {})
+        for qname, queue in qinfo.items():
+            error = queue.get('error', None)
+            if error is not None:
+                self._logger.warning(
+                    "HMB server error for queue '%s': %s",
+                    qname, error)
+
+                # if queue not found then create queue?
+                if error == u'queue not found' and self._autocreate_queues:
+                    touch.append(qname)
+            else:
+                # suppose that seq is alway a number!
+                seqnext = int(queue['seq'])
+                if qname in self.param.get('queue', {}):
+                    if seqnext > self.param['queue'][qname].get('seq', 0):
+                        self.param['queue'][qname]['seq'] = seqnext
+
+        self._logger.info("New HMB session : url=%s, sid=%s, cid=%s",
+                          self.url, ack['sid'], ack['cid'])
+        self._logger.debug("Session parameters : %r", self.param)
+        return touch
+
+    def _touch_msg(self, qname):
+        """message creating queue qname, the queue will be read from seq 1"""
+        msg = {'type': 'TOUCH', 'queue': qname}
+        self.param['queue'][qname]['seq'] = 1
+        self._logger.info("Create HMB queue '%s' with TOUCH", qname)
+        return {'0': msg} if self._use_json else msg
+
+    @staticmethod
+    def make_msg(queue, data, mtype='MSG', topic=None):
+        """build a single hmb message.
+            queue - destination queue of the message
+            data - json compatible payload
+            mtype - message type (string)
+            topic - optional tag for the message
+        """
+        msg = {"type": mtype,
+               "queue": queue,
+               "data": data}
+        if topic:
+            msg["topic"] = topic
+        return msg
+
+    def _encode_one(self, msg):
+        if self._use_json:
+            return json.dumps(msg, allow_nan=False)
+        return bson.BSON.encode(msg)
+
+    def _join_batch(self, encoded):
+        # json: multi-message format {"0": msg0, "1": msg1, ...}
+        # bson: plain concatenation of documents
+        if self._use_json:
+            return '{' + ','.join('"%d":%s' % (i, e) for i, e in enumerate(encoded)) + '}'
+        return b''.join(encoded)
+
+    def _iter_batches(self, messages):
+        """encodes messages and groups them in request bodies"""
+        batch = []
+        size = 0
+        for msg in messages:
+            encoded = self._encode_one(msg)
+            if batch and (len(batch) >= self.max_batch_count
+                          or size + len(encoded) > self.max_batch_bytes):
+                yield self._join_batch(batch)
+                batch = []
+                size = 0
+            batch.append(encoded)
+            size += len(encoded)
+        if batch:
+            yield self._join_batch(batch)
+
+    def _decode_doc(self, raw):
+        if self.raw_bson:
+            return RawBSONDocument(raw)
+        return bson.BSON(raw).decode()
+
+    def _track_seq(self, obj):
+        """extracts sequence number from messages to ensure future
+        continuity of messages received."""
+        if 'seq' in obj and 'queue' in obj:
+            seqnum = int(obj['seq'])
+            if seqnum >= self.param['queue'][obj['queue']]['seq']:
+                self.param['queue'][obj['queue']]['seq'] = seqnum + 1  # next message number
+            self._oid = '/%s/%d' % (obj['queue'], seqnum)
+
+
+class HmbSession(BaseHmbSession):
     def get_httpsession(self):
         if self._http_persistant is None:
             self._logger.debug('New http session')
@@ -139,54 +500,20 @@ class HmbSession(object):
     def _open(self):
         """opens the HMB session"""
         try:
-            headers = {"Content-type": "application/json" if self._use_json else "application/bson"}
             url = self.url + '/open'
             r = self.get_httpsession().post(
                 url,
-                data=json.dumps(self.param) if self._use_json else bson.BSON.encode(self.param),
-                headers=headers, **self.requests_kwargs)
+                data=self._encode_param(),
+                headers={"Content-type": self._content_type()}, **self.requests_kwargs)
             self._logger.debug('Open %s with status %s', url, r.status_code)
             _check_requests_status_raise(r)
 
-            ack = r.json() if self._use_json else bson.BSON(r.content).decode()
-            self._sid = ack['sid']
-            self._oid = ''
-            self.param['cid'] = ack['cid']
-
-            qinfo = ack.get('queue', {})
-            for qname, queue in qinfo.items():
-                error = queue.get('error', None)
-                if error is not None:
-                    self._logger.warning(
-                        "HMB server error for queue '%s': %s",
-                        qname, error)
-
-                    # if queue not found then create queue?
-                    if error == u'queue not found' and self._autocreate_queues:
-                        msg = {'type': 'TOUCH', 'queue': qname}
-                        self.send({'0': msg} if self._use_json else msg)
-                        self.param['queue'][qname]['seq'] = 1
-                        self._logger.info("Create HMB queue '%s' with TOUCH", qname)
-                else:
-                    # suppose that seq is alway a number!
-                    seqnext = int(queue['seq'])
-                    if qname in self.param['queue']:
-                        if seqnext > self.param['queue'][qname].get('seq', 0):
-                            self.param['queue'][qname]['seq'] = seqnext
-
-            self._logger.info("New HMB session : url=%s, sid=%s, cid=%s",
-                              self.url, ack['sid'], ack['cid'])
-            self._logger.debug("Session parameters : %r", self.param)
+            for qname in self._apply_ack(self._decode_ack(r.content)):
+                self.send(self._touch_msg(qname))
 
         except requests.exceptions.RequestException as e:
             self._logger.error("HMB connexion error: %s", str(e))
-            raise ValueError('Hmb Session not open')
-
-    def _close(self):
-        """
-        mark session as closed
-        """
-        self._sid = None
+            raise ValueError('Hmb Session not open') from e
 
     def info(self):
         """gets info from the hmb server on defined queues, topics and available
@@ -234,11 +561,7 @@ class HmbSession(object):
             kwargs - any extra keyvalues to put in the message ie. seq,
                      starttime, endtime
         """
-        msg = {"type": mtype,
-               "queue": queue,
-               "data": data}
-        if topic:
-            msg["topic"] = topic
+        msg = self.make_msg(queue, data, mtype=mtype, topic=topic)
 
         # json messages always require multi-message format
         # bson messages use a different type of concatenation
@@ -247,18 +570,73 @@ class HmbSession(object):
 
         self.send(msg, retries)
 
+    def send_msgs(self, queue, iterable, mtype='MSG', topic=None, retries=1):
+        """send several payloads to the same queue, batched in as few
+        requests as possible (see send_many).
+            queue - destination queue of the messages
+            iterable - json compatible payloads
+            mtype - message type (string)
+            topic - optional tag for the messages
+            retries - number of times to retry sending each batch
+
+        Returns the number of /send requests made.
+        """
+        return self.send_many(
+            (self.make_msg(queue, data, mtype=mtype, topic=topic) for data in iterable),
+            retries=retries)
+
+    def send_many(self, messages, retries=1):
+        """send several hmb messages (see make_msg) packed into a single /send
+        body per batch. A batch holds at most max_batch_count messages and
+        max_batch_bytes of encoded data (a single bigger message is still
+        sent alone).
+
+        Returns the number of /send requests made.
+        """
+        nrequests = 0
+        for body in self._iter_batches(messages):
+            self._wrap_retry(self._send_body, (body,), retries)
+            nrequests += 1
+        return nrequests
+
     def _wrap_retry(self, func, args, retries):
-        for i in range(retries + 1):
+        for i in _attempts(retries):
+            self.retry_policy.before_call()
             try:
                 if self._sid is None:
                     self._open()
-                return func(*args)
+                res = func(*args)
             except Exception as e:
-                self._close()
-                # self._logger.exception('Exception %S with %s, args: %s', str(e), func.__name__, str(args))
-                self._logger.error('Exception %s with %s, args: %s', str(e), func.__name__, str(args))
-                self._logger.error('HMB retry %s (retries %d/%d)', func.__name__, i, retries)
-                time.sleep(self.retry_wait)
+                delay = self._retry_delay(e, func, args, i, retries)
+                if delay is None:
+                    break
+                time.sleep(delay)
+            else:
+                self.retry_policy.success()
+                return res
+
+        self._logger.error("Max retry: HMB connexion lost")
+        raise ValueError('Exit Hmb Session. Max retry reached!')
+
+    def _wrap_retry_iter(self, func, args, retries):
+        """same as _wrap_retry for generator functions. As the session
+        bookkeeping is updated for every message, a retry continues after the
+        last message yielded."""
+        for i in _attempts(retries):
+            self.retry_policy.before_call()
+            try:
+                if self._sid is None:
+                    self._open()
+                for item in func(*args):
+                    yield item
+            except Exception as e:
+                delay = self._retry_delay(e, func, args, i, retries)
+                if delay is None:
+                    break
+                time.sleep(delay)
+            else:
+                self.retry_policy.success()
+                return
 
         self._logger.error("Max retry: HMB connexion lost")
         raise ValueError('Exit Hmb Session. Max retry reached!')
@@ -271,11 +649,15 @@ class HmbSession(object):
 
     def _send(self, msg):
         """actually sends message to HMB session"""
+        self._send_body(self._encode_one(msg))
+
+    def _send_body(self, body):
+        """posts an already encoded body to HMB session"""
         url = self.url + '/send/' + self._sid
         r = self.get_httpsession().post(
             url,
-            headers={"Content-type": "application/json" if self._use_json else "application/bson"},
-            data=json.dumps(msg, allow_nan=False) if self._use_json else bson.BSON.encode(msg),
+            headers={"Content-type": self._content_type()},
+            data=body,
             **self.requests_kwargs)
         self._logger.debug('Send %s with status %s', url, r.status_code)
 
@@ -284,24 +666,23 @@ class HmbSession(object):
     def recv_all(self, retries=1, timeout=None):
         """receives all messages from an HMB query. This should not be
         used for realtime operation."""
+        return list(self.iter_recv_all(retries=retries, timeout=timeout))
+
+    def iter_recv_all(self, retries=1, timeout=None):
+        """same as recv_all but messages are yielded as soon as they are
+        received instead of being collected in a list."""
         starttime = time.time()
         # correction factor so that timeout works as expected.
         starttime -= 0.2
-        messages = []
         while True:
-            subset = self.recv(retries=retries)
-            if not subset:  # no messages received
-                pass
-            elif subset[-1]['type'] != 'EOF':
-                messages += subset
-            else:
-                messages += subset[:-1]
-                break
+            for msg in self.iter_recv(retries=retries, keep_eof=True):
+                if msg['type'] == 'EOF':
+                    return
+                yield msg
 
             if timeout and time.time() > starttime + timeout:
                 self._close()
-                break
-        return messages
+                return
 
     def recv(self, retries=1, keep_heartbeat=False):
         """receives messages from HMB session. Request is blocking until the
@@ -316,31 +697,20 @@ class HmbSession(object):
             messages = [m for m in messages if m['type'] not in ('HEARTBEAT', )]
         return messages
 
+    def iter_recv(self, retries=1, keep_heartbeat=False, keep_eof=False):
+        """same as recv but messages are yielded one by one as soon as they
+        are received."""
+        for msg in self._wrap_retry_iter(self._iter_recv, (), retries):
+            if msg['type'] == 'HEARTBEAT' and not keep_heartbeat:
+                continue
+            if msg['type'] == 'EOF' and not keep_eof:
+                continue
+            yield msg
+
     def _recv(self):
         """actually receive messages from HMB. Request is blocking if "keep=True"
         is specified in the connection parameters for any of the queues."""
-        url = self.url + '/recv/' + self._sid + self._oid
-        r = self.get_httpsession().get(url, **self.requests_kwargs)
-
-        self._logger.debug('Recv %s with status %s', url, r.status_code)
-
-        _check_requests_status_raise(r)
-
-        if self._use_json:
-            msgdict = r.json()  # can be multiple messages
-            messages = [msgdict[str(i)] for i in range(len(msgdict))]
-        else:  # bson
-            messages = bson.decode_all(r.content)
-
-        seqnum = None
-        for obj in messages:
-            # extracts sequence number from messages to ensure future
-            # continuity of messages received.
-            if 'seq' in obj and 'queue' in obj:
-                seqnum = int(obj['seq'])
-                if seqnum >= self.param['queue'][obj['queue']]['seq']:
-                    self.param['queue'][obj['queue']]['seq'] = seqnum + 1  # next message number
-                self._oid = '/%s/%d' % (obj['queue'], seqnum)
+        messages = list(self._iter_recv())
 
         # closing session if EOF message is last message received
         # will always be the last message?
@@ -350,34 +720,64 @@ class HmbSession(object):
 
         return messages
 
-    def get(self, queue, filter):
-        self.param['queue'] = {queue: {'seq': 0, 'filter': filter}}
-        self._open()
-        url = self.url + '/recv/' + self._sid
-        r = self.get_httpsession().get(url, **self.requests_kwargs)
+    def _iter_recv(self):
+        """receive messages from HMB and yield them while the response is
+        read. The BSON body is split in documents as the bytes arrive."""
+        url = self.url + '/recv/' + self._sid + self._oid
+        r = self.get_httpsession().get(url, stream=True, **self.requests_kwargs)
+        try:
+            self._logger.debug('Recv %s with status %s', url, r.status_code)
 
-        _check_requests_status_raise(r)
+            _check_requests_status_raise(r)
 
-        if self._use_json:
-            msgdict = r.json()  # can be multiple messages
-            messages = [msgdict[str(i)] for i in range(len(msgdict))]
-        else:  # bson
-            messages = bson.decode_all(r.content)
+            if self._use_json:
+                msgdict = r.json()  # can be multiple messages
+                messages = (msgdict[str(i)] for i in range(len(msgdict)))
+            else:  # bson
+                messages = (self._decode_doc(raw)
+                            for raw in iter_bson_stream(r.iter_content(self.recv_chunk_size)))
 
-        return messages
+            for obj in messages:
+                self._track_seq(obj)
+                yield obj
+        finally:
+            r.close()
+
+    def get(self, queue, filter):
+        """gets all messages of queue matching filter (mongodb syntax)"""
+        return list(self.iter_get(queue, filter))
+
+    def iter_get(self, queue, filter):
+        """same as get but messages are yielded as soon as they are received
+        instead of being collected in a list."""
+        self.param['queue'] = {queue: {'seq': 0, 'filter': filter}}
+        self._open()
+        while True:
+            nmsg = 0
+            for msg in self._iter_recv():
+                if msg['type'] == 'EOF':
+                    return
+                nmsg += 1
+                if msg['type'] != 'HEARTBEAT':
+                    yield msg
+            if nmsg == 0:
+                return
 
     def listen(self, callback=generic_hmb_display, delay=0.1, retries=1, keep_heartbeat=False):
         while True:
-            try:
-                allmsgs = self.recv(retries=retries, keep_heartbeat=keep_heartbeat)
-            except KeyboardInterrupt:
-                self._logger.warning('Exit HMB Session Listener')
-                break
-            except Exception:
-                self._logger.warning('unexpected exit HMB')
-                break
+            allmsgs = self.iter_recv(retries=retries, keep_heartbeat=keep_heartbeat)
+            while True:
+                try:
+                    msg = next(allmsgs)
+                except StopIteration:
+                    break
+                except KeyboardInterrupt:
+                    self._logger.warning('Exit HMB Session Listener')
+                    return
+                except Exception:
+                    self._logger.warning('unexpected exit HMB')
+                    return
 
-            for msg in allmsgs:
                 callback(msg)
 
             if delay is not None:
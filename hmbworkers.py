@@ -0,0 +1,593 @@
+"""
+Pool of persistent worker processes running the processing of the messages
+received by a listener.
+
+The workers are started once and wait for tasks, so a message does not pay
+the start of a process (and the imports under spawn). The pool is driven by
+the completions: a single thread waits on the worker pipes and dispatches
+the next pending task as soon as a worker is idle.
+
+    pool = WorkerPool(process_message, nworkers=3, maxtasksperchild=100).start()
+    pool.submit(msg)
+    ...
+    pool.close()
+
+With a CoalescingScheduler, a newer version of an event replaces the one
+still waiting for a worker (and optionally cancels the one running), so that
+the freshest data is processed first under load. With a ShardedScheduler,
+the messages of an event are processed in order by a single worker.
+"""
+import bisect
+import collections
+import hashlib
+import itertools
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from multiprocessing.connection import wait
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+
+class Task(object):
+    """message submitted to the pool, with its timing (time.time())"""
+    __slots__ = ('id', 'msg', 'key', 'rank', 'slot', 'pid', 'submitted', 'started', 'ended', 'error')
+
+    def __init__(self, id, msg, key=None, rank=None):
+        self.id = id
+        self.msg = msg
+        self.key = key
+        self.rank = rank
+        self.slot = None
+        self.pid = None
+        self.submitted = time.time()
+        self.started = None
+        self.ended = None
+        self.error = None
+
+    @property
+    def ok(self):
+        return self.ended is not None and self.error is None
+
+    @property
+    def wait_time(self):
+        """time in s between the submission and the start in the worker"""
+        return None if self.started is None else self.started - self.submitted
+
+    @property
+    def run_time(self):
+        """time in s of the processing in the worker"""
+        return None if self.started is None or self.ended is None else self.ended - self.started
+
+    def __repr__(self):
+        return 'Task(%d, slot=%s)' % (self.id, self.slot)
+
+
+class FifoScheduler(object):
+    """Pending tasks of a WorkerPool, dispatched in submission order to
+    any idle worker"""
+    def __init__(self):
+        self._pending = collections.deque()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def put(self, task):
+        """queues task
+
+        Returns:
+            list of Task: tasks not to run anymore, pending ones to drop
+            (possibly task itself) and running ones to cancel
+        """
+        self._pending.append(task)
+        return []
+
+    def pop(self, idle):
+        """returns (task, slot) to run next among the idle worker slots, or
+        None if nothing can be dispatched"""
+        if not self._pending or not idle:
+            return None
+        return self._pending.popleft(), idle[0]
+
+    def done(self, task):
+        """called once task is finished"""
+        pass
+
+    def clear(self):
+        """removes and returns the pending tasks"""
+        pending = list(self._pending)
+        self._pending.clear()
+        return pending
+
+
+def emsc_event(msg):
+    """(evid, count) of a decoded EMSC message, from its metadata"""
+    metadata = msg.get('metadata') or {}
+    return metadata.get('evid'), metadata.get('count')
+
+
+def _newer(task, other):
+    # unknown ranks: the last received is the newest
+    return task.rank is None or other.rank is None or task.rank > other.rank
+
+
+class CoalescingScheduler(FifoScheduler):
+    """Pending tasks keyed by event: a task replaces, at the same place in
+    the queue, the pending task of the same event with a lower rank, and is
+    dropped if a task with a higher rank is pending or running. Tasks of
+    different events are dispatched in submission order to any idle worker.
+    With cancel_running, a running task of the event with a lower rank is
+    cancelled."""
+    coalesce = True
+
+    def __init__(self, event=emsc_event, cancel_running=False):
+        """
+        Args:
+            event (msg -> (key, rank), optional): event key and version of a message, key None for messages never coalesced. Defaults to emsc_event, (evid, count).
+            cancel_running (bool, optional): cancel the running task of an event when a newer one is received. Defaults to False.
+        """
+        super(CoalescingScheduler, self).__init__()
+        self.event = event
+        self.cancel_running = cancel_running
+        self._pending_keys = {}
+        self._running = {}
+
+    def _queue(self, task):
+        # queue where task waits
+        return self._pending
+
+    def put(self, task):
+        if task.key is None:
+            task.key, task.rank = self.event(task.msg)
+        queue = self._queue(task)
+        if task.key is None or not self.coalesce:
+            queue.append(task)
+            return []
+
+        stale = []
+        running = self._running.get(task.key)
+        if running is not None:
+            if not _newer(task, running):
+                return [task]
+            if self.cancel_running:
+                stale.append(running)
+
+        pending = self._pending_keys.get(task.key)
+        if pending is None:
+            queue.append(task)
+        elif _newer(task, pending):
+            queue[queue.index(pending)] = task
+            stale.append(pending)
+        else:
+            return [task]
+        self._pending_keys[task.key] = task
+        return stale
+
+    def _pop(self, idle):
+        return super(CoalescingScheduler, self).pop(idle)
+
+    def pop(self, idle):
+        item = self._pop(idle)
+        if item is not None:
+            task = item[0]
+            if task.key is not None:
+                if self._pending_keys.get(task.key) is task:
+                    del self._pending_keys[task.key]
+                self._running[task.key] = task
+        return item
+
+    def done(self, task):
+        if task.key is not None and self._running.get(task.key) is task:
+            del self._running[task.key]
+
+    def clear(self):
+        self._pending_keys.clear()
+        return super(CoalescingScheduler, self).clear()
+
+
+def _hash(value):
+    return int(hashlib.md5(str(value).encode('utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """Consistent hashing of keys onto nodes, each node being placed at
+    vnodes points of the ring"""
+    def __init__(self, nodes, vnodes=64):
+        ring = sorted((_hash('%s-%d' % (node, i)), node) for node in nodes for i in range(vnodes))
+        self._hashes = [h for h, _ in ring]
+        self._nodes = [node for _, node in ring]
+
+    def get(self, key):
+        """node of key"""
+        i = bisect.bisect(self._hashes, _hash(key))
+        return self._nodes[i % len(self._nodes)]
+
+
+class ShardedScheduler(CoalescingScheduler):
+    """Tasks of an event always run on the same worker slot, given by a
+    consistent hash of the event key, one at a time and in submission order,
+    while different events run in parallel on all the workers. Tasks without
+    event key run on any idle worker. With coalesce, the versions of an
+    event are coalesced as in CoalescingScheduler."""
+    def __init__(self, nslots, event=emsc_event, coalesce=False, cancel_running=False, vnodes=64):
+        """
+        Args:
+            nslots (int): number of worker slots, nworkers of the pool
+            event (msg -> (key, rank), optional): event key and version of a message. Defaults to emsc_event, (evid, count).
+            coalesce (bool, optional): coalesce the pending versions of an event. Defaults to False.
+            cancel_running (bool, optional): with coalesce, cancel the running task of an event when a newer one is received. Defaults to False.
+            vnodes (int, optional): points of each slot in the hash ring. Defaults to 64.
+        """
+        super(ShardedScheduler, self).__init__(event=event, cancel_running=cancel_running)
+        self.coalesce = coalesce
+        self.ring = HashRing(range(nslots), vnodes=vnodes)
+        self._shards = [collections.deque() for _ in range(nslots)]
+
+    def __len__(self):
+        return len(self._pending) + sum(len(q) for q in self._shards)
+
+    def slot(self, key):
+        """worker slot of the event key"""
+        return self.ring.get(key)
+
+    def _queue(self, task):
+        if task.key is None:
+            return self._pending
+        return self._shards[self.slot(task.key)]
+
+    def _pop(self, idle):
+        # oldest task that can run on an idle slot
+        best = None
+        for slot in idle:
+            if self._shards[slot] and (best is None or self._shards[slot][0].id < best[0].id):
+                best = self._shards[slot][0], slot
+        if self._pending and idle and (best is None or self._pending[0].id < best[0].id):
+            free = [slot for slot in idle if not self._shards[slot]]
+            return self._pending.popleft(), (free or idle)[0]
+        if best is not None:
+            self._shards[best[1]].popleft()
+        return best
+
+    def clear(self):
+        pending = super(ShardedScheduler, self).clear()
+        for q in self._shards:
+            pending.extend(q)
+            q.clear()
+        return pending
+
+
+class TaskCancelled(BaseException):
+    """raised in a worker when its task is cancelled (SIGTERM), not an
+    Exception so that func does not catch it"""
+
+
+def _cancelled(signum, frame):
+    # the other processes of the group (started by func) got the signal too
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    raise TaskCancelled()
+
+
+def _worker_main(func, conn, maxtasks, initializer, finalizer):
+    if hasattr(os, 'setpgid'):
+        # own process group, so that a cancellation also stops the
+        # processes started by func
+        os.setpgid(0, 0)
+    # a cancelled worker stops its task and exits through the finalizer
+    signal.signal(signal.SIGTERM, _cancelled)
+    try:
+        _worker_loop(func, conn, maxtasks, initializer, finalizer)
+    except TaskCancelled:
+        logging.info('Worker %d stopped: task cancelled', os.getpid())
+
+
+def _worker_loop(func, conn, maxtasks, initializer, finalizer):
+    if initializer is not None:
+        initializer()
+    ntasks = 0
+    try:
+        while maxtasks is None or ntasks < maxtasks:
+            try:
+                item = conn.recv()
+            except EOFError:
+                break
+            if item is None:
+                break
+            task_id, msg = item
+            started = time.time()
+            error = None
+            try:
+                func(msg)
+            except Exception as e:
+                logging.exception('Unexpected exception during message processing: %s', str(e))
+                error = str(e) or e.__class__.__name__
+            conn.send((task_id, error, started, time.time()))
+            ntasks += 1
+    finally:
+        # the atexit functions are not run in the worker processes, the
+        # finalizer is also run after a cancellation
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        if finalizer is not None:
+            try:
+                finalizer()
+            except Exception as e:
+                logging.exception('Unexpected exception at worker exit: %s', str(e))
+        conn.close()
+
+
+class _Worker(object):
+    def __init__(self, slot, process, conn):
+        self.slot = slot
+        self.process = process
+        self.conn = conn
+        self.task = None
+        self.ntasks = 0
+
+
+class WorkerPool(object):
+    """Persistent worker processes running func(msg) for each message
+    submitted. submit blocks while maxpending tasks are waiting. on_done(task)
+    is called from the pool thread when a task is finished (task.error is
+    set if func raised or the worker died)."""
+    def __init__(self, func, nworkers=3, maxtasksperchild=None, maxpending=100,
+                 scheduler=None, on_done=None, initializer=None, finalizer=None, context=None):
+        """
+        Args:
+            func (dict -> None): function run in the workers, must be picklable
+            nworkers (int, optional): number of worker processes. Defaults to 3.
+            maxtasksperchild (int, optional): number of tasks after which a worker is replaced by a new one. Defaults to None (never).
+            maxpending (int, optional): maximum number of tasks waiting for a worker. Defaults to 100.
+            scheduler (optional): order of dispatch of the pending tasks. Defaults to FifoScheduler().
+            on_done (Task -> None, optional): called when a task is finished. Defaults to None.
+            initializer (callable, optional): run at the start of each worker. Defaults to None.
+            finalizer (callable, optional): run when a worker stops (closed pool, maxtasksperchild reached, task cancelled or pool terminated, not when the worker crashes). Defaults to None.
+            context (optional): multiprocessing context. Defaults to the default one.
+        """
+        self.func = func
+        self.nworkers = nworkers
+        self.maxtasksperchild = maxtasksperchild
+        self.maxpending = maxpending
+        self.scheduler = scheduler if scheduler is not None else FifoScheduler()
+        self.on_done = on_done
+        self.initializer = initializer
+        self.finalizer = finalizer
+        self._ctx = context or multiprocessing.get_context()
+        self._logger = logging.getLogger(__name__)
+        self._cond = threading.Condition()
+        self._ids = itertools.count(1)
+        self._workers = []
+        self._thread = None
+        self._closing = False
+        self._terminated = False
+        self._wake_r, self._wake_w = self._ctx.Pipe(duplex=False)
+        self._woken = False
+        self.submitted = 0
+        self.done = 0
+        self.failed = 0
+        self.superseded = 0
+        self.cancelled = 0
+        self.respawned = 0
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _spawn(self, slot):
+        conn, child_conn = self._ctx.Pipe()
+        process = self._ctx.Process(
+            name='Worker_{0}'.format(slot), target=_worker_main,
+            args=(self.func, child_conn, self.maxtasksperchild, self.initializer, self.finalizer))
+        process.daemon = True
+        process.start()
+        child_conn.close()
+        self._logger.debug('- Start worker %d (pid %d)', slot, process.pid)
+        return _Worker(slot, process, conn)
+
+    def start(self):
+        self._workers = [self._spawn(slot) for slot in range(self.nworkers)]
+        self._thread = threading.Thread(name='WorkerPool', target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def submit(self, msg, key=None, rank=None):
+        """queues msg for processing, blocks while the pool has maxpending
+        tasks waiting. key and rank are used by the scheduler (see
+        CoalescingScheduler), by default they are computed from msg.
+
+        Returns:
+            Task: the task, updated when it is finished
+        """
+        task = Task(next(self._ids), msg, key=key, rank=rank)
+        with self._cond:
+            if self._closing:
+                raise ValueError('pool closed')
+            while self.maxpending and len(self.scheduler) >= self.maxpending:
+                self._cond.wait()
+            stale = self.scheduler.put(task)
+            self.submitted += 1
+            for t in stale:
+                if t.slot is not None:
+                    self._cancel(t)
+            self._wake()
+        for t in stale:
+            if t.slot is None:
+                self._drop(t)
+        return task
+
+    def _wake(self):
+        # called with the lock held, at most one pending wake up in the pipe
+        if not self._woken:
+            self._woken = True
+            self._wake_w.send(None)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'workers': len(self._workers),
+                'busy': sum(1 for w in self._workers if w.task is not None),
+                'pending': len(self.scheduler),
+                'submitted': self.submitted,
+                'done': self.done,
+                'failed': self.failed,
+                'superseded': self.superseded,
+                'cancelled': self.cancelled,
+                'respawned': self.respawned,
+            }
+
+    def _dispatch(self):
+        with self._cond:
+            while True:
+                # a worker which reached maxtasksperchild is exiting, it gets
+                # no task until it is replaced
+                idle = [w.slot for w in self._workers if w.task is None and (
+                    self.maxtasksperchild is None or w.ntasks < self.maxtasksperchild)]
+                item = self.scheduler.pop(idle)
+                if item is None:
+                    break
+                task, slot = item
+                worker = self._workers[slot]
+                task.slot, task.pid = slot, worker.process.pid
+                worker.task = task
+                try:
+                    worker.conn.send((task.id, task.msg))
+                except OSError:
+                    # the worker died, the task fails when its exit is seen
+                    pass
+                self._cond.notify_all()
+
+    def _finish(self, worker, error=None, started=None, ended=None):
+        with self._cond:
+            task, worker.task = worker.task, None
+            worker.ntasks += 1
+            task.started = started
+            task.ended = ended if ended is not None else time.time()
+            task.error = error
+            self.scheduler.done(task)
+            if error is None:
+                self.done += 1
+            elif error != 'cancelled':
+                self.failed += 1
+        if error == 'cancelled':
+            self._logger.info('Task %d cancelled on worker %d', task.id, task.slot)
+        elif task.wait_time is not None:
+            self._logger.info('Task %d ended in %.1f s on worker %d (waited %.3f s)%s', task.id,
+                              task.run_time, task.slot, task.wait_time, ': ' + error if error else '')
+        else:
+            self._logger.error('Task %d failed on worker %d: %s', task.id, task.slot, error)
+        if self.on_done is not None:
+            try:
+                self.on_done(task)
+            except Exception as e:
+                self._logger.exception('Unexpected exception in on_done: %s', str(e))
+
+    def _drop(self, task):
+        # pending task superseded by a newer one
+        task.ended = time.time()
+        task.error = 'superseded'
+        with self._cond:
+            self.superseded += 1
+        self._logger.info('Task %d superseded', task.id)
+        if self.on_done is not None:
+            try:
+                self.on_done(task)
+            except Exception as e:
+                self._logger.exception('Unexpected exception in on_done: %s', str(e))
+
+    def _kill(self, worker):
+        try:
+            os.killpg(worker.process.pid, signal.SIGTERM)
+        except (AttributeError, OSError):
+            worker.process.terminate()
+
+    def _cancel(self, task):
+        # called with the lock held, the task fails when the worker exit is seen
+        worker = self._workers[task.slot]
+        if worker.task is task and task.error is None:
+            task.error = 'cancelled'
+            self.cancelled += 1
+            self._logger.info('Cancel task %d on worker %d', task.id, task.slot)
+            self._kill(worker)
+
+    def _receive(self, worker):
+        try:
+            task_id, error, started, ended = worker.conn.recv()
+        except (EOFError, OSError):
+            return False
+        if worker.task is not None and worker.task.id == task_id:
+            self._finish(worker, error, started, ended)
+        return True
+
+    def _replace(self, worker):
+        # the worker exited: maxtasksperchild reached, crash or terminated
+        while worker.conn.poll() and self._receive(worker):
+            pass
+        worker.process.join()
+        if worker.task is not None:
+            self._finish(worker, worker.task.error or 'worker exited with code %s' % worker.process.exitcode)
+        worker.conn.close()
+        self._logger.debug('- Worker %d (pid %d) exited with code %s after %d task(s)', worker.slot,
+                           worker.process.pid, worker.process.exitcode, worker.ntasks)
+        if not self._terminated:
+            with self._cond:
+                self._workers[worker.slot] = self._spawn(worker.slot)
+                self.respawned += 1
+
+    def _idle(self):
+        with self._cond:
+            return not len(self.scheduler) and all(w.task is None for w in self._workers)
+
+    def _run(self):
+        while True:
+            self._dispatch()
+            if self._closing and self._idle():
+                break
+            conns = dict((w.conn, w) for w in self._workers if w.task is not None)
+            sentinels = dict((w.process.sentinel, w) for w in self._workers)
+            for obj in wait(list(conns) + list(sentinels) + [self._wake_r]):
+                if obj is self._wake_r:
+                    with self._cond:
+                        while self._wake_r.poll():
+                            self._wake_r.recv()
+                        self._woken = False
+                elif obj in conns:
+                    if obj.poll():
+                        self._receive(conns[obj])
+            for obj in wait(list(sentinels), timeout=0):
+                self._replace(sentinels[obj])
+
+        for w in self._workers:
+            try:
+                w.conn.send(None)
+            except OSError:
+                pass
+        for w in self._workers:
+            w.process.join()
+            w.conn.close()
+        self._logger.debug('- Worker pool stopped: %s', self.stats())
+
+    def close(self, wait=True):
+        """stops the pool once the pending tasks are processed"""
+        with self._cond:
+            self._closing = True
+            self._wake()
+        if wait:
+            self.join()
+
+    def join(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def terminate(self):
+        """stops the pool now, running tasks are killed"""
+        with self._cond:
+            self._closing = True
+            self._terminated = True
+            self.scheduler.clear()
+            for w in self._workers:
+                self._kill(w)
+            self._wake()
+        self.join()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+Lookup tables of the intensity prediction equation of Allen et al. (2012)
+(feltreport.I_Allen2012_Rhypo): the predicted intensity and the maximum
+distance of the felt reports are computed once on a magnitude x hypocentral
+distance grid, cached in a .npy file, and interpolated (bilinear) for each
+report.
+
+    ipe = IpeTable(cache_dir='ipe/')
+    I_sim, max_dist = ipe(evmag, evdepth, distances)
+    mask = batch.realistic_mask(evmag, evdepth, ipe=ipe)
+
+The grid is regular in the square root of the hypocentral distance, finer at
+short distances where the intensity varies most. The distances and the
+magnitudes out of the grid are computed with the closed form. IpeTable.check
+measures the interpolation error against the closed form:
+
+    python3 ipetables.py --check --cache-dir ipe/
+
+The intensity to PGA conversion (Worden et al., 2012) is piecewise linear,
+it is not tabulated.
+"""
+import hashlib
+import logging
+import os
+import sys
+import time
+from argparse import ArgumentParser
+
+import numpy
+
+from feltreport import I_Allen2012_Rhypo
+
+__version__ = '1.0'
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+# maximum interpolation errors of check: absolute on the intensity, relative
+# on the maximum distance
+INTENSITY_ERROR = 1e-3
+MAX_DIST_ERROR = 1e-3
+
+
+class IpeTable(object):
+    """Intensity and maximum distance of Allen et al. (2012) interpolated in
+    tables, called as I_Allen2012_Rhypo (with a single magnitude)"""
+    def __init__(self, cache_dir=None, mag_min=2.0, mag_max=9.5, mag_step=0.05, dist_min=0.1, dist_max=3000.0,
+                 ndist=1200):
+        """
+        Args:
+            cache_dir (str, optional): directory of the .npy file of the tables, created if needed. Defaults to None (computed, not cached).
+            mag_min (float, optional): first magnitude of the grid. Defaults to 2.
+            mag_max (float, optional): last magnitude of the grid. Defaults to 9.5.
+            mag_step (float, optional): magnitude step of the grid. Defaults to 0.05.
+            dist_min (float, optional): first hypocentral distance of the grid in km. Defaults to 0.1.
+            dist_max (float, optional): last hypocentral distance of the grid in km. Defaults to 3000.
+            ndist (int, optional): number of distance steps (regular in the square root of the distance). Defaults to 1200.
+        """
+        self._grid = (mag_min, mag_max, mag_step, dist_min, dist_max, ndist)
+        self.mags = numpy.linspace(mag_min, mag_max, int(round((mag_max - mag_min) / mag_step)) + 1)
+        self.roots = numpy.linspace(numpy.sqrt(dist_min), numpy.sqrt(dist_max), ndist + 1)
+        # identity of the tables (see feltreport.EventCache)
+        self.key = 'allen2012_%s' % self._key()
+        self.cache_file = None
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.cache_file = os.path.join(cache_dir, self.key + '.npy')
+        self._logger = logging.getLogger(__name__)
+        self.tables = self._load()
+
+    def _key(self):
+        # the cache is rebuilt when the grid or the coefficients change
+        return hashlib.sha256(repr((self._grid, I_Allen2012_Rhypo.__defaults__)).encode('utf-8')).hexdigest()[:16]
+
+    def _build(self):
+        # [intensity, max_dist] x magnitude x distance
+        tables = numpy.empty((2, len(self.mags), len(self.roots)))
+        for i, mag in enumerate(self.mags):
+            tables[0, i], tables[1, i] = I_Allen2012_Rhypo(mag, 0.0, self.roots**2)
+        return tables
+
+    def _load(self):
+        if self.cache_file is not None and os.path.exists(self.cache_file):
+            try:
+                tables = numpy.load(self.cache_file)
+                if tables.shape == (2, len(self.mags), len(self.roots)):
+                    return tables
+            except (OSError, ValueError) as e:
+                self._logger.warning('Unable to load the IPE tables %s: %s', self.cache_file, str(e))
+        tick = time.time()
+        tables = self._build()
+        self._logger.info('IPE tables computed in %.2f s', time.time() - tick)
+        if self.cache_file is not None:
+            tmp = self.cache_file + '.tmp'
+            with open(tmp, 'wb') as f:
+                numpy.save(f, tables)
+            os.replace(tmp, self.cache_file)
+        return tables
+
+    def __call__(self, eq_mag, eq_depth, sta_dist):
+        """intensity predicted at the epicentral distances sta_dist (km, array)
+        and maximum distance of the felt reports, as I_Allen2012_Rhypo"""
+        sta_dist = numpy.asarray(sta_dist, dtype=float)
+        fm = (eq_mag - self.mags[0]) / (self.mags[1] - self.mags[0])
+        if not 0 <= fm <= len(self.mags) - 1:
+            return I_Allen2012_Rhypo(eq_mag, eq_depth, sta_dist)
+        # the magnitude is the same for all the reports: the tables of the two
+        # closest magnitudes are interpolated once
+        i = min(int(fm), len(self.mags) - 2)
+        rows = self.tables[:, i] + (self.tables[:, i + 1] - self.tables[:, i]) * (fm - i)
+        slopes = numpy.diff(rows)
+
+        fu = (numpy.sqrt(numpy.sqrt(eq_depth**2 + sta_dist**2)) - self.roots[0]) / (self.roots[1] - self.roots[0])
+        inside = (fu >= 0) & (fu <= len(self.roots) - 1)
+        j = numpy.clip(numpy.where(inside, fu, 0), 0, len(self.roots) - 2).astype(numpy.int64)
+        t = fu - j
+        I_sim = rows[0].take(j) + slopes[0].take(j) * t
+        max_dist = rows[1].take(j) + slopes[1].take(j) * t
+        if not inside.all():
+            outside = ~inside
+            I_sim[outside], max_dist[outside] = I_Allen2012_Rhypo(eq_mag, eq_depth, sta_dist[outside])
+        return I_sim, max_dist
+
+    def check(self, n=100000, seed=0):
+        """maximum interpolation errors on n random magnitudes, depths (0 to
+        50 km) and distances (0.1 to 3000 km) against the closed form: absolute
+        on the intensity, relative on the maximum distance, and number of
+        maximum distances defined by only one of them. Returns a dict with
+        'ok' True if they are within INTENSITY_ERROR and MAX_DIST_ERROR."""
+        rng = numpy.random.default_rng(seed)
+        res = {'intensity': 0.0, 'max_dist': 0.0, 'nan': 0}
+        for mag in rng.uniform(self.mags[0], self.mags[-1], 100):
+            depth = rng.uniform(0, 50)
+            dist = numpy.exp(rng.uniform(numpy.log(0.1), numpy.log(3000), n // 100))
+            I_ref, max_ref = I_Allen2012_Rhypo(mag, depth, dist)
+            I_sim, max_dist = self(mag, depth, dist)
+            defined = ~numpy.isnan(max_ref) & ~numpy.isnan(max_dist)
+            res['intensity'] = max(res['intensity'], float(numpy.max(numpy.abs(I_sim - I_ref))))
+            if defined.any():
+                error = numpy.abs(max_dist[defined] - max_ref[defined]) / max_ref[defined]
+                res['max_dist'] = max(res['max_dist'], float(numpy.max(error)))
+            res['nan'] += int(numpy.count_nonzero(numpy.isnan(max_ref) != numpy.isnan(max_dist)))
+        res['ok'] = res['intensity'] <= INTENSITY_ERROR and res['max_dist'] <= MAX_DIST_ERROR and res['nan'] == 0
+        return res
+
+
+def measure(func, evmag, evdepth, dist, n):
+    """best time in s of func(evmag, evdepth, dist) over n runs"""
+    best = float('inf')
+    for _ in range(n):
+        tick = time.perf_counter()
+        func(evmag, evdepth, dist)
+        best = min(best, time.perf_counter() - tick)
+    return best
+
+
+if __name__ == '__main__':
+    argd = ArgumentParser(description='Allen et al. (2012) IPE lookup tables: build the cache, check the error and time it')
+    argd.add_argument('--cache-dir', help='directory of the .npy file of the tables')
+    argd.add_argument('--check', help='check the interpolation error against the closed form', action='store_true')
+    argd.add_argument('--reports', help='number of distances of the timing', type=int, default=100000)
+    argd.add_argument('-n', help='number of repetitions of the timing', type=int, default=20)
+
+    args = argd.parse_args()
+
+    tick = time.perf_counter()
+    ipe = IpeTable(cache_dir=args.cache_dir)
+    sys.stdout.write('tables %s loaded in %.3f s\n' % (ipe.tables.shape, time.perf_counter() - tick))
+
+    dist = numpy.random.default_rng(0).uniform(0, 500, args.reports)
+    for name, func in (('closed form', I_Allen2012_Rhypo), ('tables', ipe)):
+        sys.stdout.write('{0:12} {1:8.2f} ms for {2} distances\n'.format(
+            name, measure(func, 5.5, 10.0, dist, args.n) * 1e3, args.reports))
+
+    if args.check:
+        res = ipe.check()
+        sys.stdout.write('max intensity error %.2g (bound %.2g), max relative max_dist error %.2g (bound %.2g), '
+                         '%d nan mismatch\n' % (res['intensity'], INTENSITY_ERROR, res['max_dist'], MAX_DIST_ERROR,
+                                                res['nan']))
+        if not res['ok']:
+            sys.exit(1)
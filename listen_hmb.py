@@ -1,96 +1,169 @@
 #!/usr/bin/env python3
 
+import json
+import queue as queuelib
 import sys
 import time
+from functools import partial
 
 import getpass
 import logging
 from argparse import ArgumentParser
-from multiprocessing import Queue, Process
+from multiprocessing import Process
 
-from emschmb import EmscHmbListener, load_hmbcfg
+from emschmb import EmscHmbListener, decode_emsc_envelope, emsc_envelope, load_hmbcfg
+from hmbchunks import ChunkAssembler
+from hmbcheckpoint import CheckpointTracker, open_checkpoint_store
+from hmbdedup import DedupCache
+from hmbhandoff import HandoffQueue, POLICIES
+from hmbjournal import Journal
+from hmbsession import RetryPolicy
+from hmbworkers import WorkerPool, CoalescingScheduler, ShardedScheduler
 
 
 # here you can import the function you want to launch
 # BUT it has to be named 'process_message'
 # for example
 from my_processing import process_message
+# and optionally 'close_publishers', run when a worker stops
+try:
+    from my_processing import close_publishers
+except ImportError:
+    close_publishers = None
 
 __version__ = '1.01'
 
 
-def _process_wrapper(p, msg, tag):
-    try:
-        tick = time.time()
-        p(msg)
-        logging.info('%s ended in %.1f s', tag, time.time() - tick)
-    except Exception as e:
-        logging.exception("Unexpected exception during message processing: %s", str(e))
+def process_envelope(envelope, spool_dir=None):
+    """decodes, in the worker, a message handed over without decoding (see
+    --passthrough) and processes it"""
+    return process_message(decode_emsc_envelope(envelope, spool_dir))
+
+
+def _replay(hmb, raw=False):
+    """messages received by a previous run and not processed, from the
+    journal. The segments of the journal are listed at once, before the
+    listener starts writing to it, and decoded as they are iterated. The
+    chunks are left to the listener, which reassembles them with the rest of
+    their transfer (see EmscHmbListener.listen). The queues resume after the
+    messages journaled, which are not received again."""
+    if hmb.journal is None:
+        return iter(())
+    pending = hmb.journal.pending(raw=raw)
+    hmb.resume_after_journal()
+    decode = emsc_envelope if raw else hmb._decode
+    if hmb.chunks is None:
+        return (decode(m) for m in pending)
+    return (decode(m) for m in pending if not hmb.chunks.is_chunk(m))
+
+
+def _received(process_queue, hmbthread, poll=1.):
+    """messages handed over by the listener process, until it stops (e.g.
+    when it gave up reconnecting)"""
+    while True:
+        try:
+            yield process_queue.get(timeout=poll)
+        except queuelib.Empty:
+            if not hmbthread.is_alive():
+                break
+    # messages put just before the exit
+    while True:
+        try:
+            yield process_queue.get(timeout=0)
+        except queuelib.Empty:
+            break
+    logging.error('The hmb listener process stopped (exit code %s)', hmbthread.exitcode)
 
 
-def shellprocess_manager_multithread(hmb, maxprocess=3):
-    process_queue = Queue()
-    hmbthread = Process(name='hmbthread', target=launch_hmb, args=(process_queue, hmb))
-    hmbthread.start()
+def _commit(hmb, msg):
+    if hmb.checkpoint is not None and 'seq' in msg:
+        hmb.checkpoint.commit(msg['queue'], msg['seq'])
+    if hmb.journal is not None:
+        hmb.journal.done_msg(msg)
 
-    local_pid = 1
-    running_processes = []
-    while True:
 
-        check_running_processes = [p for p in running_processes if p.is_alive() is True]
+def shellprocess_manager_multithread(hmb, process_queue, maxprocess=3, maxtasksperchild=None, scheduler=None,
+                                     raw=False):
+    replay = _replay(hmb, raw)
+    hmbthread = Process(name='hmbthread', target=launch_hmb, args=(process_queue, hmb, raw))
+    hmbthread.start()
 
-        if len(check_running_processes) >= maxprocess:
-            logging.debug('- Queue full, loop : %s', running_processes)
-            time.sleep(1)
-            continue
+    tracker = CheckpointTracker(hmb.checkpoint) if hmb.checkpoint is not None else None
 
-        msg = process_queue.get()
-        try:
-            tag = 'Process_{0}'.format(local_pid)
-            p = Process(name=tag, target=_process_wrapper, args=(process_message, msg, tag))
-            p.start()
+    def _done(task):
+        if tracker is not None:
+            tracker.done(task.msg.get('queue'), task.msg.get('seq'))
+        if hmb.journal is not None:
+            hmb.journal.done_msg(task.msg)
 
-            local_pid += 1
+    # the workers are started once, each message is dispatched as soon as
+    # one of them is idle
+    func = partial(process_envelope, spool_dir=hmb.spool_dir) if raw else process_message
+    pool = WorkerPool(func, nworkers=maxprocess, maxtasksperchild=maxtasksperchild, scheduler=scheduler,
+                      on_done=_done, finalizer=close_publishers).start()
 
-            logging.debug('- Launch shell process : %s -> %s', tag, p)
-            check_running_processes.append(p)
+    def _submit(msg):
+        try:
+            if tracker is not None:
+                tracker.dispatched(msg.get('queue'), msg.get('seq'))
+            task = pool.submit(msg)
+            logging.debug('- Submit task %d: %s', task.id, pool.stats())
         except Exception as e:
             logging.exception('Unexpected exception : %s', str(e))
 
-        running_processes = check_running_processes
+    try:
+        for msg in replay:
+            _submit(msg)
+
+        for msg in _received(process_queue, hmbthread):
+            _submit(msg)
+    finally:
+        # the workers deliver their pending results before they stop
+        pool.close()
     hmbthread.join()
 
 
-def shellprocess_manager_singlethread(hmb):
-    process_queue = Queue()
-    hmbthread = Process(name='hmbthread', target=launch_hmb, args=(process_queue, hmb))
+def shellprocess_manager_singlethread(hmb, process_queue, raw=False):
+    replay = _replay(hmb, raw)
+    hmbthread = Process(name='hmbthread', target=launch_hmb, args=(process_queue, hmb, raw))
     hmbthread.start()
 
-    while True:
+    func = partial(process_envelope, spool_dir=hmb.spool_dir) if raw else process_message
 
-        msg = process_queue.get()
+    def _process(msg):
         tick = time.time()
         try:
-            process_message(msg)
+            func(msg)
             logging.info('End process in %.1f s', time.time() - tick)
         except Exception as e:
             logging.exception('Unexpected exception : %s', str(e))
+        _commit(hmb, msg)
+
+    for msg in replay:
+        _process(msg)
+
+    for msg in _received(process_queue, hmbthread):
+        _process(msg)
 
     hmbthread.join()
 
 
 def shellprocess_manager_nothread(hmb):
+    for msg in _replay(hmb):
+        process_message(msg)
+        _commit(hmb, msg)
     logging.debug('Begin hmb listener...')
     hmb.listen(process_message)
 
 
-def launch_hmb(pqueue, hmbsession):
+def launch_hmb(pqueue, hmbsession, raw=False):
     def _process_closure(msg):
         logging.info('- hmb msg: %s', msg.keys())
         pqueue.put(msg)
 
     logging.debug('Begin hmb listener...')
-    hmbsession.listen(_process_closure)
+    # messages are checkpointed once processed, not when handed to the manager
+    hmbsession.listen(_process_closure, commit=False, raw=raw)
 
 
 if __name__ == '__main__':
@@ -102,13 +175,36 @@ if __name__ == '__main__':
     argd.add_argument('--queue', help='define the queue to listen')
     argd.add_argument('--user', help='connexion authentication')
     argd.add_argument('--password', help='connexion authentication')
+    argd.add_argument('--topics', help='comma separated list of the topics to receive')
+    argd.add_argument('--filter', help='mongodb like filter (json) of the messages to receive, e.g. \'{"data._header.metadata.mag": {"$gte": 4.5}}\'')
+    argd.add_argument('--retry-time', help='time in s after which the listener stops if it can not reconnect (default: never)', type=float)
     argd.add_argument('--nthreads', help='number of concurrent running threads', type=int, default=3)
+    argd.add_argument('--capacity', help='number of received messages waiting to be processed kept in memory', type=int, default=1000)
+    argd.add_argument('--overflow', help='what to do when --capacity messages are waiting: block the reception, drop the oldest message of the event or spill to disk', choices=POLICIES, default='block')
+    argd.add_argument('--spill-dir', help='directory of the spill file of --overflow spill')
+    argd.add_argument('--stats-interval', help='period in s of the logging of the queue gauges (depth, oldest message age, rates)', type=float, default=60)
+    argd.add_argument('--maxtasksperchild', help='number of messages processed by a worker process before it is replaced', type=int)
+    argd.add_argument('--shard', help='process the messages of an event in order, always by the same worker', action='store_true')
+    argd.add_argument('--coalesce', help='a newer version of an event replaces the one waiting to be processed', action='store_true')
+    argd.add_argument('--cancel-stale', help='with --coalesce, a newer version of an event also cancels the processing of an older one', action='store_true')
+    argd.add_argument('--chunk-dir', help='directory where the files sent in chunks are reassembled')
+    argd.add_argument('--chunk-timeout', help='time in s after which a file whose chunks stopped arriving is abandoned', type=float, default=600)
+    argd.add_argument('--spool-dir', help='directory where the contents of the FILE messages are decompressed, process_message gets their path instead of their content')
+    argd.add_argument('--passthrough', help='hand the messages to the workers without decoding them, the workers decode and decompress them', action='store_true')
     argd.add_argument('--singlethread', help='force single thread running (useful for debugging)', action='store_true')
     argd.add_argument('--nothread', help='force no threading (useful for debugging)', action='store_true')
+    argd.add_argument('--checkpoint', help='file keeping the last processed message of each queue to resume from it (sqlite if it ends with .sqlite or .db)')
+    argd.add_argument('--journal', help='directory of the journal of the messages received, the messages not processed are processed again at restart')
+    argd.add_argument('--dedup', help='size of the cache of the messages seen to drop duplicates, 0 to disable', type=int, default=10000)
+    argd.add_argument('--dedup-keys', help='comma separated message keys identifying duplicates besides (queue, seq)', default='metadata.evid,metadata.count')
+    argd.add_argument('--dedup-ttl', help='time in s a message is remembered by the duplicates cache', type=float)
+    argd.add_argument('--dedup-file', help='file where the duplicates cache is persisted')
     argd.add_argument('-v', '--verbose', action='store_true')
 
     args = argd.parse_args()
     dargs = vars(args)
+    if args.passthrough and args.nothread:
+        argd.error('--passthrough needs a listener process, it can not be used with --nothread')
 
     logging.basicConfig(
         stream=sys.stderr, level=logging.DEBUG if args.verbose else logging.INFO,
@@ -143,7 +239,26 @@ if __name__ == '__main__':
         password = getpass.getpass('Password for {0} : '.format(user))
 
     heartbeat = args.timeout / 2
-    hmb = EmscHmbListener(url, heartbeat=heartbeat)
+    checkpoint = None
+    if args.checkpoint is not None:
+        logging.info('Use checkpoints from %s', args.checkpoint)
+        checkpoint = open_checkpoint_store(args.checkpoint)
+    dedup = None
+    if args.dedup > 0:
+        dedup = DedupCache(
+            maxsize=args.dedup, ttl=args.dedup_ttl, filename=args.dedup_file,
+            keys=[k for k in args.dedup_keys.split(',') if k])
+    journal = None
+    if args.journal is not None:
+        logging.info('Journal the messages in %s', args.journal)
+        journal = Journal(args.journal).start_compaction()
+    chunks = None
+    if args.chunk_dir is not None:
+        logging.info('Reassemble the files sent in chunks in %s', args.chunk_dir)
+        chunks = ChunkAssembler(args.chunk_dir, timeout=args.chunk_timeout)
+    retry_policy = RetryPolicy(max_delay=10, max_retry_time=args.retry_time)
+    hmb = EmscHmbListener(url, heartbeat=heartbeat, retry_policy=retry_policy, checkpoint=checkpoint, dedup=dedup,
+                          journal=journal, chunks=chunks, spool_dir=args.spool_dir)
 
     auth = None
     if user is not None and password is not None:
@@ -152,14 +267,42 @@ if __name__ == '__main__':
 
     queue = queue.split(',')
 
-    hmb.queue(*queue, nlast=args.nlast)
+    topics = args.topics.split(',') if args.topics else None
+    filter = None
+    if args.filter is not None:
+        try:
+            filter = json.loads(args.filter)
+        except ValueError as e:
+            argd.error('invalid --filter: %s' % str(e))
+        logging.info('Filter: %s', args.filter)
+    try:
+        hmb.queue(*queue, nlast=args.nlast, topics=topics, filter=filter)
+    except ValueError as e:
+        argd.error('invalid --filter: %s' % str(e))
+
+    process_queue = HandoffQueue(
+        capacity=args.capacity, policy=args.overflow, spill_dir=args.spill_dir, log_interval=args.stats_interval,
+        on_drop=journal.done_msg if journal is not None else None)
 
     if args.nothread:
         logging.info('No thread processing')
         shellprocess_manager_nothread(hmb)
     elif args.singlethread:
         logging.info('Single thread processing')
-        shellprocess_manager_singlethread(hmb)
+        shellprocess_manager_singlethread(hmb, process_queue, raw=args.passthrough)
     else:
         logging.info('Multi threads processing (%d process(es))', args.nthreads)
-        shellprocess_manager_multithread(hmb, maxprocess=args.nthreads)
+        scheduler = None
+        if args.coalesce:
+            logging.info('Coalesce the versions of an event%s', ', cancel stale processing' if args.cancel_stale else '')
+        if args.shard:
+            logging.info('Process the messages of an event in order on one worker')
+            scheduler = ShardedScheduler(args.nthreads, coalesce=args.coalesce, cancel_running=args.cancel_stale)
+        elif args.coalesce:
+            scheduler = CoalescingScheduler(cancel_running=args.cancel_stale)
+        shellprocess_manager_multithread(
+            hmb, process_queue, maxprocess=args.nthreads, maxtasksperchild=args.maxtasksperchild, scheduler=scheduler,
+            raw=args.passthrough)
+
+    # the listener stopped: a non zero status lets a supervisor restart it
+    sys.exit(1)
@@ -1,9 +1,12 @@
+import atexit
 import json
 from subprocess import call, Popen, PIPE
 import logging,numpy,os,shutil
 import datetime
 
-from emschmb import EmscHmbPublisher, load_hmbcfg
+from emschmb import EmscHmbBackgroundPublisher, load_hmbcfg
+from ipetables import IpeTable
+from feltreport import EventCache, FeltReportBatch, I_Allen2012_Rhypo, I_to_PGA_Wordon2012, loads_feltreport
 
 from re import search
 import json
@@ -19,58 +22,46 @@ def grep(input,pattern,splitby,index):
             else:
                 print(splitby)
 
-def I_Allen2012_Rhypo(eq_mag,
-                      eq_depth,
-                      sta_dist,
-                      c0 =  2.085,
-                      c1 =  1.428,
-                      c2 = -1.402,
-                      c4 =  0.078,
-                      m1 = -0.209,
-                      m2 =  2.042,
-                      Imin = 3):
-
-    RM = m1 + m2*numpy.exp(eq_mag-5)
-    R_hypo = numpy.sqrt(eq_depth**2+sta_dist**2)
-    I_sim   = c0 + (c1 * eq_mag) + c2*numpy.log(numpy.sqrt(R_hypo**2+RM**2))+c4*numpy.log(R_hypo/50)
-    idx = (R_hypo<=50)
-    I_sim[idx] = c0 + (c1 * eq_mag) + c2*numpy.log(numpy.sqrt(R_hypo[idx]**2+RM**2))
-    max_dist = numpy.sqrt((numpy.exp((Imin-c0-(c1 * eq_mag)-c4*numpy.log(R_hypo/50))/c2))**2-RM**2)
-
-    return I_sim, max_dist
-
-def I_to_PGA_Wordon2012(sta_I,
-                        alpha1 =  1.78,
-                        beta1  =  1.557,
-                        alpha2 = -1.60,
-                        beta2  =  3.7,
-                        thres  =  4.22):
-
-    sta_logPGA = [0 for i in sta_I]
-    for i in range(len(sta_I)):
-        if sta_I[i]<=thres :
-            sta_logPGA[i] = (sta_I[i]-alpha1)/beta1
-        else:
-            sta_logPGA[i] = (sta_I[i]-alpha2)/beta2
-
-    return sta_logPGA
-
-def haversine(lon1, lat1, lon2, lat2,
-              r = 6371 # Radius of earth in kilometers. Use 3956 for miles
-              ):
-    """
-    Calculate the great circle distance between two points
-    on the earth (specified in decimal degrees)
-    """
-    lon1, lat1, lon2, lat2 = map(numpy.deg2rad, [lon1, lat1, lon2, lat2])
-
-    # haversine formula
-    dlon = lon2 - lon1
-    dlat = lat2 - lat1
-    a = numpy.sin(dlat/2)**2 + numpy.cos(lat1) * numpy.cos(lat2) * numpy.sin(dlon/2)**2
-    c = 2 * numpy.arcsin(numpy.sqrt(a))
-
-    return c * r
+_publishers = {}
+
+# reports already processed for the last events of this process: each message
+# of an event has all its reports, only the new ones are processed (use
+# --shard to keep the messages of an event on the same worker). With
+# spill_dir, the events evicted from memory are kept on disk.
+_event_cache = EventCache(maxsize=50, spill_dir=None)
+
+def get_publisher(pubopt):
+    """Background publisher shared by all the messages processed in this process"""
+    key = (pubopt['agency'], pubopt['url'], pubopt['user'])
+    if key not in _publishers:
+        hmb = EmscHmbBackgroundPublisher(pubopt['agency'], pubopt['url'])
+        hmb.authentication(pubopt['user'], pubopt['password'])
+        _publishers[key] = hmb
+    return _publishers[key]
+
+_ipe_tables = {}
+
+def get_ipe_table(cache_dir):
+    """IPE lookup tables shared by all the messages processed in this process,
+    loaded from (or computed and saved in) cache_dir once"""
+    if cache_dir not in _ipe_tables:
+        _ipe_tables[cache_dir] = IpeTable(cache_dir=cache_dir)
+    return _ipe_tables[cache_dir]
+
+def close_publishers():
+    """Sends the pending results and closes the publishers, when the process
+    stops (run by the listener workers at exit, and by atexit otherwise)"""
+    while _publishers:
+        _, hmb = _publishers.popitem()
+        hmb.close()
+
+atexit.register(close_publishers)
+
+def _log_delivery(future):
+    if future.exception() is not None:
+        logging.error('Publishing failed: %s'%future.exception())
+    else:
+        logging.info('--------------------- DONE PUBLISHING -------------------')
 
 def process_message_from_file(file):
     # Open and load the JSON file
@@ -100,6 +91,9 @@ def process_message(msg,
                     finder_inputs='/project/Results_from_FinDer_for_EMSC_felt_reports/online/finder_inputs/',        # path to finder inputs file directory
                     finder_logs=  '/project/Results_from_FinDer_for_EMSC_felt_reports/online/finder_logs/',          # path to finder log file directory
                     S=0.25,
+                    aggregate_km=None, # size in km of the cells the realistic reports are aggregated in (None: a row per report)
+                    max_points=None,   # maximum number of aggregated rows, the cells are enlarged to fit (None: no limit)
+                    ipe_tables=None,   # directory of the cached Allen et al. (2012) lookup tables, interpolated instead of the closed form (None: closed form)
                     publish=True,
                     **pubopt):
     """The User should modify this function.
@@ -167,17 +161,14 @@ def process_message(msg,
     count = metadata['count']
 
     # data is json txt
-    data = json.loads(msg['data'])
+    # the felt report columns are parsed straight into numpy arrays
+    data = loads_feltreport(msg['data'])
     logging.info(data)
 
     evid = data['evid']
 
     # felt report information
-    fdata = data['feltreport']
-    lon = fdata['lon']
-    lat = fdata['lat']
-    intensity = fdata['intensity']
-    dt = fdata['dt']
+    reports = FeltReportBatch.from_feltreport(data['feltreport'])
    
     # event information
     eqinfo = data['eqinfo']
@@ -189,43 +180,46 @@ def process_message(msg,
     #logging.info(data)
    
     #(1) Remove unrealistic high intensities (>10), reports at large distance (max_dist) and delta_I>3 compared to Allen et al. (2012):
-    data_distances = haversine(evlon, evlat, lon, lat)
-    I_sim, max_dist = I_Allen2012_Rhypo(evmag, evdepth, data_distances)
-    realistic_data_mask = (numpy.round(intensity)<=10) * (data_distances<max_dist) * (numpy.abs(intensity-I_sim)<=3)
-    logging.info('Filtering %d realistic felt reports from %d total'%(sum(realistic_data_mask),len(realistic_data_mask)))
+    #    only the reports new since the previous message of the event are processed
+    ipe = I_Allen2012_Rhypo if ipe_tables is None else get_ipe_table(ipe_tables)
+    realistic_data_mask, realistic_rows = _event_cache.update(evid, reports, evlon, evlat, evdepth, evmag, ipe)
+    logging.info('Filtering %d realistic felt reports from %d total'%(numpy.count_nonzero(realistic_data_mask),len(realistic_data_mask)))
 
     #(2) Add artificial intensity datapoint at epicenter:
-    epicentral_intensity = I_Allen2012_Rhypo(evmag, evdepth, numpy.asarray([0.001]))[0][0]+S
+    epicentral_intensity = ipe(evmag, evdepth, numpy.asarray([0.001]))[0][0]+S
     logging.info('Epicentral intensity: %s (M%.1f, %.1f km bsl)'%(epicentral_intensity, evmag, evdepth))
     
     #(3) Convert intensity to PGA:
-    logPGA = I_to_PGA_Wordon2012(intensity)
-    logging.info('Intensities: %s'%', '.join(['%.1f'%d for d in list(set(intensity))]))
-    logging.info('Wordon (2012) log(PGA): %s'%', '.join(['%.4f'%d for d in list(set(logPGA))]))
+    logPGA = reports.logpga
+    logging.info('Intensities: %s'%', '.join(['%.1f'%d for d in numpy.unique(reports.intensity)]))
+    logging.info('Wordon (2012) log(PGA): %s'%', '.join(['%.4f'%d for d in numpy.unique(logPGA)]))
+
+    #(3.1) Optionally aggregate the dense realistic reports, a row per cell with their median intensity:
+    if aggregate_km is not None:
+        cells, cell_count, cell_spread = reports.select(realistic_data_mask).aggregate(aggregate_km, max_points)
+        logging.info('Aggregating %d realistic felt reports in %d cells (up to %d reports, intensity IQR up to %.1f)'%(
+            numpy.sum(cell_count), len(cells), numpy.max(cell_count, initial=0), numpy.max(cell_spread, initial=0)))
+        realistic_rows = cells.finder_text()
 
     #(4) Produce FinDer input files <path>/data_0:
     #    e.i., 3 columns with: lat lon pga_in_cm**2
-    finder_data  = [[lat[i], lon[i], logPGA[i]] for i in numpy.where(realistic_data_mask>0)[0]] 
-    finder_data += [[ evlat,  evlon, I_to_PGA_Wordon2012([epicentral_intensity])[0] ]]
+    epicentral_row = (evlat, evlon, I_to_PGA_Wordon2012([epicentral_intensity])[0])
     
     if not os.path.exists('%s/%s'%(finder_inputs,evid)):
         os.makedirs('%s/%s'%(finder_inputs,evid))
 
     logs = 'Writing version %d inputs in %s/%s/data_%d:\n'%(version,finder_inputs,evid,count)
-    logged = False
     
     if os.path.exists('%s/%s/data_%d'%(finder_inputs,evid,count)):
         logging.info('Data already processed (%s/%s/data_%d)'%(finder_inputs,evid,count))
         return
 
-    with open('%s/%s/data_%d'%(finder_inputs,evid,count), 'w') as f: 
-        for d in finder_data:
-            towrite = '%s %s %s\n'%tuple(d)
-            f.write(towrite) 
-            if not logged:
-                logs+=towrite
-            logged=True
-    logging.info('%s...\n%s'%(logs,towrite))
+    # all the rows in a single write
+    towrite = realistic_rows + '%s %s %s\n'%epicentral_row
+    with open('%s/%s/data_%d'%(finder_inputs,evid,count), 'w') as f:
+        f.write(towrite)
+    rows = towrite.splitlines(True)
+    logging.info('%s%s...\n%s'%(logs,rows[0],rows[-1]))
     shutil.copyfile('%s/%s/data_%d'%(finder_inputs,evid,count), '%s/%s/data_0'%(finder_inputs,evid))
 
     # (4.1) make epicenter input for the ps file
@@ -328,8 +322,7 @@ def process_message(msg,
             and 'password' in pubopt
             and 'queue_pub' in pubopt):
             logging.info('--------------------- PUBLISHING -------------------')
-            hmb = EmscHmbPublisher(pubopt['agency'], pubopt['url'])
-            hmb.authentication(pubopt['user'], pubopt['password'])
+            hmb = get_publisher(pubopt)
 
             metadata['EMSC'] = {}
             metadata['FinDer'] = {}
@@ -348,14 +341,15 @@ def process_message(msg,
             metadata['FinDer']['strike degree']      = fd_strike
             metadata['FinDer']['PGA threshold']      = fd_pga_thresh
 
-            hmb.send_file(pubopt['queue_pub'], psfnameguess, metadata=metadata)
-            logging.info('--------------------- DONE PUBLISHING -------------------')
+            # the file is read here, the network part is done in the background
+            hmb.send_file(pubopt['queue_pub'], psfnameguess, metadata=metadata).add_done_callback(_log_delivery)
 
         else:
             logging.info('CANNOT SEND BACK!!! Sending parameters:')
             logging.info(pubopt)
         logging.info('Moving %s to %s' % (psfnameguess , "%s/%s"%(logfdir, psfnameguess.split('/')[-1])))
         os.rename( psfnameguess ,  "%s/%s"%(logfdir, psfnameguess.split('/')[-1]) )
+
     elif psfnameguess is None:
         logging.info('WARNING !! No ouput files')
 
@@ -22,6 +22,7 @@ if __name__ == '__main__':
     argd.add_argument('--password', help='connexion authentication')
     argd.add_argument('-m', '--metadata', help=' add metadata information to the message. the format is key:val. It can be used multiple times',
                       action='append', default=[])
+    argd.add_argument('--topic', help='topic of the message, listeners can receive only some topics')
 
     args = argd.parse_args()
     dargs = vars(args)
@@ -82,27 +83,27 @@ if __name__ == '__main__':
         argd.exit()
 
     if args.type == 'file':
-        hmb.send_file(queue, argsmsg, metadata=metadata)
+        hmb.send_file(queue, argsmsg, metadata=metadata, topic=args.topic)
         logging.info('File \'%s\' sent to queue %s', argsmsg, args.queue)
     elif args.type == 'fstr':
         with open(argsmsg, 'r', encoding='utf-8') as f:
             msg = f.read()
-        hmb.send_str(queue, msg, compress=True, encoding='utf-8', metadata=metadata)
+        hmb.send_str(queue, msg, compress=True, encoding='utf-8', metadata=metadata, topic=args.topic)
         logging.info('Str content of file \'%s\' (size %d) sent to queue %s', argsmsg, len(argsmsg), args.queue)
     elif args.type == 'fbin':
         with open(argsmsg, 'rb') as f:
             msg = f.read()
-        hmb.send_bin(queue, msg, compress=True, metadata=metadata)
+        hmb.send_bin(queue, msg, compress=True, metadata=metadata, topic=args.topic)
         logging.info('Binary content of file \'%s\' (size %d) sent to queue %s', argsmsg, len(argsmsg), args.queue)
     elif args.type == 'txt':
-        hmb.send_str(queue, argsmsg, compress=False, metadata=metadata)
+        hmb.send_str(queue, argsmsg, compress=False, metadata=metadata, topic=args.topic)
         logging.info('Txt (size %d) sent to queue %s', len(argsmsg), args.queue)
     elif args.type == 'ztxt':
-        hmb.send_str(queue, argsmsg, compress=True, metadata=metadata)
+        hmb.send_str(queue, argsmsg, compress=True, metadata=metadata, topic=args.topic)
         logging.info('Compressed Txt (size %d) sent to queue %s', len(argsmsg), args.queue)
     elif args.type == 'json':
         msg = json.loads(argsmsg)
-        hmb.send(queue, msg, metadata=metadata)
+        hmb.send(queue, msg, metadata=metadata, topic=args.topic)
         logging.info('Json sent to queue %s', args.queue)
     else:
         raise NameError('Not implemented')
@@ -79,4 +79,9 @@ if __name__ == '__main__':
         logging.info('Use authentication')
         hmb.authentication(user, password)
 
-    hmb.get(display if args.check else process_message, queue, filter)
+    func = display if args.check else process_message
+    nmsg = 0
+    for msg in hmb.iter_get(queue, filter):
+        func(msg)
+        nmsg += 1
+    logging.info('%d message(s) replayed', nmsg)